@@ -0,0 +1,66 @@
+"""Compare ``ExcludeFilter`` throughput against per-pattern ``match_pattern`` checks.
+
+Run with ``uv run python benchmarks/bench_exclude.py``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from watchfiles import Change
+
+from watchfs.filters import ExcludeFilter, match_pattern
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+EXCLUDES = ".git/**,node_modules,__pycache__,*.pyc,*.egg-info/**,build/,dist/,.venv,.mypy_cache,*/cache/**,*.tmp"
+NAMES = ["src", "lib", "pkg", "core", "utils", "tests", "docs", "app", "api", "models", "node_modules", ".git"]
+
+
+def generate_paths(count: int, depth: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    root = "/home/user/projects/watchfs"
+    paths: list[str] = []
+    for _ in range(count):
+        parts = [rng.choice(NAMES) for _ in range(rng.randint(1, depth))]
+        parts.append(f"file{rng.randint(0, 50)}{rng.choice(['.py', '.pyc', '.txt', '.tmp'])}")
+        paths.append("/".join([root, *parts]))
+    return paths
+
+
+def measure(label: str, check: Callable[[Change, str], bool], paths: list[str]) -> float:
+    start = time.perf_counter()
+    for path in paths:
+        check(Change.modified, path)
+    elapsed = time.perf_counter() - start
+    rate = len(paths) / elapsed
+    print(f"{label:<10} {rate:>12,.0f} events/s")
+    return rate
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=100_000)
+    parser.add_argument("--depth", type=int, default=12)
+    args = parser.parse_args()
+
+    paths = generate_paths(args.events, args.depth)
+    exclude_filter = ExcludeFilter(EXCLUDES)
+    patterns = exclude_filter.exclude_patterns
+
+    def legacy(change: Change, path: str) -> bool:
+        return all(not match_pattern(Path(path), pattern) for pattern in patterns)
+
+    print(f"{len(patterns)} patterns, {args.events:,} events, depth <= {args.depth}")
+    baseline = measure("legacy", legacy, paths)
+    compiled = measure("compiled", exclude_filter, paths)
+    print(f"speedup    {compiled / baseline:>12.1f}x")
+
+
+if __name__ == "__main__":
+    main()
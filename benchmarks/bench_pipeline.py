@@ -0,0 +1,244 @@
+"""Benchmark the watch -> filter -> sync pipeline and report the results as JSON.
+
+Run with ``uv run python benchmarks/bench_pipeline.py [--quick] [--output results.json]``.
+Each benchmark works on synthetic trees in a temporary directory, SSH targets run their
+remote commands with a local ``sh`` instead of ``ssh``. Compare two result files to catch
+regressions, the ``value`` of every result is higher-is-better unless its unit is seconds.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path, PurePath, PurePosixPath
+from typing import TYPE_CHECKING
+
+from bench_exclude import EXCLUDES, generate_paths
+from watchfiles import Change
+
+from watchfs import __version__
+from watchfs.__main__ import consume_target_queue, watch_source
+from watchfs.events import SyncJob
+from watchfs.filters import ChangeCacheFilter, ExcludeFilter, combine_filters
+from watchfs.mappings import LocalTargetSpec, SshTargetSpec, SyncMapping
+from watchfs.queues import CoalescingQueue
+from watchfs.targets import LocalTarget, SshTarget, TargetHealth
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+# Extra patterns on top of ``EXCLUDES``, so filters are measured against a long list.
+HEAVY_EXCLUDES = ",".join([EXCLUDES, *(f"generated{index}/**,*.out{index}" for index in range(40))])
+
+
+@dataclass(frozen=True, slots=True)
+class Scale:
+    events: int
+    small_files: int
+    huge_files: int
+    huge_size: int
+    depth: int
+    samples: int
+
+
+FULL = Scale(events=200_000, small_files=5_000, huge_files=3, huge_size=256 * 1024 * 1024, depth=24, samples=30)
+QUICK = Scale(events=20_000, small_files=500, huge_files=1, huge_size=16 * 1024 * 1024, depth=12, samples=5)
+
+
+@dataclass(frozen=True, slots=True)
+class Result:
+    name: str
+    value: float
+    unit: str
+    parameters: dict[str, object] = field(default_factory=dict)
+
+
+class LoopbackSshTarget(SshTarget):
+    # Runs the remote commands with a local shell, so only the local side of SSH is measured.
+    def _ssh_base_command(self) -> list[str]:
+        return ["sh", "-c"]
+
+
+def generate_tree(root: Path, *, files: int, depth: int, size: int = 4096, seed: int = 0) -> list[Path]:
+    """Create ``files`` files of ``size`` bytes spread over directories nested up to ``depth`` levels."""
+    rng = random.Random(seed)
+    paths: list[Path] = []
+    for index in range(files):
+        directory = root.joinpath(*(f"d{rng.randint(0, 3)}" for _ in range(rng.randint(0, depth))))
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"file{index}.txt"
+        path.write_bytes(rng.randbytes(size))
+        paths.append(path)
+    return paths
+
+
+def generate_huge_files(root: Path, *, count: int, size: int) -> list[Path]:
+    root.mkdir(parents=True, exist_ok=True)
+    paths: list[Path] = []
+    chunk = os.urandom(1024 * 1024)
+    for index in range(count):
+        path = root / f"huge{index}.bin"
+        with path.open("wb") as stream:
+            for _ in range(size // len(chunk)):
+                stream.write(chunk)
+        paths.append(path)
+    return paths
+
+
+def bench_exclude_filter(scale: Scale, _: Path) -> list[Result]:
+    paths = generate_paths(scale.events, scale.depth)
+    exclude_filter = ExcludeFilter(HEAVY_EXCLUDES)
+    elapsed = _timed(lambda: [exclude_filter(Change.modified, path) for path in paths])
+    parameters = {"events": scale.events, "patterns": len(exclude_filter.exclude_patterns), "depth": scale.depth}
+    return [Result("exclude_filter", scale.events / elapsed, "events/s", parameters)]
+
+
+def bench_content_cache_filter(scale: Scale, workdir: Path) -> list[Result]:
+    files = generate_tree(workdir / "cache", files=scale.small_files, depth=4)
+    changes = {(Change.modified, str(path)) for path in files}
+    content_filter = ChangeCacheFilter(max_entries=len(files) * 2)
+    first = _timed(lambda: asyncio.run(content_filter.filter_changes(changes)))
+    # Nothing changed, so every file is answered from its cached stat signature.
+    repeated = _timed(lambda: asyncio.run(content_filter.filter_changes(changes)))
+    parameters = {"files": len(files)}
+    return [
+        Result("content_cache_filter_first_seen", len(files) / first, "events/s", parameters),
+        Result("content_cache_filter_unchanged", len(files) / repeated, "events/s", parameters),
+    ]
+
+
+def bench_local_copy(scale: Scale, workdir: Path) -> list[Result]:
+    small = generate_tree(workdir / "small", files=scale.small_files, depth=scale.depth // 4)
+    huge = generate_huge_files(workdir / "huge", count=scale.huge_files, size=scale.huge_size)
+    results: list[Result] = []
+    for label, root, files in (("small", workdir / "small", small), ("huge", workdir / "huge", huge)):
+        target = LocalTarget(LocalTargetSpec(workdir / f"dst-{label}"))
+        items = [(PurePath(path.relative_to(root)), path) for path in files]
+        elapsed = _timed(lambda target=target, items=items: asyncio.run(target.write_files(items)))
+        total = sum(path.stat().st_size for path in files)
+        parameters = {"files": len(files), "bytes": total}
+        results.append(Result(f"local_copy_{label}_files", total / elapsed / 1024**2, "MiB/s", parameters))
+        if label == "small":
+            results.append(Result("local_copy_small_files_rate", len(files) / elapsed, "files/s", parameters))
+    return results
+
+
+def bench_ssh_operations(scale: Scale, workdir: Path) -> list[Result]:
+    source = workdir / "ssh-src" / "file.txt"
+    source.parent.mkdir()
+    remote = workdir / "ssh-remote"
+    target = LoopbackSshTarget(SshTargetSpec(host="bench", path=PurePosixPath(remote.as_posix())), delta_min_size=None)
+    operations = scale.samples * 4
+
+    async def writes() -> None:
+        for index in range(operations):
+            source.write_text(str(index))
+            await target.write_files([(PurePath("file.txt"), source)])
+
+    async def removals() -> None:
+        for index in range(operations):
+            await target.remove_paths([PurePath(f"missing{index}")])
+
+    parameters = {"operations": operations, "ssh": "sh -c stand-in"}
+    return [
+        Result("ssh_write_rate", operations / _timed(lambda: asyncio.run(writes())), "ops/s", parameters),
+        Result("ssh_remove_rate", operations / _timed(lambda: asyncio.run(removals())), "ops/s", parameters),
+    ]
+
+
+def bench_end_to_end_latency(scale: Scale, workdir: Path) -> list[Result]:
+    source, destination = workdir / "e2e-src", workdir / "e2e-dst"
+    source.mkdir()
+    mapping = SyncMapping(source, LocalTargetSpec(destination))
+    job = SyncJob(mapping=mapping, target=LocalTarget(mapping.target), queue_key="local")
+
+    async def measure() -> list[float]:
+        queue = CoalescingQueue()
+        tasks = [
+            asyncio.create_task(watch_source(source.resolve(), [job], {"local": queue}, combine_filters([]))),
+            asyncio.create_task(consume_target_queue(queue, TargetHealth())),
+        ]
+        latencies: list[float] = []
+        try:
+            # Let the watcher start before the first change.
+            await asyncio.sleep(0.5)
+            for index in range(scale.samples):
+                name = f"file{index}.txt"
+                started = time.perf_counter()
+                (source / name).write_text(name)
+                while not (destination / name).exists():
+                    await asyncio.sleep(0.001)
+                latencies.append(time.perf_counter() - started)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return latencies
+
+    # The pipeline prints a line per change, which must not end up in the JSON output.
+    with contextlib.redirect_stdout(io.StringIO()):
+        latencies = asyncio.run(measure())
+    parameters = {"samples": len(latencies), "note": "includes the watcher's debounce"}
+    return [
+        Result("end_to_end_latency_p50", statistics.median(latencies), "s", parameters),
+        Result("end_to_end_latency_max", max(latencies), "s", parameters),
+    ]
+
+
+BENCHMARKS: dict[str, Callable[[Scale, Path], list[Result]]] = {
+    "exclude_filter": bench_exclude_filter,
+    "content_cache_filter": bench_content_cache_filter,
+    "local_copy": bench_local_copy,
+    "ssh_operations": bench_ssh_operations,
+    "end_to_end_latency": bench_end_to_end_latency,
+}
+
+
+def _timed(function: Callable[[], object]) -> float:
+    started = time.perf_counter()
+    function()
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="Run on small inputs, e.g. in CI.")
+    parser.add_argument("--only", choices=sorted(BENCHMARKS), action="append", help="Run only these benchmarks.")
+    parser.add_argument("--output", type=Path, help="Write the JSON results here instead of stdout.")
+    args = parser.parse_args()
+
+    scale = QUICK if args.quick else FULL
+    results: list[Result] = []
+    for name in args.only or BENCHMARKS:
+        with tempfile.TemporaryDirectory(prefix=f"watchfs-bench-{name}-") as workdir:
+            for result in BENCHMARKS[name](scale, Path(workdir)):
+                print(f"{result.name:<36} {result.value:>14,.4g} {result.unit}", file=sys.stderr)
+                results.append(result)
+
+    report = {
+        "watchfs": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": "quick" if args.quick else "full",
+        "results": [asdict(result) for result in results],
+    }
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        args.output.write_text(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
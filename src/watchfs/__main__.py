@@ -2,10 +2,13 @@ from __future__ import annotations
 
 import argparse
 import asyncio
+import dataclasses
+import itertools
 import sys
-from dataclasses import dataclass
-from pathlib import Path
-from typing import TYPE_CHECKING
+import time
+from collections import Counter
+from pathlib import Path, PurePath
+from typing import TYPE_CHECKING, Literal
 
 from colored import Back, Fore
 from watchfiles import Change, awatch
@@ -13,17 +16,37 @@ from watchfiles import Change, awatch
 from watchfs import __version__
 from watchfs.as_sync import as_sync
 from watchfs.colorful import Badge
-from watchfs.filters import ChangeCacheFilter, ExcludeFilter, combine_filters
+from watchfs.console import CONSOLE, SUMMARY_INTERVAL
+from watchfs.delta import DELTA_MIN_SIZE
+from watchfs.echoes import EchoSuppressor
+from watchfs.events import SyncEvent, SyncJob
+from watchfs.exceptions import TargetUnavailableError
+from watchfs.fanout import SharedReads
+from watchfs.filters import ChangeCacheFilter, ExcludeFilter, IgnoreFileFilter, MeasuredFilter, combine_filters
 from watchfs.mappings import SshTargetSpec, SyncMapping, parse_sync_mapping
+from watchfs.metrics import REGISTRY, serve_metrics, write_stats_periodically
+from watchfs.moves import MoveDetector
+from watchfs.priorities import PRIORITY_AGING, Priority, PriorityPolicy, parse_priority_rule, priority_for
+from watchfs.queues import CoalescingQueue
+from watchfs.reconcile import diff_subtree, reconcile_job
 from watchfs.rusty import Err, Ok
-from watchfs.targets import SyncTarget, create_target
+from watchfs.scan import iter_file_paths
+from watchfs.shaping import TokenBucket, buckets_for, parse_bandwidth_limit, parse_rate
+from watchfs.state import FLUSH_INTERVAL, SyncStateIndex, collect_states
+from watchfs.targets import LocalTarget, TargetHealth, create_target
 
 if TYPE_CHECKING:
+    from collections.abc import Iterator
+
     from watchfiles.filters import BaseFilter
 
+    from watchfs.scan import FileState
+    from watchfs.targets import SourceOpener
+
 BADGE_ADD = Badge("ADDED", Fore.black, Back.green)  # type: ignore
 BADGE_DEL = Badge("DELETED", Fore.black, Back.red)  # type: ignore
 BADGE_MOD = Badge("MODIFIED", Fore.black, Back.blue)  # type: ignore
+BADGE_MOVE = Badge("MOVED", Fore.black, Back.yellow)  # type: ignore
 CHANGE_TYPE_TO_BADGE = {
     Change.added: BADGE_ADD,
     Change.deleted: BADGE_DEL,
@@ -31,77 +54,321 @@ CHANGE_TYPE_TO_BADGE = {
 }
 
 
-async def handle_added(src_dir: Path, target: SyncTarget, changed: Path):
-    await handle_modified(src_dir, target, changed)
-
-
-async def handle_modified(src_dir: Path, target: SyncTarget, changed: Path):
-    changed_rel_to_src = changed.relative_to(src_dir)
+def iter_source_files(
+    src_dir: Path, changed: Path, path_filter: BaseFilter | None = None
+) -> Iterator[tuple[PurePath, Path]]:
+    """Expand a changed path into the files to write, blocking so it is meant to be consumed off the loop."""
     if changed.is_dir():
-        for child in changed.iterdir():
-            await handle_modified(src_dir, target, child)
+        prefix = changed.relative_to(src_dir)
+        for relative_path in iter_file_paths(changed, path_filter):
+            yield prefix / relative_path, changed / relative_path
     elif changed.is_file():
-        await target.write_file(changed_rel_to_src, changed)
-
-
-async def handle_removed(src_dir: Path, target: SyncTarget, changed: Path):
-    changed_rel_to_src = changed.relative_to(src_dir)
-    await target.remove_path(changed_rel_to_src)
-
+        yield changed.relative_to(src_dir), changed
 
-@dataclass(frozen=True, slots=True)
-class SyncJob:
-    mapping: SyncMapping
-    target: SyncTarget
-    queue_key: str
 
+MAX_BATCH_SIZE = 10000
+# Applying an event is given up after this many failures while its target was reachable.
+MAX_ATTEMPTS = 5
+RESCAN_BATCH_SIZE = 1000
+DEFAULT_QUEUE_LIMIT = 100_000
 
-@dataclass(frozen=True, slots=True)
-class SyncEvent:
-    job: SyncJob
-    change: Change
-    path: Path
 
-
-async def consume_target_queue(queue: asyncio.Queue[SyncEvent]) -> None:
+async def consume_target_queue(queue: CoalescingQueue, health: TargetHealth, *, batch_window: float = 0.0) -> None:
     while True:
-        event = await queue.get()
+        await health.wait()
+        if health.unavailable:
+            await reconnect_targets(queue, health)
+            continue
+        events = await collect_batch(queue, batch_window)
         try:
             try:
-                await apply_event(event)
+                await apply_events(events)
+                health.succeeded()
             except asyncio.CancelledError:
                 raise
+            except TargetUnavailableError as err:
+                REGISTRY.inc("watchfs_events_failed_total", len(events), target=events[0].job.target.description)
+                # Nothing reached the target, so the events wait for it without counting as attempts.
+                queue.requeue(events)
+                CONSOLE.failed(events[0].job.target.description, [event.path for event in events], err, retry=True)
+                if not health.unavailable:
+                    print(f"{err}, pausing its changes until it is back", file=sys.stderr)
+                health.failed({id(event.job.target): event.job.target for event in events}.values())
             except Exception as err:
-                print(f"Failed to sync {event.path} to {event.job.target.description}: {err}", file=sys.stderr)
+                REGISTRY.inc("watchfs_events_failed_total", len(events), target=events[0].job.target.description)
+                # The target is reachable, so only these events back off and everything else keeps syncing.
+                delay = health.retry_delay(events[0].attempts + 1)
+                retries = [
+                    dataclasses.replace(event, attempts=event.attempts + 1, retry_at=time.monotonic() + delay)
+                    for event in events
+                ]
+                queue.requeue([event for event in retries if event.attempts < MAX_ATTEMPTS])
+                target = events[0].job.target.description
+                retry = retries[0].attempts < MAX_ATTEMPTS
+                CONSOLE.failed(target, [event.path for event in events], err, retry=retry)
+                given_up = f" retrying in {delay:.1f}s" if retry else " giving up"
+                if len(events) == 1:
+                    print(f"Failed to sync {events[0].path} to {target}: {err},{given_up}", file=sys.stderr)
+                else:
+                    print(f"Failed to sync {len(events)} changes to {target}: {err},{given_up}", file=sys.stderr)
         finally:
-            queue.task_done()
+            for event in events:
+                queue.task_done(event)
+
+
+async def reconnect_targets(queue: CoalescingQueue, health: TargetHealth) -> None:
+    # Only one worker of the queue reconnects, the others find the targets back or wait for the next try.
+    async with health.lock:
+        if not health.unavailable:
+            return
+        for target in await health.reconnect():
+            CONSOLE.message(f"{target.description} is back, syncing {queue.qsize()} pending changes")
+
+
+async def collect_batch(queue: CoalescingQueue, batch_window: float) -> list[SyncEvent]:
+    """Wait for one event, then take everything that arrives within ``batch_window`` seconds.
+
+    An event that already failed more than once is applied on its own, so a path that keeps
+    failing does not take the rest of a batch down with it.
+    """
+    events = [await queue.get()]
+    if events[0].attempts > 1:
+        return events
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + batch_window
+    while len(events) < MAX_BATCH_SIZE:
+        try:
+            event = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                event = await asyncio.wait_for(queue.get(), remaining)
+            except TimeoutError:
+                break
+        if event.attempts > 1:
+            # Handed back, it is retried in a batch of its own.
+            queue.requeue([event])
+            queue.task_done(event)
+            break
+        events.append(event)
+    return events
+
+
+type RunKind = Literal["write", "remove", "move", "rescan"]
+
+# How the changes of a run are counted in summaries and logs, writes and removals go by their change.
+SYNCED_CHANGE_NAMES: dict[RunKind, str] = {"move": "moved", "rescan": "rescanned"}
+
+
+def split_event_runs(events: list[SyncEvent]) -> Iterator[tuple[SyncJob, RunKind, list[SyncEvent]]]:
+    """Group events by job, then into consecutive runs of writes, removals, moves and rescans.
+
+    Order is only kept within a job since different jobs never share a destination.
+    """
+    jobs: dict[int, list[SyncEvent]] = {}
+    for event in events:
+        jobs.setdefault(id(event.job), []).append(event)
+    for job_events in jobs.values():
+        for kind, run in itertools.groupby(job_events, key=event_run_kind):
+            yield job_events[0].job, kind, list(run)
+
+
+def event_run_kind(event: SyncEvent) -> RunKind:
+    if event.rescan:
+        return "rescan"
+    if event.moved_from is not None:
+        return "move"
+    return "remove" if event.change == Change.deleted else "write"
+
+
+async def apply_events(events: list[SyncEvent]) -> None:
+    for job, kind, run in split_event_runs(events):
+        started = time.perf_counter()
+        await apply_run(job, kind, run)
+        target, elapsed = job.target.description, time.perf_counter() - started
+        REGISTRY.observe("watchfs_operation_seconds", elapsed, target=target, operation=kind)
+        REGISTRY.inc("watchfs_events_applied_total", len(run), target=target)
+        now = time.monotonic()
+        synced: list[tuple[str, Path, float]] = []
+        for event in run:
+            REGISTRY.observe("watchfs_sync_lag_seconds", now - event.observed_at, target=target)
+            synced.append((SYNCED_CHANGE_NAMES.get(kind, event.change.name), event.path, now - event.observed_at))
+        CONSOLE.synced(target, synced, elapsed)
+
 
+async def apply_run(job: SyncJob, kind: RunKind, run: list[SyncEvent]) -> None:
+    src_dir = job.mapping.source.resolve()
+    opener = job.reads.open if job.reads is not None else None
+    match kind:
+        case "remove":
+            await remove_paths(job, [event.path.relative_to(src_dir) for event in run])
+        case "write":
+            # Directories are expanded lazily while the target writes, so large trees stream through.
+            files = (file for event in run for file in iter_source_files(src_dir, event.path, job.path_filter))
+            await write_files(job, files, opener)
+        case "move":
+            for event in run:
+                assert event.moved_from is not None
+                old_path, new_path = event.moved_from.relative_to(src_dir), event.path.relative_to(src_dir)
+                if await job.target.move_path(old_path, new_path):
+                    if job.state is not None:
+                        job.state.move(old_path, new_path)
+                else:
+                    # The destination never had the old path, so upload the new one instead.
+                    await write_files(job, iter_source_files(src_dir, event.path, job.path_filter), opener)
+        case "rescan":
+            for event in run:
+                await resync_subtree(job, event.path, opener)
 
-async def apply_event(event: SyncEvent) -> None:
-    src_dir = event.job.mapping.source.resolve()
-    match event.change:
-        case Change.added:
-            await handle_added(src_dir, event.job.target, event.path)
-        case Change.modified:
-            await handle_modified(src_dir, event.job.target, event.path)
-        case Change.deleted:
-            await handle_removed(src_dir, event.job.target, event.path)
+
+async def resync_subtree(job: SyncJob, path: Path, opener: SourceOpener | None) -> None:
+    """Bring the destination's copy of a directory whose changes overflowed the queue up to date."""
+    CONSOLE.message(f"Rescanning {path} for {job.target.description}, its changes overflowed the queue")
+    src_dir = job.mapping.source.resolve()
+    if not path.is_dir():
+        # Replaced or removed since it overflowed, so it is synced like any changed path.
+        if path.exists():
+            await write_files(job, iter_source_files(src_dir, path, job.path_filter), opener)
+        else:
+            await remove_paths(job, [path.relative_to(src_dir)])
+        return
+    writes: list[tuple[PurePath, Path]] = []
+    removals: list[PurePath] = []
+
+    async def flush() -> None:
+        # Removals first, a file may have been replaced by a directory of the same name.
+        if removals:
+            await remove_paths(job, removals.copy())
+            removals.clear()
+        if writes:
+            await write_files(job, iter(writes.copy()), opener)
+            writes.clear()
+
+    async for change, changed in diff_subtree(job, path):
+        if change == Change.deleted:
+            removals.append(changed.relative_to(src_dir))
+        else:
+            writes.append((changed.relative_to(src_dir), changed))
+        if len(writes) + len(removals) >= RESCAN_BATCH_SIZE:
+            await flush()
+    await flush()
+
+
+async def remove_paths(job: SyncJob, relative_paths: list[PurePath]) -> None:
+    await job.target.remove_paths(relative_paths)
+    if job.state is not None:
+        for relative_path in relative_paths:
+            job.state.remove(relative_path)
+
+
+async def write_files(job: SyncJob, files: Iterator[tuple[PurePath, Path]], opener: SourceOpener | None) -> None:
+    if job.state is None:
+        await job.target.write_files(files, opener)
+        return
+    # Stat each file before it is written, a change while writing then shows up as a mismatch on restart.
+    states: list[FileState] = []
+    await job.target.write_files(collect_states(files, states), opener)
+    job.state.record(states)
+
+
+async def flush_state_periodically(indexes: list[SyncStateIndex]) -> None:
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        for index in indexes:
+            await asyncio.to_thread(index.flush)
 
 
 async def watch_source(
     source: Path,
     jobs: list[SyncJob],
-    queues: dict[str, asyncio.Queue[SyncEvent]],
+    queues: dict[str, CoalescingQueue],
     filter: BaseFilter,
     *,
+    content_filter: ChangeCacheFilter | None = None,
+    move_detector: MoveDetector | None = None,
+    echoes: EchoSuppressor | None = None,
+    priorities: PriorityPolicy | None = None,
     force_polling: bool = False,
 ) -> None:
-    async for changes in awatch(source, watch_filter=filter, force_polling=force_polling):
-        for change, path in changes:
-            path = Path(path).absolute()
-            print(f"{CHANGE_TYPE_TO_BADGE[change]} {path}")
+    labels = {"source": str(source)}
+    measured_filter = MeasuredFilter(filter)
+    REGISTRY.gauge("watchfs_events_filtered_total", lambda: measured_filter.dropped, filter="path", **labels)
+    REGISTRY.gauge("watchfs_filter_seconds_total", lambda: measured_filter.seconds, filter="path", **labels)
+    async for changes in awatch(source, watch_filter=measured_filter, force_polling=force_polling):
+        REGISTRY.inc("watchfs_events_received_total", len(changes), **labels)
+        if echoes is not None:
+            received = len(changes)
+            changes = await asyncio.to_thread(echoes.filter_changes, changes)
+            REGISTRY.inc("watchfs_events_filtered_total", received - len(changes), filter="echo", **labels)
+        if content_filter is not None:
+            started, received = time.perf_counter(), len(changes)
+            changes = await content_filter.filter_changes(changes)
+            REGISTRY.inc("watchfs_filter_seconds_total", time.perf_counter() - started, filter="content", **labels)
+            REGISTRY.inc("watchfs_events_filtered_total", received - len(changes), filter="content", **labels)
+        if move_detector is not None:
+            for old_path, new_path in await asyncio.to_thread(move_detector.update, changes):
+                changes -= {(Change.deleted, str(old_path)), (Change.added, str(new_path))}
+                old_path, new_path = old_path.absolute(), new_path.absolute()
+                CONSOLE.change(BADGE_MOVE, new_path, moved_from=old_path)
+                for job in jobs:
+                    queue = queues[job.queue_key]
+                    # A move is as cheap as a deletion.
+                    priority = Priority.HIGH if job.priority is None else job.priority
+                    if queue.has_pending(job.mapping, old_path):
+                        # The destination is behind on the old path, so sync both paths as they are.
+                        await queue.put(SyncEvent(job=job, change=Change.deleted, path=old_path, priority=priority))
+                        await queue.put(SyncEvent(job=job, change=Change.added, path=new_path))
+                    else:
+                        await queue.put(
+                            SyncEvent(
+                                job=job, change=Change.added, path=new_path, moved_from=old_path, priority=priority
+                            )
+                        )
+        absolute_changes = [(change, Path(path).absolute()) for change, path in changes]
+        classes = await asyncio.to_thread(priorities.classify, absolute_changes) if priorities is not None else {}
+        for change, path in absolute_changes:
+            CONSOLE.change(CHANGE_TYPE_TO_BADGE[change], path)
             for job in jobs:
-                await queues[job.queue_key].put(SyncEvent(job=job, change=change, path=path))
+                priority = classes.get(path, Priority.NORMAL) if job.priority is None else job.priority
+                await queues[job.queue_key].put(SyncEvent(job=job, change=change, path=path, priority=priority))
+
+
+async def initial_sync(
+    jobs: list[SyncJob],
+    queues: dict[str, CoalescingQueue],
+    path_filter: BaseFilter,
+    *,
+    delete: bool,
+) -> None:
+    async def run(job: SyncJob) -> None:
+        stats = await reconcile_job(
+            job,
+            queues[job.queue_key],
+            path_filter=path_filter,
+            delete=delete and not job.bidirectional,
+            newer_only=job.bidirectional,
+        )
+        print(
+            f"Initial sync {job.mapping.display()}: {stats.written} to copy, "
+            f"{stats.deleted} to delete, {stats.unchanged} up to date"
+        )
+
+    results = await asyncio.gather(*(run(job) for job in jobs), return_exceptions=True)
+    for job, result in zip(jobs, results, strict=True):
+        if isinstance(result, Exception):
+            print(f"Failed initial sync of {job.mapping.display()}: {result}", file=sys.stderr)
+
+
+def register_metrics(jobs: list[SyncJob], queues: dict[str, CoalescingQueue]) -> None:
+    for key, queue in queues.items():
+        REGISTRY.gauge("watchfs_queue_depth", queue.qsize, queue=key)
+        REGISTRY.gauge("watchfs_events_coalesced_total", lambda queue=queue: queue.coalesced, queue=key)
+    for job in jobs:
+        stats, target = job.target.stats, job.target.description
+        REGISTRY.gauge("watchfs_payload_bytes_total", lambda stats=stats: stats.payload_bytes, target=target)
+        REGISTRY.gauge("watchfs_sent_bytes_total", lambda stats=stats: stats.sent_bytes, target=target)
 
 
 def build_queue_key(mapping: SyncMapping) -> str:
@@ -122,10 +389,183 @@ async def main():
         help="Sync mapping file. Use SRC->DST for SSH destinations such as user@host:/path.",
     )
     parser.add_argument("--exclude", type=str, help="Exclude directories or files, separated by comma.")
+    parser.add_argument(
+        "--gitignore",
+        action="store_true",
+        help="Skip files ignored by .gitignore or .watchfsignore files in the sources.",
+    )
     parser.add_argument("-cc", "--enable-content-caching", action="store_true", help="Enable content caching.")
+    parser.add_argument(
+        "--content-cache-size",
+        type=int,
+        default=ChangeCacheFilter.CACHE_MAX_ENTRIES,
+        metavar="ENTRIES",
+        help=f"Maximum number of files remembered by content caching (default: {ChangeCacheFilter.CACHE_MAX_ENTRIES}).",
+    )
     parser.add_argument("--force-polling", action="store_true", help="Enable force polling.")
+    parser.add_argument(
+        "--batch-window",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="Wait this long for more changes before syncing, so bursts go out as one batch (default: 0).",
+    )
+    parser.add_argument(
+        "--initial-sync",
+        action="store_true",
+        help="Copy files that differ in size or mtime from each source to its destination on startup.",
+    )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="With --initial-sync, also delete destination files that are missing from the source.",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="Only sync a path once it has not changed for this long (default: 0).",
+    )
+    parser.add_argument(
+        "--delta-min-size",
+        type=int,
+        default=DELTA_MIN_SIZE,
+        metavar="BYTES",
+        help=(
+            "Update files of at least this size on SSH targets by sending only the changed blocks, "
+            f"needs python3 on the remote host, 0 disables it (default: {DELTA_MIN_SIZE})."
+        ),
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Gzip uploads to SSH targets, adapting the level to the link and skipping compressed files.",
+    )
+    parser.add_argument(
+        "--bwlimit",
+        type=parse_bandwidth_limit,
+        action="append",
+        default=[],
+        metavar="[TARGET=]RATE",
+        help=(
+            "Limit uploads to each SSH destination to RATE bytes per second, e.g. 512K or 10M. "
+            "With TARGET (a host or a destination as printed) only that destination, can be repeated."
+        ),
+    )
+    parser.add_argument(
+        "--total-bwlimit",
+        type=parse_rate,
+        metavar="RATE",
+        help="Limit the uploads to all SSH destinations together to RATE bytes per second.",
+    )
+    parser.add_argument(
+        "--agent",
+        action="store_true",
+        help=(
+            "Start a small python3 agent on each SSH destination that applies the changes over one "
+            "connection with pipelined requests, shell commands are used where there is no python3."
+        ),
+    )
+    parser.add_argument(
+        "--no-move-detection",
+        action="store_true",
+        help="Sync renames as a deletion plus an upload instead of moving the path on the destination.",
+    )
+    parser.add_argument(
+        "--state-dir",
+        type=Path,
+        metavar="DIR",
+        help=(
+            "Remember what was synced to each destination in DIR, so --initial-sync after a restart "
+            "only compares the sources to that record and copies what changed meanwhile."
+        ),
+    )
+    parser.add_argument(
+        "--queue-limit",
+        type=int,
+        default=DEFAULT_QUEUE_LIMIT,
+        metavar="N",
+        help=(
+            "Pending changes kept per target before those below a common directory are merged into a "
+            f"rescan of it, 0 for no limit (default: {DEFAULT_QUEUE_LIMIT})."
+        ),
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        metavar="PORT",
+        help="Serve Prometheus metrics on this port, at /metrics.",
+    )
+    parser.add_argument(
+        "--metrics-host",
+        default="127.0.0.1",
+        metavar="HOST",
+        help="Address the metrics endpoint listens on (default: 127.0.0.1).",
+    )
+    parser.add_argument(
+        "--stats-file",
+        type=Path,
+        metavar="PATH",
+        help="Rewrite PATH with the metrics in the Prometheus text format every 10 seconds.",
+    )
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Print a summary of the synced changes per destination instead of a line per change.",
+    )
+    parser.add_argument(
+        "--summary-interval",
+        type=float,
+        default=SUMMARY_INTERVAL,
+        metavar="SECONDS",
+        help=f"How often --quiet prints its summary (default: {SUMMARY_INTERVAL:g}).",
+    )
+    parser.add_argument(
+        "--log-json",
+        type=Path,
+        metavar="PATH",
+        help="Append every change, sync and failure to PATH as JSON lines.",
+    )
+    parser.add_argument(
+        "--priority",
+        type=parse_priority_rule,
+        action="append",
+        default=[],
+        metavar="PATTERN=CLASS",
+        help=(
+            "Sync paths matching PATTERN (like --exclude) with priority CLASS: high, normal or low, can be repeated. "
+            "Other changes are high for deletions, recent edits and small files, low for large files."
+        ),
+    )
+    parser.add_argument(
+        "--target-priority",
+        type=parse_priority_rule,
+        action="append",
+        default=[],
+        metavar="TARGET=CLASS",
+        help="Sync all changes to TARGET (a host or a destination as printed) with priority CLASS, can be repeated.",
+    )
+    parser.add_argument(
+        "--priority-aging",
+        type=float,
+        default=PRIORITY_AGING,
+        metavar="SECONDS",
+        help=(
+            "A waiting change counts as one class more urgent for every SECONDS it waited, "
+            f"so low priority changes keep moving, 0 to disable (default: {PRIORITY_AGING:g})."
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Concurrent workers per target, changes to overlapping paths still apply in order (default: 1).",
+    )
     args = parser.parse_args()
     parsed_sync_mapping: list[SyncMapping] = []
+    bidirectional_mappings: set[SyncMapping] = set()
     for sync_src_with_dst in args.sync_mapping:
         match parse_sync_mapping(sync_src_with_dst):
             case Ok((mapping, bidirectional)):
@@ -134,60 +574,139 @@ async def main():
                     match parse_sync_mapping(f"{mapping.target.display()}->{mapping.source}"):
                         case Ok((reverse_mapping, _)):
                             parsed_sync_mapping.append(reverse_mapping)
+                            bidirectional_mappings.update((mapping, reverse_mapping))
                         case Err(err):
                             raise err
             case Err(err):
                 raise err
 
+    path_filters: list[BaseFilter] = []
+    if args.exclude:
+        path_filters.append(ExcludeFilter(args.exclude))
+    if args.gitignore:
+        path_filters.append(IgnoreFileFilter([mapping.source for mapping in parsed_sync_mapping]))
+    path_filter = combine_filters(path_filters)
+
+    # One bucket shared by all destinations, each destination with a limit gets a bucket of its own.
+    total_bucket = TokenBucket(args.total_bwlimit) if args.total_bwlimit is not None else None
+    source_counts = Counter(mapping.source.resolve() for mapping in parsed_sync_mapping)
+    shared_reads = {source: SharedReads(count) for source, count in source_counts.items() if count > 1}
     jobs = [
         SyncJob(
             mapping=mapping,
-            target=create_target(mapping.target),
+            target=create_target(
+                mapping.target,
+                delta_min_size=args.delta_min_size or None,
+                compress=args.compress,
+                buckets=buckets_for(mapping.target, args.bwlimit, total_bucket),
+                agent=args.agent,
+            ),
             queue_key=build_queue_key(mapping),
+            reads=shared_reads.get(mapping.source.resolve()),
+            path_filter=path_filter if path_filters else None,
+            # Both directions of a bidirectional mapping write to each other, which a record of one side misses.
+            state=(
+                SyncStateIndex.for_mapping(args.state_dir, mapping)
+                if args.state_dir is not None and mapping not in bidirectional_mappings
+                else None
+            ),
+            priority=priority_for(mapping.target, args.target_priority),
+            bidirectional=mapping in bidirectional_mappings,
         )
         for mapping in parsed_sync_mapping
     ]
+    state_indexes = [job.state for job in jobs if job.state is not None]
+    # Each side of a bidirectional mapping drops the changes the other side's writes cause.
+    echoes: dict[Path, EchoSuppressor] = {}
+    for job in jobs:
+        if job.mapping in bidirectional_mappings and isinstance(job.target, LocalTarget):
+            root = job.target.spec.path.resolve()
+            job.target.echoes = echoes.setdefault(root, EchoSuppressor(root))
 
-    filters: list[BaseFilter] = []
-    if args.exclude:
-        filters.append(ExcludeFilter(args.exclude))
-    if args.enable_content_caching:
-        filters.append(ChangeCacheFilter())
-
-    combined_filter = combine_filters(filters)
+    content_filter = ChangeCacheFilter(max_entries=args.content_cache_size) if args.enable_content_caching else None
+    CONSOLE.quiet, CONSOLE.summary_interval = args.quiet, args.summary_interval
+    if args.log_json is not None:
+        CONSOLE.open_log(args.log_json)
     print(f"Starting watch {', '.join(mapping.display() for mapping in parsed_sync_mapping)}")
     print("Press Ctrl+C to exit.")
-    queues: dict[str, asyncio.Queue[SyncEvent]] = {job.queue_key: asyncio.Queue() for job in jobs}
+    queues = {
+        job.queue_key: CoalescingQueue(
+            debounce=args.debounce, limit=args.queue_limit or None, aging=args.priority_aging or None
+        )
+        for job in jobs
+    }
+    priorities = PriorityPolicy(args.priority)
+    healths = {key: TargetHealth() for key in queues}
+    register_metrics(jobs, queues)
     source_jobs: dict[Path, list[SyncJob]] = {}
     for job in jobs:
         source_jobs.setdefault(job.mapping.source.resolve(), []).append(job)
     worker_tasks: list[asyncio.Task[None]] = []
     watcher_tasks: list[asyncio.Task[None]] = []
+    metrics_server: asyncio.Server | None = None
     try:
-        await asyncio.gather(*(job.target.start() for job in jobs))
-        worker_tasks = [asyncio.create_task(consume_target_queue(queue)) for queue in queues.values()]
+        results = await asyncio.gather(*(job.target.start() for job in jobs), return_exceptions=True)
+        for job, result in zip(jobs, results, strict=True):
+            if isinstance(result, TargetUnavailableError):
+                # Not fatal, its changes are buffered and the worker keeps trying to connect.
+                print(f"{result}, buffering its changes until it is reachable", file=sys.stderr)
+                healths[job.queue_key].failed([job.target])
+            elif isinstance(result, BaseException):
+                raise result
+        worker_tasks = [
+            asyncio.create_task(consume_target_queue(queue, healths[key], batch_window=args.batch_window))
+            for key, queue in queues.items()
+            for _ in range(args.workers)
+        ]
+        worker_tasks.append(asyncio.create_task(CONSOLE.run()))
+        move_detectors = {source: None if args.no_move_detection else MoveDetector() for source in source_jobs}
+        for source, move_detector in move_detectors.items():
+            if move_detector is not None:
+                # Renames of paths that exist already are only recognized once they are indexed.
+                worker_tasks.append(asyncio.create_task(asyncio.to_thread(move_detector.index, source, path_filter)))
         watcher_tasks = [
             asyncio.create_task(
                 watch_source(
                     source,
                     grouped_jobs,
                     queues,
-                    combined_filter,
+                    path_filter,
+                    content_filter=content_filter,
+                    move_detector=move_detectors[source],
+                    echoes=echoes.get(source),
+                    priorities=priorities,
                     force_polling=args.force_polling,
                 )
             )
             for source, grouped_jobs in source_jobs.items()
         ]
+        if state_indexes:
+            worker_tasks.append(asyncio.create_task(flush_state_periodically(state_indexes)))
+        if args.stats_file is not None:
+            worker_tasks.append(asyncio.create_task(write_stats_periodically(REGISTRY, args.stats_file)))
+        if args.metrics_port is not None:
+            metrics_server = await serve_metrics(REGISTRY, args.metrics_host, args.metrics_port)
+            print(f"Serving metrics on http://{args.metrics_host}:{args.metrics_port}/metrics")
+        if args.initial_sync:
+            await initial_sync(jobs, queues, path_filter, delete=args.delete)
         await asyncio.gather(*worker_tasks, *watcher_tasks)
     except asyncio.exceptions.CancelledError:
-        print("Bye!")
+        CONSOLE.message("Bye!")
     finally:
+        if metrics_server is not None:
+            metrics_server.close()
         for task in watcher_tasks:
             task.cancel()
         for task in worker_tasks:
             task.cancel()
         await asyncio.gather(*watcher_tasks, *worker_tasks, return_exceptions=True)
         await asyncio.gather(*(job.target.close() for job in jobs))
+        for index in state_indexes:
+            index.close()
+        CONSOLE.close()
+        for job in jobs:
+            if job.target.stats.payload_bytes:
+                print(f"{job.target.description}: {job.target.stats.describe()}")
 
 
 if __name__ == "__main__":
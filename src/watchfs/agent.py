@@ -0,0 +1,540 @@
+from __future__ import annotations
+
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
+import os
+import queue
+import shlex
+import struct
+import subprocess
+import tempfile
+import threading
+import zlib
+from dataclasses import dataclass
+from enum import IntEnum
+from pathlib import PurePath, PurePosixPath
+from typing import IO, TYPE_CHECKING
+
+from watchfs.compression import MAGIC_SIZE, is_incompressible
+from watchfs.delta import NO_PYTHON_EXIT_CODE, SSH_ERROR_EXIT_CODE
+from watchfs.exceptions import TargetUnavailableError
+from watchfs.fanout import open_changed_file
+from watchfs.scan import FileState
+from watchfs.shaping import shaped
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Iterator, Sequence
+    from pathlib import Path
+
+    from watchfs.appends import Append
+    from watchfs.compression import AdaptiveLevel
+    from watchfs.fanout import SharedReader
+    from watchfs.shaping import ShapedWriter, TokenBucket
+
+AGENT_MAGIC = b"WFA1"
+# Payload length, request ID and op of a request, or status of a reply.
+HEADER = struct.Struct(">IIB")
+# Files are sent in pieces of this size, so a large one does not hold up the requests behind it.
+AGENT_CHUNK_SIZE = 1024 * 1024
+# Files at least this large are looked up remotely first and skipped if they are already there.
+SKIP_CHECK_MIN_SIZE = 1024 * 1024
+
+WRITE_FIRST = 1
+WRITE_LAST = 2
+WRITE_COMPRESSED = 4
+
+
+class Op(IntEnum):
+    WRITE = 1
+    APPEND = 2
+    DELETE = 3
+    MKDIR = 4
+    STAT = 5
+    HASH = 6
+    LIST = 7
+    MOVE = 8
+    TOUCH = 9
+
+
+class Status(IntEnum):
+    OK = 0
+    ERROR = 1
+    MISSING = 2
+    MISMATCH = 3
+    # One piece of a longer reply, e.g. a batch of listed files, more follow.
+    MORE = 4
+
+
+# Runs on the destination, started by ``agent_command`` which sends it over stdin. Paths are
+# relative to the root given as its argument. Answers every request in order, with the ID it
+# came with. Only needs the standard library of any python3.
+AGENT_SOURCE = r"""
+import hashlib, os, shutil, stat, struct, sys, tempfile, zlib
+ROOT = os.path.expanduser(sys.argv[1])
+HEADER = struct.Struct(">IIB")
+OK, ERROR, MISSING, MISMATCH, MORE = 0, 1, 2, 3, 4
+stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+writes = {}
+def reply(request, status, payload=b""):
+    stdout.write(HEADER.pack(len(payload), request, status) + payload)
+def take_path(payload, offset=0):
+    (n,) = struct.unpack_from(">H", payload, offset)
+    name = payload[offset + 2 : offset + 2 + n].decode("utf-8", "surrogateescape")
+    return (os.path.join(ROOT, name) if name else ROOT), offset + 2 + n
+def make_parent(path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+def op_write(request, payload):
+    path, offset = take_path(payload)
+    flags, mode, mtime_ns = struct.unpack_from(">BIq", payload, offset)
+    data = payload[offset + 13 :]
+    if flags & 4:
+        data = zlib.decompress(data)
+    if flags & 1:
+        if path in writes:
+            writes.pop(path)[1].close()
+        make_parent(path)
+        fd, temp = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".", suffix=".watchfs", dir=os.path.dirname(path))
+        writes[path] = (temp, os.fdopen(fd, "wb"))
+    temp, stream = writes[path]
+    try:
+        stream.write(data)
+        if flags & 2:
+            del writes[path]
+            stream.close()
+            os.chmod(temp, mode)
+            os.utime(temp, ns=(mtime_ns, mtime_ns))
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            os.replace(temp, path)
+    except BaseException:
+        writes.pop(path, None)
+        stream.close()
+        os.unlink(temp)
+        raise
+    return OK, b""
+def op_append(request, payload):
+    path, offset = take_path(payload)
+    size, mtime_ns = struct.unpack_from(">qq", payload, offset)
+    try:
+        if os.path.getsize(path) != size:
+            return MISMATCH, b""
+    except OSError:
+        return MISMATCH, b""
+    with open(path, "ab") as stream:
+        stream.write(payload[offset + 16 :])
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    return OK, b""
+def op_delete(request, payload):
+    remove(take_path(payload)[0])
+    return OK, b""
+def op_mkdir(request, payload):
+    os.makedirs(take_path(payload)[0], exist_ok=True)
+    return OK, b""
+def op_stat(request, payload):
+    try:
+        result = os.lstat(take_path(payload)[0])
+    except FileNotFoundError:
+        return MISSING, b""
+    is_dir = stat.S_ISDIR(result.st_mode)
+    return OK, struct.pack(">BqqI", is_dir, result.st_size, result.st_mtime_ns, result.st_mode & 0o7777)
+def op_hash(request, payload):
+    digest = hashlib.sha256()
+    try:
+        with open(take_path(payload)[0], "rb") as stream:
+            for block in iter(lambda: stream.read(1 << 20), b""):
+                digest.update(block)
+    except (FileNotFoundError, IsADirectoryError):
+        return MISSING, b""
+    return OK, digest.digest()
+def entries(path):
+    try:
+        with os.scandir(path) as found:
+            found = list(found)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+    def key(entry):
+        try:
+            return entry.name + "/" if entry.is_dir(follow_symlinks=False) else entry.name
+        except OSError:
+            return entry.name
+    return sorted(found, key=key)
+def op_list(request, payload):
+    path, offset = take_path(payload)
+    (n,) = struct.unpack_from(">H", payload, offset)
+    prefix = payload[offset + 2 : offset + 2 + n].decode("utf-8", "surrogateescape")
+    stack, prefixes, batch = [iter(entries(path))], [prefix], []
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            prefixes.pop()
+            continue
+        name = prefixes[-1] + entry.name
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(iter(entries(entry.path)))
+                prefixes.append(name + "/")
+                continue
+            if not entry.is_file():
+                continue
+            result = entry.stat()
+        except FileNotFoundError:
+            continue
+        encoded = name.encode("utf-8", "surrogateescape")
+        batch.append(struct.pack(">H", len(encoded)) + encoded + struct.pack(">qd", result.st_size, result.st_mtime))
+        if len(batch) >= 1000:
+            reply(request, MORE, b"".join(batch))
+            batch = []
+    return OK, b"".join(batch)
+def op_move(request, payload):
+    old, offset = take_path(payload)
+    new = take_path(payload, offset)[0]
+    if not os.path.lexists(old):
+        return MISSING, b""
+    remove(new)
+    make_parent(new)
+    os.rename(old, new)
+    return OK, b""
+def op_touch(request, payload):
+    path, offset = take_path(payload)
+    mode, mtime_ns = struct.unpack_from(">Iq", payload, offset)
+    os.chmod(path, mode)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    return OK, b""
+HANDLERS = {1: op_write, 2: op_append, 3: op_delete, 4: op_mkdir, 5: op_stat, 6: op_hash, 7: op_list, 8: op_move, 9: op_touch}
+reply(0, OK, b"WFA1")
+stdout.flush()
+try:
+    while True:
+        header = stdin.read(HEADER.size)
+        if len(header) != HEADER.size:
+            break
+        length, request, op = HEADER.unpack(header)
+        payload = stdin.read(length)
+        if len(payload) != length:
+            break
+        try:
+            status, body = HANDLERS[op](request, payload)
+        except Exception as error:
+            status, body = ERROR, ("%s: %s" % (type(error).__name__, error)).encode("utf-8", "replace")
+        reply(request, status, body)
+        stdout.flush()
+finally:
+    for temp, stream in writes.values():
+        stream.close()
+        os.unlink(temp)
+"""
+
+_AGENT_SOURCE_BYTES = AGENT_SOURCE.encode()
+_BOOTSTRAP = f"import sys; exec(sys.stdin.buffer.read({len(_AGENT_SOURCE_BYTES)}))"
+
+
+def agent_command(root: str) -> str:
+    """The remote command that starts the agent on ``root``, which has to be quoted for the shell already."""
+    return (
+        f"command -v python3 >/dev/null 2>&1 || exit {NO_PYTHON_EXIT_CODE}; "
+        f"exec python3 -c {shlex.quote(_BOOTSTRAP)} {root}"
+    )
+
+
+@dataclass(frozen=True, slots=True)
+class RemoteStat:
+    is_dir: bool
+    size: int
+    mtime_ns: int
+    mode: int
+
+
+class AgentClient:
+    """Runs ``command``, which has to start the agent (see ``agent_command``), and talks to it.
+
+    Requests are written whole by any thread and pipelined, a reader thread hands each reply to
+    whoever waits for its request ID. Everything sent is paced by ``buckets``. The methods block,
+    run them in a thread.
+
+    Writing a request may block for as long as the agent is busy writing replies, so the reader
+    must never wait for a writer: it only shares the short-lived ``_lock`` on the waiters, the
+    writers serialize on ``_write_lock`` instead.
+    """
+
+    def __init__(self, command: list[str], description: str, buckets: Sequence[TokenBucket] = ()) -> None:
+        self.command = command
+        self.description = description
+        self.buckets = buckets
+        self._process: subprocess.Popen[bytes] | None = None
+        self._writer: IO[bytes] | ShapedWriter | None = None
+        self._stderr: IO[bytes] | None = None
+        self._reader: threading.Thread | None = None
+        self._ids = itertools.count(1)
+        # Request ID to the future of its reply, or to the queue of every piece of a longer reply.
+        self._futures: dict[int, concurrent.futures.Future[tuple[Status, bytes]]] = {}
+        self._streams: dict[int, queue.SimpleQueue[tuple[Status, bytes]]] = {}
+        # Set once the reader has failed all waiters, nothing sent after that gets a reply.
+        self._finished = False
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def start(self) -> bool:
+        """Start the agent and wait for it to greet, ``False`` if the destination has no python3."""
+        self._stderr = tempfile.TemporaryFile()
+        process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self._stderr)
+        assert process.stdin is not None and process.stdout is not None
+        self._process = process
+        with contextlib.suppress(BrokenPipeError):
+            process.stdin.write(_AGENT_SOURCE_BYTES)
+            process.stdin.flush()
+        header = process.stdout.read(HEADER.size)
+        if len(header) == HEADER.size:
+            length, _, status = HEADER.unpack(header)
+            if status == Status.OK and process.stdout.read(length) == AGENT_MAGIC:
+                self._writer = shaped(process.stdin, self.buckets)
+                self._reader = threading.Thread(target=self._read_replies, name="watchfs-agent", daemon=True)
+                self._reader.start()
+                return True
+        self.close()
+        if process.returncode == NO_PYTHON_EXIT_CODE:
+            return False
+        raise self._failure()
+
+    def close(self) -> None:
+        process = self._process
+        if process is None:
+            return
+        assert process.stdin is not None
+        with contextlib.suppress(BrokenPipeError), self._write_lock:
+            process.stdin.close()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        if self._reader is not None:
+            self._reader.join()
+        if self._stderr is not None:
+            self._stderr.close()
+
+    def submit(self, op: Op, payload: bytes | bytearray = b"") -> concurrent.futures.Future[tuple[Status, bytes]]:
+        """Send a request without waiting for it, see ``flush``."""
+        future: concurrent.futures.Future[tuple[Status, bytes]] = concurrent.futures.Future()
+        with self._lock:
+            request = self._next_request()
+            self._futures[request] = future
+        self._send(request, op, payload)
+        return future
+
+    def flush(self) -> None:
+        assert self._writer is not None
+        try:
+            with self._write_lock:
+                self._writer.flush()
+        except (BrokenPipeError, ValueError):
+            raise self._failure() from None
+
+    def call(self, op: Op, payload: bytes | bytearray = b"") -> tuple[Status, bytes]:
+        future = self.submit(op, payload)
+        self.flush()
+        return self._check(future.result())
+
+    def write_files(
+        self,
+        files: Iterable[tuple[PurePath, Path]],
+        opener: Callable[[Path], IO[bytes] | SharedReader],
+        compression: AdaptiveLevel | None = None,
+    ) -> tuple[int, int]:
+        """Upload all files, pipelined, return how many bytes they hold and how many were sent.
+
+        Files of at least ``SKIP_CHECK_MIN_SIZE`` bytes are compared with the remote copy by
+        size, modification time and finally content hash first, and skipped if it matches.
+        Pieces of files worth it are compressed at the level of ``compression``.
+        """
+        futures: list[concurrent.futures.Future[tuple[Status, bytes]]] = []
+        total = sent = 0
+        for relative_path, source in files:
+            if (opened := open_changed_file(source, opener)) is None:
+                continue
+            stream, result = opened
+            with stream:
+                name = _encode_path(relative_path)
+                mode, mtime_ns = result.st_mode & 0o7777, result.st_mtime_ns
+                total += result.st_size
+                if result.st_size >= SKIP_CHECK_MIN_SIZE and self._matches_remote(relative_path, source, result):
+                    futures.append(self.submit(Op.TOUCH, name + struct.pack(">Iq", mode, mtime_ns)))
+                    continue
+                data = bytes(stream.read(AGENT_CHUNK_SIZE))
+                level = None
+                if compression is not None and not is_incompressible(relative_path, data[:MAGIC_SIZE]):
+                    level = compression.level
+                flags = WRITE_FIRST
+                while True:
+                    following = bytes(stream.read(AGENT_CHUNK_SIZE)) if len(data) == AGENT_CHUNK_SIZE else b""
+                    if not following:
+                        flags |= WRITE_LAST
+                    if level is not None:
+                        data = zlib.compress(data, level)
+                        flags |= WRITE_COMPRESSED
+                    futures.append(self.submit(Op.WRITE, name + struct.pack(">BIq", flags, mode, mtime_ns) + data))
+                    sent += len(data)
+                    if not following:
+                        break
+                    data, flags = following, 0
+        self.flush()
+        for future in futures:
+            self._check(future.result())
+        return total, sent
+
+    def append(self, append: Append) -> bool:
+        """Append the new bytes, ``False`` if the remote file does not have the old size anymore.
+
+        Sent in pieces that each expect the size the one before leaves, once one does not match
+        none of the following does either.
+        """
+        name = _encode_path(append.relative_path)
+        futures = []
+        with append.source.open("rb") as stream:
+            stream.seek(append.offset)
+            for offset in range(append.offset, append.size, AGENT_CHUNK_SIZE):
+                data = stream.read(min(AGENT_CHUNK_SIZE, append.size - offset))
+                futures.append(self.submit(Op.APPEND, name + struct.pack(">qq", offset, append.mtime_ns) + data))
+        self.flush()
+        return all(self._check(future.result())[0] != Status.MISMATCH for future in futures)
+
+    def remove(self, relative_paths: Iterable[PurePath]) -> None:
+        futures = [self.submit(Op.DELETE, _encode_path(path)) for path in relative_paths]
+        self.flush()
+        for future in futures:
+            self._check(future.result())
+
+    def mkdir(self, relative_path: PurePath | None = None) -> None:
+        self.call(Op.MKDIR, _encode_path(relative_path))
+
+    def move(self, old_path: PurePath, new_path: PurePath) -> bool:
+        status, _ = self.call(Op.MOVE, _encode_path(old_path) + _encode_path(new_path))
+        return status != Status.MISSING
+
+    def stat(self, relative_path: PurePath) -> RemoteStat | None:
+        status, payload = self.call(Op.STAT, _encode_path(relative_path))
+        if status == Status.MISSING:
+            return None
+        is_dir, size, mtime_ns, mode = struct.unpack(">BqqI", payload)
+        return RemoteStat(bool(is_dir), size, mtime_ns, mode)
+
+    def hash(self, relative_path: PurePath) -> bytes | None:
+        """The SHA-256 digest of the remote file, ``None`` if there is none."""
+        status, payload = self.call(Op.HASH, _encode_path(relative_path))
+        return None if status == Status.MISSING else payload
+
+    def iter_files(self, relative_path: PurePath | None = None) -> Iterator[FileState]:
+        """Stream the regular files below the root, or below ``relative_path``, sorted like ``walk_files``."""
+        prefix = f"{PurePosixPath(*relative_path.parts)}/" if relative_path is not None else ""
+        replies: queue.SimpleQueue[tuple[Status, bytes]] = queue.SimpleQueue()
+        with self._lock:
+            request = self._next_request()
+            self._streams[request] = replies
+        self._send(request, Op.LIST, _encode_path(relative_path) + _encode_name(prefix))
+        self.flush()
+        while True:
+            status, payload = replies.get()
+            offset = 0
+            while offset < len(payload) and status in (Status.OK, Status.MORE):
+                (length,) = struct.unpack_from(">H", payload, offset)
+                path = payload[offset + 2 : offset + 2 + length].decode("utf-8", "surrogateescape")
+                size, mtime = struct.unpack_from(">qd", payload, offset + 2 + length)
+                offset += 2 + length + 16
+                yield FileState(path, size, mtime)
+            if status != Status.MORE:
+                self._check((status, payload))
+                return
+
+    def _matches_remote(self, relative_path: PurePath, source: Path, result: os.stat_result) -> bool:
+        remote = self.stat(relative_path)
+        if remote is None or remote.is_dir or remote.size != result.st_size:
+            return False
+        if remote.mtime_ns == result.st_mtime_ns:
+            return True
+        with source.open("rb") as stream:
+            local = hashlib.file_digest(stream, "sha256").digest()
+        return self.hash(relative_path) == local
+
+    def _next_request(self) -> int:
+        """The ID of a new request, whose waiter the caller registers before sending it. Hold ``_lock``."""
+        if self._finished:
+            raise self._failure()
+        return next(self._ids)
+
+    def _send(self, request: int, op: Op, payload: bytes | bytearray) -> None:
+        assert self._writer is not None
+        try:
+            with self._write_lock:
+                self._writer.write(HEADER.pack(len(payload), request, op))
+                self._writer.write(payload)
+        except (BrokenPipeError, ValueError):
+            with self._lock:
+                self._futures.pop(request, None)
+                self._streams.pop(request, None)
+            raise self._failure() from None
+
+    def _read_replies(self) -> None:
+        assert self._process is not None and self._process.stdout is not None
+        stdout = self._process.stdout
+        while len(header := stdout.read(HEADER.size)) == HEADER.size:
+            length, request, status = HEADER.unpack(header)
+            payload = stdout.read(length)
+            with self._lock:
+                stream = self._streams.get(request)
+                if stream is None:
+                    future = self._futures.pop(request)
+                elif status != Status.MORE:
+                    del self._streams[request]
+            if stream is not None:
+                stream.put((Status(status), payload))
+            else:
+                future.set_result((Status(status), payload))
+        self._process.wait()
+        with self._lock:
+            self._finished = True
+            futures, self._futures = self._futures, {}
+            streams, self._streams = self._streams, {}
+        for stream in streams.values():
+            stream.put((Status.ERROR, b""))
+        for future in futures.values():
+            future.set_exception(self._failure())
+
+    def _check(self, reply: tuple[Status, bytes]) -> tuple[Status, bytes]:
+        status, payload = reply
+        if status == Status.ERROR:
+            if not payload:
+                raise self._failure()
+            raise RuntimeError(f"Agent failed for {self.description}: {payload.decode(errors='replace')}")
+        return reply
+
+    def _failure(self) -> TargetUnavailableError:
+        """The error to raise once the agent is gone, from its exit status and stderr.
+
+        Either way the target is unusable until it reconnects, which starts a new agent.
+        """
+        assert self._process is not None
+        returncode = self._process.poll()
+        stderr_text = ""
+        if self._stderr is not None and not self._stderr.closed:
+            self._stderr.seek(0)
+            stderr_text = self._stderr.read().decode(errors="replace").strip()
+        stderr_text = stderr_text or "agent exited"
+        if returncode == SSH_ERROR_EXIT_CODE:
+            return TargetUnavailableError(f"SSH connection failed for {self.description}: {stderr_text}")
+        return TargetUnavailableError(f"Agent exited for {self.description}: {stderr_text}")
+
+
+def _encode_path(relative_path: PurePath | None) -> bytes:
+    return _encode_name(PurePosixPath(*relative_path.parts).as_posix() if relative_path is not None else "")
+
+
+def _encode_name(name: str) -> bytes:
+    encoded = os.fsencode(name)
+    return struct.pack(">H", len(encoded)) + encoded
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import IO, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pathlib import Path, PurePath
+
+# The synced part of a file is compared by this many blocks spread over it, the first and last included.
+SAMPLE_COUNT = 16
+SAMPLE_SIZE = 4 * 1024
+# Smaller files are not tracked, copying them is about as cheap as checking them for an append.
+APPEND_MIN_SIZE = SAMPLE_COUNT * SAMPLE_SIZE
+MAX_TRACKED_FILES = 100_000
+APPEND_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass(frozen=True, slots=True)
+class SyncedFile:
+    inode: int
+    size: int
+    # See ``fingerprint``.
+    fingerprint: int
+
+
+@dataclass(frozen=True, slots=True)
+class Append:
+    """The bytes ``offset:size`` of ``source`` that were appended since it was last synced."""
+
+    relative_path: PurePath
+    source: Path
+    offset: int
+    size: int
+    mtime_ns: int
+    # What the tracker remembers once the append was applied, see ``AppendTracker.record_append``.
+    synced: SyncedFile
+
+
+class AppendTracker:
+    """Remembers the size and a fingerprint of the files last synced to a target.
+
+    A modification is taken to be a pure append when the file kept its inode, grew, and the
+    fingerprint of the bytes up to the old size is unchanged. The fingerprint only covers
+    samples of the synced part, so checking a file reads the same few blocks however large
+    it is, and an edit that touches none of them, e.g. by a database, is mistaken for an
+    append. Files below ``APPEND_MIN_SIZE`` are not tracked. Callers still check that the
+    destination has exactly the old size before appending to it.
+    """
+
+    def __init__(self, *, max_entries: int = MAX_TRACKED_FILES) -> None:
+        self.max_entries = max_entries
+        self._files: OrderedDict[PurePath, SyncedFile] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def find_append(self, relative_path: PurePath, source: Path) -> Append | None:
+        with self._lock:
+            previous = self._files.get(relative_path)
+        if previous is None:
+            return None
+        try:
+            with source.open("rb") as stream:
+                stat = os.fstat(stream.fileno())
+                if stat.st_ino != previous.inode or stat.st_size <= previous.size:
+                    return None
+                if fingerprint(stream, previous.size) != previous.fingerprint:
+                    return None
+                # Taken now, so recording the append does not open the file again.
+                total = fingerprint(stream, stat.st_size)
+        except OSError:
+            return None
+        if total is None:
+            return None
+        synced = SyncedFile(stat.st_ino, stat.st_size, total)
+        return Append(relative_path, source, previous.size, stat.st_size, stat.st_mtime_ns, synced)
+
+    def record(self, relative_path: PurePath, source: Path, size: int | None = None) -> None:
+        """Remember ``source`` as synced up to ``size`` bytes, by default its current size."""
+        if size is not None and size < APPEND_MIN_SIZE:
+            self.forget(relative_path)
+            return
+        try:
+            with source.open("rb") as stream:
+                stat = os.fstat(stream.fileno())
+                synced_size = stat.st_size if size is None else size
+                value = fingerprint(stream, synced_size) if synced_size >= APPEND_MIN_SIZE else None
+        except OSError:
+            value = None
+        if value is None:
+            self.forget(relative_path)
+            return
+        self._remember(relative_path, SyncedFile(stat.st_ino, synced_size, value))
+
+    def record_append(self, append: Append) -> None:
+        """Remember the source of ``append`` as synced up to its new size."""
+        self._remember(append.relative_path, append.synced)
+
+    def _remember(self, relative_path: PurePath, synced: SyncedFile) -> None:
+        with self._lock:
+            self._files[relative_path] = synced
+            self._files.move_to_end(relative_path)
+            while len(self._files) > self.max_entries:
+                self._files.popitem(last=False)
+
+    def forget(self, relative_path: PurePath) -> None:
+        with self._lock:
+            self._files.pop(relative_path, None)
+
+
+def fingerprint(stream: IO[bytes], size: int) -> int | None:
+    """CRC-32 of ``SAMPLE_COUNT`` blocks spread over the first ``size`` bytes of ``stream``, ``None`` if it is shorter.
+
+    The last block ends at ``size``, so the bytes right before an append are always covered.
+    """
+    if size <= SAMPLE_COUNT * SAMPLE_SIZE:
+        spans = [(0, size)]
+    else:
+        spans = [(index * (size - SAMPLE_SIZE) // (SAMPLE_COUNT - 1), SAMPLE_SIZE) for index in range(SAMPLE_COUNT)]
+    value = 0
+    for offset, length in spans:
+        stream.seek(offset)
+        data = stream.read(length)
+        if len(data) < length:
+            return None
+        value = zlib.crc32(data, value)
+    return value
+
+
+def append_local_file(append: Append, destination: Path) -> bool:
+    """Append the new bytes to ``destination``, ``False`` if it does not have the old size anymore.
+
+    Unlike full copies this writes to the destination in place, not to a temporary file that
+    is renamed over it. A reader may see part of the appended bytes, but never a changed prefix.
+    """
+    try:
+        if destination.stat().st_size != append.offset:
+            return False
+    except OSError:
+        return False
+    with append.source.open("rb") as reader, destination.open("ab") as writer:
+        reader.seek(append.offset)
+        remaining = append.size - append.offset
+        while remaining > 0 and (data := reader.read(min(remaining, APPEND_CHUNK_SIZE))):
+            writer.write(data)
+            remaining -= len(data)
+    os.utime(destination, ns=(append.mtime_ns, append.mtime_ns))
+    return True
@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import time
+import zlib
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Protocol
+
+if TYPE_CHECKING:
+    from pathlib import PurePath
+
+MIN_LEVEL = 1
+MAX_LEVEL = 9
+DEFAULT_LEVEL = 6
+# Amount of input after which the level is reconsidered.
+ADAPT_WINDOW = 4 * 1024 * 1024
+# Share of the time spent compressing above which the level goes down, and below which it goes up.
+CPU_BOUND_SHARE = 0.6
+NETWORK_BOUND_SHARE = 0.3
+# Makes zlib write the gzip container instead of a raw zlib stream.
+GZIP_WBITS = 31
+
+INCOMPRESSIBLE_SUFFIXES = frozenset(
+    {
+        ".7z", ".apk", ".avif", ".br", ".bz2", ".deb", ".docx", ".flac", ".gif", ".gz", ".heic", ".jar",
+        ".jpeg", ".jpg", ".lz", ".lz4", ".lzma", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".ogg", ".opus",
+        ".parquet", ".png", ".pptx", ".rar", ".rpm", ".tgz", ".txz", ".webm", ".webp", ".whl", ".xlsx",
+        ".xz", ".zip", ".zst",
+    }
+)  # fmt: skip
+INCOMPRESSIBLE_MAGIC = (
+    b"\x1f\x8b",  # gzip
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"\xfd7zXZ\x00",  # xz
+    b"BZh",  # bzip2
+    b"PK\x03\x04",  # zip and its derivatives
+    b"\x89PNG",
+    b"\xff\xd8\xff",  # jpeg
+    b"GIF8",
+    b"7z\xbc\xaf\x27\x1c",
+    b"Rar!\x1a\x07",
+    b"\x04\x22\x4d\x18",  # lz4
+    b"OggS",
+    b"fLaC",
+)
+MAGIC_SIZE = 12
+
+
+def is_incompressible(path: PurePath, head: bytes) -> bool:
+    """Whether a file is already compressed, judging by its suffix or its first ``MAGIC_SIZE`` bytes."""
+    if path.suffix.lower() in INCOMPRESSIBLE_SUFFIXES:
+        return True
+    if head.startswith(INCOMPRESSIBLE_MAGIC):
+        return True
+    # RIFF containers (webp, avi) and ISO media (mp4, mov, heic) carry their type after a header.
+    return (head[:4] == b"RIFF" and head[8:12] in (b"WEBP", b"AVI ")) or head[4:8] == b"ftyp"
+
+
+@dataclass(slots=True)
+class TransferStats:
+    """Bytes a target was asked to sync versus bytes it actually had to send or write."""
+
+    payload_bytes: int = 0
+    sent_bytes: int = 0
+
+    @property
+    def saved_bytes(self) -> int:
+        return max(self.payload_bytes - self.sent_bytes, 0)
+
+    def add(self, payload_bytes: int, sent_bytes: int) -> None:
+        self.payload_bytes += payload_bytes
+        self.sent_bytes += sent_bytes
+
+    def describe(self) -> str:
+        share = self.saved_bytes / self.payload_bytes if self.payload_bytes else 0.0
+        return (
+            f"sent {format_size(self.sent_bytes)} for {format_size(self.payload_bytes)} of changes, "
+            f"saved {format_size(self.saved_bytes)} ({share:.0%})"
+        )
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    raise AssertionError("unreachable")
+
+
+class AdaptiveLevel:
+    """The compression level of a target, kept across uploads.
+
+    The level goes down while compressing takes most of the time, i.e. the CPU is the
+    bottleneck, and up while most of the time is spent waiting for the link to take the data.
+    """
+
+    def __init__(self, level: int = DEFAULT_LEVEL) -> None:
+        self.level = level
+
+    def update(self, compress_time: float, write_time: float) -> None:
+        total = compress_time + write_time
+        if total <= 0:
+            return
+        share = compress_time / total
+        if share > CPU_BOUND_SHARE:
+            self.level = max(self.level - 1, MIN_LEVEL)
+        elif share < NETWORK_BOUND_SHARE:
+            self.level = min(self.level + 1, MAX_LEVEL)
+
+
+class Writable(Protocol):
+    """Where ``CompressingWriter`` sends its output, e.g. a pipe or a ``ShapedWriter`` around one."""
+
+    def write(self, data: bytes | bytearray | memoryview, /) -> int: ...
+
+
+class CompressingWriter:
+    """A write-only stream that gzip-compresses into ``raw`` and counts what goes through.
+
+    The output is a series of gzip members, which ``gzip -d`` and ``tar -z`` read as one
+    stream. A new member starts whenever the level changes or the data switches between
+    compressible and already compressed, which is stored without deflating it again.
+    Without ``level`` the data is passed through uncompressed and only counted.
+    """
+
+    def __init__(self, raw: Writable, level: AdaptiveLevel | None) -> None:
+        self.raw = raw
+        self.level = level
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self._compressor: zlib._Compress | None = None
+        self._stored = False
+        self._window = 0
+        self._compress_time = 0.0
+        self._write_time = 0.0
+
+    def set_compressible(self, compressible: bool) -> None:
+        if self.level is not None and compressible == self._stored:
+            self._finish_member()
+            self._stored = not compressible
+
+    def write(self, data: bytes | bytearray | memoryview) -> int:
+        size = len(data)
+        self.raw_bytes += size
+        if self.level is None:
+            self._send(data)
+            return size
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(0 if self._stored else self.level.level, zlib.DEFLATED, GZIP_WBITS)
+        started = time.perf_counter()
+        compressed = self._compressor.compress(data)
+        self._compress_time += time.perf_counter() - started
+        if compressed:
+            self._send(compressed)
+        self._window += size
+        if self._window >= ADAPT_WINDOW:
+            self._adapt()
+        return size
+
+    def close(self) -> None:
+        """Finish the last gzip member, ``raw`` is left open."""
+        self._finish_member()
+
+    def _adapt(self) -> None:
+        assert self.level is not None
+        previous = self.level.level
+        if not self._stored:
+            self.level.update(self._compress_time, self._write_time)
+        self._window = 0
+        self._compress_time = self._write_time = 0.0
+        if self.level.level != previous:
+            self._finish_member()
+
+    def _finish_member(self) -> None:
+        if self._compressor is not None:
+            self._send(self._compressor.flush())
+            self._compressor = None
+
+    def _send(self, data: bytes | bytearray | memoryview) -> None:
+        started = time.perf_counter()
+        self.raw.write(data)
+        self._write_time += time.perf_counter() - started
+        self.wire_bytes += len(data)
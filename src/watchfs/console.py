@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from typing import IO, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from watchfs.colorful import Badge
+
+FLUSH_INTERVAL = 0.1
+SUMMARY_INTERVAL = 5.0
+CHANGE_LINES_PER_SECOND = 100
+# Written right away once this many lines are pending, e.g. when nothing runs ``run``.
+MAX_BUFFERED_LINES = 10_000
+SUMMARY_ORDER = ("added", "modified", "deleted", "moved", "rescanned")
+
+
+class Console:
+    """The output of the pipeline, buffered and written off the event loop by ``run``.
+
+    A change line is only rendered for the first ``lines_per_second`` changes of every
+    second, the rest are counted in one line. In ``quiet`` mode change lines are replaced
+    by a summary per target and ``summary_interval``. Every change, sync and failure can
+    also be logged as JSON lines for machines, see ``open_log``.
+    """
+
+    def __init__(
+        self,
+        stream: IO[str] | None = None,
+        *,
+        quiet: bool = False,
+        summary_interval: float = SUMMARY_INTERVAL,
+        lines_per_second: int = CHANGE_LINES_PER_SECOND,
+    ) -> None:
+        # ``None`` looks ``sys.stdout`` up on every write, so it can be redirected.
+        self.stream = stream
+        self.quiet = quiet
+        self.summary_interval = summary_interval
+        self.lines_per_second = lines_per_second
+        self._lines: list[str] = []
+        self._records: list[dict[str, object]] = []
+        self._log: IO[str] | None = None
+        self._window = 0
+        self._window_lines = 0
+        self._skipped = 0
+        self._summaries: dict[str, tuple[Counter[str], float]] = {}
+        self._summary_started = time.monotonic()
+        self._lock = threading.Lock()
+        # Held while writing, so two flushes never interleave their output.
+        self._write_lock = threading.Lock()
+
+    def open_log(self, path: Path) -> None:
+        """Append a JSON object per line to ``path`` for every change, sync and failure."""
+        self._log = path.open("a", encoding="utf-8")
+
+    def message(self, text: str) -> None:
+        self._append(text)
+
+    def change(self, badge: Badge, path: Path, moved_from: Path | None = None) -> None:
+        if self._log is not None:
+            record: dict[str, object] = {"event": "change", "change": badge.name.lower(), "path": str(path)}
+            if moved_from is not None:
+                record["from"] = str(moved_from)
+            self._record(record)
+        if self.quiet:
+            return
+        window = int(time.monotonic())
+        with self._lock:
+            if window != self._window:
+                self._window, self._window_lines = window, 0
+                self._report_skipped()
+            if self._window_lines >= self.lines_per_second:
+                self._skipped += 1
+                return
+            self._window_lines += 1
+        self._append(f"{badge} {path}" if moved_from is None else f"{badge} {moved_from} -> {path}")
+
+    def synced(self, target: str, changes: list[tuple[str, Path, float]], seconds: float) -> None:
+        """Count ``(change, path, lag)`` as applied to ``target`` in ``seconds``."""
+        if self._log is not None:
+            for change, path, lag in changes:
+                self._record({"event": "synced", "target": target, "change": change, "path": str(path), "lag": lag})
+        if not self.quiet:
+            return
+        with self._lock:
+            counts, busy = self._summaries.get(target, (Counter(), 0.0))
+            counts.update(change for change, _, _ in changes)
+            self._summaries[target] = counts, busy + seconds
+
+    def failed(self, target: str, paths: list[Path], error: BaseException, *, retry: bool) -> None:
+        if self._log is not None:
+            paths_text = [str(path) for path in paths]
+            self._record(
+                {"event": "failed", "target": target, "paths": paths_text, "error": str(error), "retry": retry}
+            )
+
+    async def run(self, interval: float = FLUSH_INTERVAL) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            with self._lock:
+                if self._window != int(time.monotonic()):
+                    self._report_skipped()
+                if time.monotonic() - self._summary_started >= self.summary_interval:
+                    self._report_summaries()
+            await asyncio.to_thread(self.flush)
+
+    def flush(self) -> None:
+        """Write everything pending. Blocking."""
+        with self._write_lock:
+            with self._lock:
+                lines, self._lines = self._lines, []
+                records, self._records = self._records, []
+            if lines:
+                stream = self.stream or sys.stdout
+                stream.write("".join(f"{line}\n" for line in lines))
+                stream.flush()
+            if records and self._log is not None:
+                self._log.write("".join(json.dumps(record) + "\n" for record in records))
+                self._log.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._report_skipped()
+            self._report_summaries()
+        self.flush()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _append(self, line: str) -> None:
+        with self._lock:
+            self._lines.append(line)
+            overflowing = len(self._lines) >= MAX_BUFFERED_LINES
+        if overflowing:
+            self.flush()
+
+    def _record(self, record: dict[str, object]) -> None:
+        record["time"] = time.time()
+        with self._lock:
+            self._records.append(record)
+            overflowing = len(self._records) >= MAX_BUFFERED_LINES
+        if overflowing:
+            self.flush()
+
+    def _report_skipped(self) -> None:
+        if self._skipped:
+            self._lines.append(f"... and {self._skipped:,} more changes")
+            self._skipped = 0
+
+    def _report_summaries(self) -> None:
+        for target, (counts, busy) in self._summaries.items():
+            self._lines.append(f"{format_counts(counts)} → {target} in {busy:.1f}s")
+        self._summaries.clear()
+        self._summary_started = time.monotonic()
+
+
+def format_counts(counts: Counter[str]) -> str:
+    """Render e.g. ``1,204 modified, 3 deleted``."""
+    ordered = sorted(
+        counts, key=lambda change: (SUMMARY_ORDER.index(change) if change in SUMMARY_ORDER else 99, change)
+    )
+    return ", ".join(f"{counts[change]:,} {change}" for change in ordered if counts[change])
+
+
+CONSOLE = Console()
@@ -0,0 +1,286 @@
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import math
+import shlex
+import struct
+import subprocess
+import tempfile
+import zlib
+from dataclasses import dataclass
+from typing import IO, TYPE_CHECKING, NoReturn
+
+from watchfs.exceptions import TargetUnavailableError
+from watchfs.fanout import open_changed_file
+from watchfs.shaping import shaped
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterator, Sequence
+    from pathlib import Path
+
+    from watchfs.fanout import SharedReader
+    from watchfs.shaping import TokenBucket
+
+    type Signatures = dict[int, dict[bytes, int]]
+
+DELTA_MIN_SIZE = 8 * 1024 * 1024
+MIN_BLOCK_SIZE = 4 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+# Bytes per file that may be searched byte by byte for a block that moved, beyond that only
+# block-aligned matches are found. Keeps files that are mostly new from being slow to diff.
+ROLL_BUDGET = 4 * 1024 * 1024
+LITERAL_CHUNK_SIZE = 1024 * 1024
+STRONG_DIGEST_SIZE = 16
+# Exit status of the remote command when there is no python3 to run the helper.
+NO_PYTHON_EXIT_CODE = 97
+# Exit status of ssh itself failing, e.g. because the host cannot be reached.
+SSH_ERROR_EXIT_CODE = 255
+MAGIC = b"WFD1"
+
+# Runs on the destination. Sends the signatures of the blocks of the existing file, then
+# rebuilds the file from literal data and references to those blocks into a temporary file
+# that is renamed over the old one. Only needs the standard library of any python3.
+REMOTE_HELPER = r"""
+import hashlib, os, struct, sys, tempfile, zlib
+root, name, size = sys.argv[1], sys.argv[2], int(sys.argv[3])
+path = os.path.join(os.path.expanduser(root), name)
+stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+def read(n):
+    data = stdin.read(n)
+    if len(data) != n:
+        sys.exit("watchfs delta: truncated stream")
+    return data
+try:
+    old = open(path, "rb")
+except OSError:
+    old = None
+signatures = []
+while old is not None:
+    block = old.read(size)
+    if not block:
+        break
+    signatures.append(struct.pack(">I", zlib.adler32(block)) + hashlib.blake2b(block, digest_size=16).digest())
+stdout.write(b"WFD1" + struct.pack(">I", len(signatures)) + b"".join(signatures))
+stdout.flush()
+os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+fd, temp = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".", suffix=".watchfs", dir=os.path.dirname(path))
+try:
+    with os.fdopen(fd, "wb") as new:
+        while True:
+            op = read(1)
+            if op == b"L":
+                new.write(read(struct.unpack(">I", read(4))[0]))
+            elif op == b"B":
+                old.seek(struct.unpack(">I", read(4))[0] * size)
+                new.write(old.read(size))
+            elif op == b"E":
+                mtime_ns, mode = struct.unpack(">qI", read(12))
+                break
+            elif op == b"A":
+                sys.exit(0)
+            else:
+                sys.exit("watchfs delta: bad stream")
+    os.chmod(temp, mode)
+    os.utime(temp, ns=(mtime_ns, mtime_ns))
+    os.replace(temp, path)
+except BaseException:
+    os.unlink(temp)
+    raise
+stdout.write(b"DONE")
+"""
+
+
+@dataclass(frozen=True, slots=True)
+class DeltaStats:
+    literal_bytes: int
+    matched_bytes: int
+    # Nothing was sent because the destination has no copy to diff against, see ``transfer_delta_sync``.
+    remote_missing: bool = False
+
+
+def choose_block_size(size: int) -> int:
+    """Roughly ``sqrt(size)`` like rsync, rounded to a power of two."""
+    block_size = 2 ** round(math.log2(max(math.isqrt(size), 1)))
+    return min(max(block_size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def delta_remote_command(root: str, relative_path: str, block_size: int) -> str:
+    """The shell command that runs the helper for ``relative_path`` below ``root``, an already quoted path."""
+    helper = shlex.quote(REMOTE_HELPER)
+    return (
+        f"command -v python3 >/dev/null 2>&1 || exit {NO_PYTHON_EXIT_CODE}; "
+        f"exec python3 -c {helper} {root} {shlex.quote(relative_path)} {block_size}"
+    )
+
+
+def transfer_delta_sync(
+    command: list[str],
+    source: Path,
+    opener: Callable[[Path], IO[bytes] | SharedReader],
+    block_size: int,
+    buckets: Sequence[TokenBucket] = (),
+    *,
+    require_remote_copy: bool = False,
+) -> DeltaStats | None:
+    """Update the destination of ``source`` through the helper started by ``command``.
+
+    Returns ``None`` without transferring anything when the destination has no python3. With
+    ``require_remote_copy`` a destination that is missing or empty is left alone too, and the
+    stats say ``remote_missing``: sending the whole file as literal data is slower than a tar
+    upload, which compresses it as well. A source that is gone is skipped with empty stats.
+    """
+    # Opened first, so nothing is started remotely for a file that vanished.
+    if (opened := open_changed_file(source, opener)) is None:
+        return DeltaStats(0, 0)
+    reader, stat = opened
+    with reader, tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+        assert process.stdin is not None and process.stdout is not None
+        try:
+            header = process.stdout.read(len(MAGIC) + 4)
+            if len(header) < len(MAGIC) + 4 or not header.startswith(MAGIC):
+                process.stdin.close()
+                if process.wait() == NO_PYTHON_EXIT_CODE:
+                    return None
+                _raise_failure(process, stderr)
+            (count,) = struct.unpack(">I", header[len(MAGIC) :])
+            signatures = _parse_signatures(process.stdout.read(count * (4 + STRONG_DIGEST_SIZE)))
+            if require_remote_copy and not signatures:
+                process.stdin.write(b"A")
+                process.stdin.close()
+                if process.wait() != 0:
+                    _raise_failure(process, stderr)
+                return DeltaStats(0, 0, remote_missing=True)
+            literal_bytes = 0
+            stdin = shaped(process.stdin, buckets)
+            for op, data in iter_delta(reader, signatures, block_size):
+                if op == b"L":
+                    literal_bytes += len(data)
+                    stdin.write(b"L" + struct.pack(">I", len(data)) + data)
+                else:
+                    stdin.write(b"B" + data)
+            stdin.write(b"E" + struct.pack(">qI", stat.st_mtime_ns, stat.st_mode & 0o7777))
+            process.stdin.close()
+            if process.stdout.read() != b"DONE" or process.wait() != 0:
+                _raise_failure(process, stderr)
+            return DeltaStats(literal_bytes, max(stat.st_size - literal_bytes, 0))
+        except BrokenPipeError:
+            _raise_failure(process, stderr)
+        finally:
+            with contextlib.suppress(BrokenPipeError):
+                process.stdin.close()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+
+def _raise_failure(process: subprocess.Popen[bytes], stderr: IO[bytes]) -> NoReturn:
+    returncode = process.wait()
+    stderr.seek(0)
+    message = stderr.read().decode(errors="replace").strip() or f"exit status {returncode}"
+    if returncode == SSH_ERROR_EXIT_CODE:
+        # Nothing reached the destination, so this waits for it instead of counting as a failed attempt.
+        raise TargetUnavailableError(f"SSH connection failed during delta transfer: {message}")
+    raise RuntimeError(f"Delta transfer failed: {message}")
+
+
+def _parse_signatures(data: bytes) -> Signatures:
+    signatures: Signatures = {}
+    record_size = 4 + STRONG_DIGEST_SIZE
+    for index in range(len(data) // record_size):
+        record = data[index * record_size : (index + 1) * record_size]
+        (weak,) = struct.unpack(">I", record[:4])
+        signatures.setdefault(weak, {}).setdefault(record[4:], index)
+    return signatures
+
+
+def signatures_of(data: bytes, block_size: int) -> Signatures:
+    """The signatures the helper would send for a destination file containing ``data``."""
+    signatures: Signatures = {}
+    for index, offset in enumerate(range(0, len(data), block_size)):
+        block = data[offset : offset + block_size]
+        signatures.setdefault(zlib.adler32(block), {}).setdefault(_strong(block), index)
+    return signatures
+
+
+def iter_delta(
+    reader: IO[bytes] | SharedReader, signatures: Signatures, block_size: int, *, roll_budget: int = ROLL_BUDGET
+) -> Iterator[tuple[bytes, bytes]]:
+    """Yield ``(b"L", data)`` for literal data and ``(b"B", packed index)`` for blocks the destination has.
+
+    Blocks are first looked up at the current offset. After a miss, the rolling adler32 is
+    used to find a block that moved, until ``roll_budget`` bytes were searched that way.
+    """
+    buffer = bytearray()
+    position = 0
+    literal = bytearray()
+    eof = False
+
+    def fill(size: int) -> None:
+        nonlocal eof
+        while not eof and len(buffer) - position < size:
+            data = reader.read(max(size, LITERAL_CHUNK_SIZE))
+            if data:
+                buffer.extend(data)
+            else:
+                eof = True
+
+    while True:
+        if position >= LITERAL_CHUNK_SIZE:
+            del buffer[:position]
+            position = 0
+        fill(2 * block_size)
+        window = bytes(buffer[position : position + block_size])
+        if not window:
+            break
+        index = _lookup(signatures, window)
+        if index is None and signatures and roll_budget > 0 and len(window) == block_size:
+            offset, index = _roll(buffer, position, block_size, signatures, roll_budget)
+            roll_budget -= block_size if index is None else offset
+            if index is not None:
+                literal += buffer[position : position + offset]
+                position += offset
+                window = bytes(buffer[position : position + block_size])
+        if index is None:
+            literal += window
+        else:
+            if literal:
+                yield b"L", bytes(literal)
+                literal.clear()
+            yield b"B", struct.pack(">I", index)
+        position += len(window)
+        if len(literal) >= LITERAL_CHUNK_SIZE:
+            yield b"L", bytes(literal)
+            literal.clear()
+    if literal:
+        yield b"L", bytes(literal)
+
+
+def _lookup(signatures: Signatures, block: bytes) -> int | None:
+    strong = signatures.get(zlib.adler32(block))
+    if strong is None:
+        return None
+    return strong.get(_strong(block))
+
+
+def _roll(
+    buffer: bytearray, position: int, block_size: int, signatures: Signatures, budget: int
+) -> tuple[int, int | None]:
+    """Search the offsets after ``position`` for a known block, return the offset and its index."""
+    checksum = zlib.adler32(buffer[position : position + block_size])
+    a, b = checksum & 0xFFFF, checksum >> 16
+    end = min(len(buffer) - block_size - position, block_size, budget)
+    for offset in range(1, end + 1):
+        removed, added = buffer[position + offset - 1], buffer[position + offset - 1 + block_size]
+        a = (a - removed + added) % 65521
+        b = (b - block_size * removed + a - 1) % 65521
+        if (b << 16 | a) in signatures:
+            block = bytes(buffer[position + offset : position + offset + block_size])
+            if (index := signatures[b << 16 | a].get(_strong(block))) is not None:
+                return offset, index
+    return 0, None
+
+
+def _strong(block: bytes) -> bytes:
+    return hashlib.blake2b(block, digest_size=STRONG_DIGEST_SIZE).digest()
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import stat
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path, PurePath
+from typing import TYPE_CHECKING
+
+from watchfiles import Change
+
+from watchfs.fastcopy import TEMP_SUFFIX
+
+if TYPE_CHECKING:
+    import os
+
+# How long a write is expected to show up in the watcher, well above its debounce.
+ECHO_TTL = 30.0
+MAX_EXPECTED_PATHS = 100_000
+
+
+@dataclass(frozen=True, slots=True)
+class Fingerprint:
+    size: int
+    mtime_ns: int
+    is_dir: bool = False
+
+    @classmethod
+    def of(cls, path: Path) -> Fingerprint | None:
+        try:
+            result = path.lstat()
+        except OSError:
+            return None
+        return cls(result.st_size, result.st_mtime_ns, stat.S_ISDIR(result.st_mode))
+
+    def matches(self, other: Fingerprint) -> bool:
+        # A directory's size and mtime change with its entries.
+        return self.is_dir == other.is_dir and (
+            self.is_dir or (self.size, self.mtime_ns) == (other.size, other.mtime_ns)
+        )
+
+
+type Expectation = Fingerprint | None
+
+
+class EchoSuppressor:
+    """Remembers what watchfs itself wrote below ``root``, so the watcher of ``root`` can drop the echoes.
+
+    Both directions of a bidirectional mapping watch what the other one writes. Every write,
+    removal and move is recorded before it happens with the fingerprint the path will have
+    afterwards, the destination gets the size and nanosecond mtime of the source. A change
+    reported for a path that still has its expected fingerprint is an echo, a change by
+    anyone else gives the path a new mtime and passes.
+    """
+
+    def __init__(self, root: Path, *, ttl: float = ECHO_TTL, max_entries: int = MAX_EXPECTED_PATHS) -> None:
+        self.root = root
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.suppressed = 0
+        self._expected: OrderedDict[PurePath, tuple[float, Expectation]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def expect_write(self, relative_path: PurePath, source_stat: os.stat_result) -> None:
+        """Record that ``relative_path`` is about to become a copy of a file with ``source_stat``. Blocking."""
+        directories = []
+        for parent in relative_path.parents:
+            if parent == PurePath() or (self.root / parent).is_dir():
+                break
+            directories.append(parent)
+        with self._lock:
+            for directory in directories:
+                self._expect(directory, Fingerprint(0, 0, is_dir=True))
+            self._expect(relative_path, Fingerprint(source_stat.st_size, source_stat.st_mtime_ns))
+
+    def expect_removal(self, relative_path: PurePath) -> None:
+        """Record that ``relative_path`` and everything below it is about to be removed."""
+        with self._lock:
+            self._expect(relative_path, None)
+
+    def expect_move(self, old_path: PurePath, new_path: PurePath) -> None:
+        """Record that ``old_path`` is about to be renamed to ``new_path``. Blocking."""
+        fingerprint = Fingerprint.of(self.root / old_path)
+        with self._lock:
+            self._expect(old_path, None)
+            if fingerprint is not None:
+                self._expect(new_path, fingerprint)
+
+    def filter_changes(self, changes: set[tuple[Change, str]]) -> set[tuple[Change, str]]:
+        """Return ``changes`` without the echoes of recorded writes. Blocking."""
+        kept: set[tuple[Change, str]] = set()
+        with self._lock:
+            self._expire()
+            if not self._expected:
+                return changes
+            for change, path in changes:
+                try:
+                    relative_path = PurePath(path).relative_to(self.root)
+                except ValueError:
+                    kept.add((change, path))
+                    continue
+                if self._is_echo(change, relative_path, Path(path)):
+                    self.suppressed += 1
+                else:
+                    # Someone else changed the path since, whatever comes next is not an echo.
+                    self._expected.pop(relative_path, None)
+                    kept.add((change, path))
+        return kept
+
+    def _is_echo(self, change: Change, relative_path: PurePath, path: Path) -> bool:
+        if _is_temporary(relative_path):
+            # The temporary file of a write, renamed over its destination by now.
+            name = relative_path.name.removeprefix(".").removesuffix(TEMP_SUFFIX).rsplit(".", 1)[0]
+            return relative_path.with_name(name) in self._expected
+        current = Fingerprint.of(path)
+        if change == Change.deleted:
+            if current is not None:
+                return False
+            # A removed directory reports the deletion of everything below it.
+            return any(
+                candidate in self._expected and self._expected[candidate][1] is None
+                for candidate in (relative_path, *relative_path.parents)
+            )
+        entry = self._expected.get(relative_path)
+        if entry is None or entry[1] is None or current is None:
+            return False
+        return entry[1].matches(current)
+
+    def _expect(self, relative_path: PurePath, expectation: Expectation) -> None:
+        self._expected.pop(relative_path, None)
+        self._expected[relative_path] = (time.monotonic() + self.ttl, expectation)
+        while len(self._expected) > self.max_entries:
+            self._expected.popitem(last=False)
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        while self._expected:
+            relative_path, (deadline, _) = next(iter(self._expected.items()))
+            if deadline > now:
+                return
+            del self._expected[relative_path]
+
+
+def _is_temporary(relative_path: PurePath) -> bool:
+    return relative_path.name.startswith(".") and relative_path.name.endswith(TEMP_SUFFIX)
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+from watchfiles import Change
+
+from watchfs.priorities import Priority
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from watchfiles.filters import BaseFilter
+
+    from watchfs.fanout import SharedReads
+    from watchfs.mappings import SyncMapping
+    from watchfs.state import SyncStateIndex
+    from watchfs.targets import SyncTarget
+
+
+@dataclass(frozen=True, slots=True)
+class SyncJob:
+    mapping: SyncMapping
+    target: SyncTarget
+    queue_key: str
+    # Set when several jobs watch the same source so they can share reads of changed files.
+    reads: SharedReads | None = None
+    # Applied while expanding added or modified directories, so excluded subtrees are never walked.
+    path_filter: BaseFilter | None = None
+    # What was synced to the target so far, kept across runs with ``--state-dir``.
+    state: SyncStateIndex | None = None
+    # The class of all changes of this job instead of classifying them one by one.
+    priority: Priority | None = None
+    # Set for either direction of a bidirectional mapping, which never deletes and only overwrites older files.
+    bidirectional: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class SyncEvent:
+    job: SyncJob
+    change: Change
+    path: Path
+    # Set for a rename of ``moved_from`` to ``path``, which targets apply with ``move_path``.
+    moved_from: Path | None = None
+    # Set for a directory whose pending changes overflowed the queue, it is resynced by comparing both sides.
+    rescan: bool = False
+    # Number of times applying this event failed while its target was reachable.
+    attempts: int = 0
+    # Monotonic time before which a failed event is not retried, it backs off on its own.
+    retry_at: float = 0.0
+    # When the first change this event stands for was seen, kept when events are merged, for the sync lag.
+    observed_at: float = field(default_factory=time.monotonic)
+    # More urgent classes are handed out first, see ``CoalescingQueue``.
+    priority: Priority = Priority.NORMAL
+
+
+def coalesce_changes(previous: Change, current: Change) -> Change | None:
+    """Merge two pending changes of the same path into one, ``None`` means nothing is left to do."""
+    match previous, current:
+        case Change.added, Change.deleted:
+            return None
+        case Change.added, _:
+            return Change.added
+        case _, Change.deleted:
+            return Change.deleted
+        case Change.deleted, _:
+            # The destination may still hold the old file, so a later deletion must not cancel out.
+            return Change.modified
+        case _:
+            return Change.modified
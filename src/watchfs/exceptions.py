@@ -10,6 +10,7 @@ if TYPE_CHECKING:
 
 class ErrorCode(Enum):
     PARSE_ERROR = 1
+    TARGET_UNAVAILABLE = 2
 
 
 class SuccessCode(Enum):
@@ -32,6 +33,12 @@ class ParseError(WatchFsBaseException):
     code = ErrorCode.PARSE_ERROR
 
 
+class TargetUnavailableError(WatchFsBaseException):
+    """The target could not be reached at all, as opposed to an operation on it failing."""
+
+    code = ErrorCode.TARGET_UNAVAILABLE
+
+
 def handle_uncaught_exception(
     exctype: type[BaseException], exception: BaseException, trace: TracebackType | None
 ) -> None:
@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import IO, TYPE_CHECKING, BinaryIO, Self
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from pathlib import Path
+    from types import TracebackType
+
+CHUNK_SIZE = 1024 * 1024
+WINDOW_CHUNKS = 16
+STALL_TIMEOUT = 10.0
+# Chunks kept for readers that may still join, over all files of a source.
+MAX_BUFFERED_BYTES = 64 * 1024 * 1024
+
+
+class SharedRead:
+    """A single pass over a source file whose chunks are shared by several readers.
+
+    Chunks are read on demand by whichever reader first needs them and are kept in a window
+    of at most ``window`` chunks. A reader that runs ahead waits for the slowest one before
+    the oldest chunk is dropped, which bounds memory and applies backpressure. Readers that
+    only show up after the first chunk was dropped are turned away and read the file themselves,
+    as are readers that stall the others for longer than ``stall_timeout``.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        stream: BinaryIO,
+        identity: tuple[int, int, int],
+        *,
+        readers: int,
+        chunk_size: int = CHUNK_SIZE,
+        window: int = WINDOW_CHUNKS,
+        stall_timeout: float = STALL_TIMEOUT,
+    ) -> None:
+        self.path = path
+        self.identity = identity
+        self.expected = readers
+        self.chunk_size = chunk_size
+        self.window = window
+        self.stall_timeout = stall_timeout
+        self._stream: BinaryIO | None = stream
+        self._chunks: list[bytes] = []
+        self._base = 0
+        self._eof_at: int | None = None
+        self._reading = False
+        self._joined = 0
+        self._closed_for_joins = False
+        self._positions: dict[SharedReader, int] = {}
+        self._cond = threading.Condition()
+
+    def join(self) -> SharedReader | None:
+        with self._cond:
+            if self._closed_for_joins or self._base > 0 or self._joined >= self.expected:
+                return None
+            self._joined += 1
+            reader = SharedReader(self)
+            self._positions[reader] = 0
+            return reader
+
+    def buffered_bytes(self) -> int:
+        with self._cond:
+            return sum(len(chunk) for chunk in self._chunks)
+
+    def close_for_joins(self) -> None:
+        with self._cond:
+            self._closed_for_joins = True
+            self._maybe_close()
+
+    def chunk(self, reader: SharedReader, index: int) -> bytes | None:
+        """Return chunk ``index`` for ``reader``, ``None`` if it was detached for stalling the others."""
+        with self._cond:
+            deadline = time.monotonic() + self.stall_timeout
+            while True:
+                if reader not in self._positions:
+                    return None
+                if self._base <= index < self._base + len(self._chunks):
+                    self._positions[reader] = index
+                    self._cond.notify_all()
+                    return self._chunks[index - self._base]
+                if self._eof_at is not None and index >= self._eof_at:
+                    return b""
+                if self._reading:
+                    self._cond.wait()
+                    continue
+                if len(self._chunks) >= self.window and not self._evict():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._detach_slowest()
+                    else:
+                        self._cond.wait(remaining)
+                    continue
+                self._read_next()
+
+    def leave(self, reader: SharedReader) -> None:
+        with self._cond:
+            self._positions.pop(reader, None)
+            self._cond.notify_all()
+            self._maybe_close()
+
+    def _read_next(self) -> None:
+        assert self._stream is not None
+        self._reading = True
+        stream = self._stream
+        self._cond.release()
+        try:
+            data = stream.read(self.chunk_size)
+        finally:
+            self._cond.acquire()
+            self._reading = False
+        self._chunks.append(data)
+        if len(data) < self.chunk_size:
+            self._eof_at = self._base + len(self._chunks) - (0 if data else 1)
+        self._cond.notify_all()
+
+    def _evict(self) -> bool:
+        # A reader's position is the chunk it is still consuming, so the oldest chunk can only
+        # go once every reader has asked for a later one.
+        if any(position <= self._base for position in self._positions.values()):
+            return False
+        del self._chunks[0]
+        self._base += 1
+        return True
+
+    def _detach_slowest(self) -> None:
+        for reader, position in list(self._positions.items()):
+            if position <= self._base:
+                del self._positions[reader]
+        self._cond.notify_all()
+
+    def _maybe_close(self) -> None:
+        no_more_joins = self._closed_for_joins or self._base > 0 or self._joined >= self.expected
+        if not self._positions and no_more_joins and self._stream is not None:
+            self._stream.close()
+            self._stream = None
+            self._chunks.clear()
+
+
+class SharedReader:
+    """A file-like view of a ``SharedRead`` that falls back to its own file handle when detached."""
+
+    def __init__(self, shared: SharedRead) -> None:
+        self.shared = shared
+        self._index = 0
+        self._chunk: bytes | None = None
+        self._offset = 0
+        self._position = 0
+        self._fallback: BinaryIO | None = None
+
+    def read(self, size: int = -1) -> bytes | memoryview:
+        if size < 0:
+            parts: list[bytes] = []
+            while data := self.read(self.shared.chunk_size):
+                parts.append(bytes(data))
+            return b"".join(parts)
+        if self._fallback is not None:
+            return self._read_fallback(size)
+        if self._chunk is None or self._offset >= len(self._chunk):
+            if self._chunk is not None:
+                if not self._chunk:
+                    return b""
+                self._index += 1
+                self._offset = 0
+            self._chunk = self.shared.chunk(self, self._index)
+            if self._chunk is None:
+                self._fallback = self.shared.path.open("rb")
+                self._fallback.seek(self._position)
+                return self._read_fallback(size)
+        view = memoryview(self._chunk)[self._offset : self._offset + size]
+        self._offset += len(view)
+        self._position += len(view)
+        return view
+
+    def close(self) -> None:
+        self.shared.leave(self)
+        if self._fallback is not None:
+            self._fallback.close()
+            self._fallback = None
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self, exc_type: type[BaseException] | None, exc: BaseException | None, traceback: TracebackType | None
+    ) -> None:
+        self.close()
+
+    def _read_fallback(self, size: int) -> bytes:
+        assert self._fallback is not None
+        data = self._fallback.read(size)
+        self._position += len(data)
+        return data
+
+
+class SharedReads:
+    """Per-source registry that lets the jobs of one source share a single read of each file.
+
+    ``readers`` is the number of jobs watching the source, i.e. how many writes of the same
+    file content to expect. Only the ``max_open`` most recently opened files are joinable, and
+    older ones stop being joinable while they hold more than ``max_buffered`` bytes together,
+    since a job that filters a file out or finds it up to date never joins its read.
+    """
+
+    def __init__(self, readers: int, *, max_open: int = 64, max_buffered: int = MAX_BUFFERED_BYTES) -> None:
+        self.readers = readers
+        self.max_open = max_open
+        self.max_buffered = max_buffered
+        self._reads: OrderedDict[Path, SharedRead] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def open(self, path: Path) -> SharedReader | BinaryIO:
+        stream = path.open("rb")
+        stat = os.fstat(stream.fileno())
+        identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            shared = self._reads.get(path)
+            if shared is not None and shared.identity == identity and (reader := shared.join()) is not None:
+                stream.close()
+                return reader
+            if shared is not None:
+                shared.close_for_joins()
+            shared = SharedRead(path, stream, identity, readers=self.readers)
+            self._reads[path] = shared
+            self._reads.move_to_end(path)
+            while len(self._reads) > self.max_open or (
+                len(self._reads) > 1 and sum(read.buffered_bytes() for read in self._reads.values()) > self.max_buffered
+            ):
+                _, evicted = self._reads.popitem(last=False)
+                evicted.close_for_joins()
+            reader = shared.join()
+            assert reader is not None
+            return reader
+
+
+def open_changed_file(
+    path: Path, opener: Callable[[Path], IO[bytes] | SharedReader]
+) -> tuple[IO[bytes] | SharedReader, os.stat_result] | None:
+    """Open ``path`` with ``opener`` and stat it, ``None`` if it is gone or a directory by now.
+
+    Such a file vanished or was replaced since its event was queued, a later event covers it,
+    so callers skip it.
+    """
+    try:
+        stream = opener(path)
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+    try:
+        return stream, path.stat()
+    except FileNotFoundError:
+        stream.close()
+        return None
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import contextlib
+import errno
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from typing import IO, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Generator
+
+    from watchfs.fanout import SharedReader
+
+if sys.platform != "win32":
+    import fcntl
+
+# ``_IOW(0x94, 9, int)`` from linux/fs.h, clones the extents of one file into another.
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 1024 * 1024
+# Suffix of the temporary file a copy is written to before it replaces the destination.
+TEMP_SUFFIX = ".watchfs"
+
+# Errors meaning "this copy method is not available here", after which the next one is tried.
+_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+    errno.EPERM,
+}
+
+
+def copy_file(source: Path, destination: Path) -> bool:
+    """Copy ``source`` over ``destination`` with its mtime, return ``False`` if it was already up to date.
+
+    The content goes to a temporary file next to ``destination`` that is renamed over it,
+    so readers never see a partially written file. The data is reflinked where the
+    filesystem supports it and otherwise copied in the kernel.
+    """
+    with source.open("rb") as reader:
+        stat = os.fstat(reader.fileno())
+        if is_up_to_date(destination, stat):
+            return False
+        with _replacing(destination, stat) as writer:
+            _copy_data(reader, writer)
+    return True
+
+
+def stream_file(source: Path, destination: Path, reader: IO[bytes] | SharedReader) -> bool:
+    """Like ``copy_file`` but reads the content from ``reader``, e.g. a shared read of ``source``."""
+    stat = source.stat()
+    if is_up_to_date(destination, stat):
+        return False
+    with _replacing(destination, stat) as writer:
+        while data := reader.read(COPY_CHUNK_SIZE):
+            writer.write(data)
+    return True
+
+
+def is_up_to_date(destination: Path, source_stat: os.stat_result) -> bool:
+    try:
+        stat = destination.stat()
+    except OSError:
+        return False
+    return stat.st_size == source_stat.st_size and stat.st_mtime_ns == source_stat.st_mtime_ns
+
+
+@contextlib.contextmanager
+def _replacing(destination: Path, source_stat: os.stat_result) -> Generator[IO[bytes]]:
+    fd, temp_name = tempfile.mkstemp(prefix=f".{destination.name}.", suffix=TEMP_SUFFIX, dir=destination.parent)
+    temp_path = Path(temp_name)
+    try:
+        with os.fdopen(fd, "wb") as writer:
+            yield writer
+        temp_path.chmod(source_stat.st_mode & 0o7777)
+        os.utime(temp_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        temp_path.replace(destination)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+def _copy_data(reader: IO[bytes], writer: IO[bytes]) -> None:
+    source_fd, destination_fd = reader.fileno(), writer.fileno()
+    if _reflink(source_fd, destination_fd):
+        return
+    # Each method continues from the file offsets the previous one stopped at.
+    for copy in (_copy_file_range, _sendfile):
+        with contextlib.suppress(_Unsupported):
+            copy(source_fd, destination_fd)
+            return
+    shutil.copyfileobj(reader, writer, COPY_CHUNK_SIZE)
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _reflink(source_fd: int, destination_fd: int) -> bool:
+    if sys.platform == "win32":
+        return False
+    try:
+        fcntl.ioctl(destination_fd, FICLONE, source_fd)
+    except OSError as err:
+        if err.errno in _UNSUPPORTED_ERRNOS:
+            return False
+        raise
+    return True
+
+
+def _copy_file_range(source_fd: int, destination_fd: int) -> None:
+    copy_file_range = getattr(os, "copy_file_range", None)
+    if copy_file_range is None:
+        raise _Unsupported
+    _copy_in_kernel(lambda: copy_file_range(source_fd, destination_fd, COPY_CHUNK_SIZE * 64))
+
+
+def _sendfile(source_fd: int, destination_fd: int) -> None:
+    if sys.platform != "linux":
+        raise _Unsupported
+    _copy_in_kernel(lambda: os.sendfile(destination_fd, source_fd, None, COPY_CHUNK_SIZE * 64))
+
+
+def _copy_in_kernel(copy_chunk: Callable[[], int]) -> None:
+    copied_any = False
+    while True:
+        try:
+            copied = copy_chunk()
+        except OSError as err:
+            # Only fall back before anything was copied, later errors are real I/O errors.
+            if not copied_any and err.errno in _UNSUPPORTED_ERRNOS:
+                raise _Unsupported from err
+            raise
+        if copied == 0:
+            # Some filesystems report nothing to copy instead of failing, let the next method check.
+            if not copied_any:
+                raise _Unsupported
+            return
+        copied_any = True
@@ -1,13 +1,23 @@
 from __future__ import annotations
 
+import asyncio
 import fnmatch
-import hashlib
+import os
+import re
+import threading
 import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 from watchfiles import Change
 from watchfiles.filters import BaseFilter
 
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
 
 def match_pattern(path: Path, pattern: str) -> bool:
     normalized_path = path.as_posix()
@@ -38,13 +48,121 @@ def _contains_glob(pattern: str) -> bool:
     return any(token in pattern for token in "*?[]")
 
 
+_ANCHOR_RE = re.compile(r"^(?:[A-Za-z]:)?/*")
+
+
+def _strip_anchor(posix_path: str) -> str:
+    return _ANCHOR_RE.sub("", posix_path, count=1)
+
+
+def _translate_glob(pattern: str) -> str:
+    return re.sub(r"\\[Zz]$", "", fnmatch.translate(pattern))
+
+
+def _compile_alternatives(alternatives: list[str], *, absolute: bool) -> re.Pattern[str] | None:
+    if not alternatives:
+        return None
+    joined = "|".join(alternatives)
+    # Relative patterns may match any suffix of the path that starts at a component boundary.
+    return re.compile(rf"(?:{joined})\Z" if absolute else rf"(?:^|/)(?:{joined})\Z")
+
+
+class ExcludeMatcher:
+    """The exclude patterns of an ``ExcludeFilter`` compiled into one matcher.
+
+    Gives the same answers as checking ``match_pattern`` for every pattern. Literal patterns and
+    ``pattern/**`` globs exclude whole subtrees, so they are evaluated once per directory and the
+    decision is cached for everything below it; single component literals are a set lookup and
+    the rest is one combined regex. The remaining globs only apply to the path itself and are
+    combined into another regex.
+    """
+
+    def __init__(self, patterns: list[str], *, cache_size: int = 65536) -> None:
+        self.cache_size = cache_size
+        self._names: set[str] = set()
+        self._absolute_literals: set[str] = set()
+        prefixes: list[str] = []
+        absolute_prefixes: list[str] = []
+        leaves: list[str] = []
+        absolute_leaves: list[str] = []
+        for pattern in patterns:
+            absolute = Path(pattern).is_absolute()
+            if _contains_glob(pattern) and not pattern.endswith("/**"):
+                (absolute_leaves if absolute else leaves).append(_translate_glob(pattern))
+                continue
+            stem = pattern
+            while stem.endswith("/**"):
+                stem = stem.removesuffix("/**")
+                if _contains_glob(stem):
+                    (absolute_prefixes if absolute else prefixes).append(_translate_glob(stem))
+            if _contains_glob(stem):
+                continue
+            stem = stem.rstrip("/")
+            if absolute:
+                self._absolute_literals.add(stem)
+            elif "/" in stem:
+                prefixes.append(re.escape(stem))
+            else:
+                self._names.add(stem)
+        self._prefix_re = _compile_alternatives(prefixes, absolute=False)
+        self._absolute_prefix_re = _compile_alternatives(absolute_prefixes, absolute=True)
+        self._leaf_re = _compile_alternatives(leaves, absolute=False)
+        self._absolute_leaf_re = _compile_alternatives(absolute_leaves, absolute=True)
+        self._directories: dict[str, bool] = {}
+
+    def matches(self, path: str) -> bool:
+        posix_path = path if os.sep == "/" else path.replace(os.sep, "/")
+        parent, _, _ = posix_path.rpartition("/")
+        return (
+            self._excludes_subtree(parent) or self._matches_subtree_root(posix_path) or self._matches_leaf(posix_path)
+        )
+
+    def _excludes_subtree(self, directory: str) -> bool:
+        if (cached := self._directories.get(directory)) is not None:
+            return cached
+        pending: list[str] = []
+        excluded = False
+        while True:
+            if (cached := self._directories.get(directory)) is not None:
+                excluded = cached
+                break
+            if not _strip_anchor(directory):
+                break
+            pending.append(directory)
+            directory = directory.rpartition("/")[0]
+        if len(self._directories) + len(pending) > self.cache_size:
+            self._directories.clear()
+        for directory in reversed(pending):
+            excluded = excluded or self._matches_subtree_root(directory)
+            self._directories[directory] = excluded
+        return excluded
+
+    def _matches_subtree_root(self, posix_path: str) -> bool:
+        relative_path = _strip_anchor(posix_path)
+        if not relative_path:
+            return False
+        if relative_path.rpartition("/")[2] in self._names:
+            return True
+        if self._prefix_re is not None and self._prefix_re.search(relative_path):
+            return True
+        if posix_path in self._absolute_literals:
+            return True
+        return self._absolute_prefix_re is not None and self._absolute_prefix_re.match(posix_path) is not None
+
+    def _matches_leaf(self, posix_path: str) -> bool:
+        if self._leaf_re is not None and self._leaf_re.search(_strip_anchor(posix_path)):
+            return True
+        return self._absolute_leaf_re is not None and self._absolute_leaf_re.match(posix_path) is not None
+
+
 class ExcludeFilter(BaseFilter):
     def __init__(self, cli_arg: str):
         super().__init__()
         self.exclude_patterns = self.parse_cli_arg(cli_arg)
+        self.matcher = ExcludeMatcher(self.exclude_patterns)
 
     def __call__(self, change: Change, path: str) -> bool:
-        return all(not match_pattern(Path(path), pattern) for pattern in self.exclude_patterns)
+        return not self.matcher.matches(path)
 
     @staticmethod
     def parse_cli_arg(cli_arg: str) -> list[str]:
@@ -57,42 +175,238 @@ class ExcludeFilter(BaseFilter):
         return exclude_patterns
 
 
+IGNORE_FILE_NAMES = (".gitignore", ".watchfsignore")
+
+
+@dataclass(frozen=True, slots=True)
+class IgnoreRule:
+    regex: re.Pattern[str]
+    negated: bool
+    directory_only: bool
+
+
+def parse_ignore_rules(text: str) -> list[IgnoreRule]:
+    """Parse the lines of a gitignore file, see ``gitignore(5)``."""
+    rules: list[IgnoreRule] = []
+    for line in text.splitlines():
+        line = _strip_trailing_spaces(line)
+        if not line or line.startswith("#"):
+            continue
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        elif line.startswith(("\\!", "\\#")):
+            line = line[1:]
+        directory_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            continue
+        # A separator anywhere but at the end anchors the pattern to the directory of the ignore file.
+        anchored = "/" in line
+        line = line.removeprefix("/")
+        regex = _translate_ignore_pattern(line)
+        if not anchored:
+            regex = f"(?:.*/)?{regex}"
+        rules.append(IgnoreRule(re.compile(regex, re.DOTALL), negated, directory_only))
+    return rules
+
+
+def _strip_trailing_spaces(line: str) -> str:
+    stripped = line.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) < len(line):
+        return f"{stripped} "
+    return stripped
+
+
+def _translate_ignore_pattern(pattern: str) -> str:
+    regex: list[str] = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if pattern.startswith("**/", index) and (index == 0 or pattern[index - 1] == "/"):
+            regex.append("(?:.*/)?")
+            index += 3
+        elif (
+            pattern.startswith("**", index) and index + 2 == len(pattern) and (index == 0 or pattern[index - 1] == "/")
+        ):
+            regex.append(".*")
+            index += 2
+        elif char == "*":
+            regex.append("[^/]*")
+            index += 1
+        elif char == "?":
+            regex.append("[^/]")
+            index += 1
+        elif char == "[" and (end := pattern.find("]", index + 2)) != -1:
+            body = pattern[index + 1 : end]
+            if body.startswith("!"):
+                body = f"^{body[1:]}"
+            body = body.replace("\\", "\\\\").replace("[", "\\[")
+            regex.append(f"[{body}]")
+            index = end + 1
+        elif char == "\\" and index + 1 < len(pattern):
+            regex.append(re.escape(pattern[index + 1]))
+            index += 2
+        else:
+            regex.append(re.escape(char))
+            index += 1
+    return "".join(regex)
+
+
+class IgnoreFileFilter(BaseFilter):
+    """Skips paths ignored by ``.gitignore`` / ``.watchfsignore`` files below the source roots.
+
+    Ignore files are read lazily per directory and kept until an event reports that one of them
+    changed. Whether a directory is ignored is cached, and everything below an ignored directory
+    is ignored without looking at its own rules, just like git.
+    """
+
+    def __init__(self, roots: list[Path], *, file_names: tuple[str, ...] = IGNORE_FILE_NAMES) -> None:
+        super().__init__()
+        self.roots = sorted((root.resolve().as_posix() for root in roots), key=len, reverse=True)
+        self.file_names = file_names
+        self._rules: dict[str, list[IgnoreRule]] = {}
+        self._chains: dict[str, tuple[tuple[str, list[IgnoreRule]], ...]] = {}
+        self._directories: dict[str, bool] = {}
+
+    def __call__(self, change: Change, path: str) -> bool:
+        posix_path = path if os.sep == "/" else path.replace(os.sep, "/")
+        parent, _, name = posix_path.rpartition("/")
+        if name in self.file_names:
+            self.invalidate(parent)
+        root = self._root_of(posix_path)
+        if root is None or posix_path == root:
+            return True
+        if self._is_ignored_directory(parent, root):
+            return False
+        return not self._matches(posix_path, parent, root, lambda: change == Change.deleted or Path(path).is_dir())
+
+    def invalidate(self, directory: str) -> None:
+        self._rules.pop(directory, None)
+        self._chains.clear()
+        self._directories.clear()
+
+    def _root_of(self, posix_path: str) -> str | None:
+        for root in self.roots:
+            if posix_path == root or posix_path.startswith(f"{root}/"):
+                return root
+        return None
+
+    def _is_ignored_directory(self, directory: str, root: str) -> bool:
+        if directory == root or len(directory) < len(root):
+            return False
+        if (cached := self._directories.get(directory)) is None:
+            parent = directory.rpartition("/")[0]
+            cached = self._is_ignored_directory(parent, root) or self._matches(directory, parent, root, lambda: True)
+            self._directories[directory] = cached
+        return cached
+
+    def _matches(self, posix_path: str, parent: str, root: str, is_dir: Callable[[], bool]) -> bool:
+        # Deeper ignore files take precedence, and later rules within a file win over earlier ones.
+        for base, rules in reversed(self._chain(parent, root)):
+            relative_path = posix_path[len(base) + 1 :]
+            for rule in reversed(rules):
+                if rule.regex.fullmatch(relative_path) and (not rule.directory_only or is_dir()):
+                    return not rule.negated
+        return False
+
+    def _chain(self, directory: str, root: str) -> tuple[tuple[str, list[IgnoreRule]], ...]:
+        if (chain := self._chains.get(directory)) is None:
+            parent_chain = () if directory == root else self._chain(directory.rpartition("/")[0], root)
+            rules = self._load(directory)
+            chain = (*parent_chain, (directory, rules)) if rules else parent_chain
+            self._chains[directory] = chain
+        return chain
+
+    def _load(self, directory: str) -> list[IgnoreRule]:
+        if (rules := self._rules.get(directory)) is None:
+            rules = []
+            for file_name in self.file_names:
+                try:
+                    text = Path(directory, file_name).read_text(encoding="utf-8", errors="surrogateescape")
+                except (FileNotFoundError, NotADirectoryError, PermissionError):
+                    continue
+                rules.extend(parse_ignore_rules(text))
+            self._rules[directory] = rules
+        return rules
+
+
+@dataclass(frozen=True, slots=True)
+class ContentCacheEntry:
+    signature: tuple[int, int, int]
+    digest: tuple[int, int, int]
+    expires_at: float
+
+
 class ChangeCacheFilter(BaseFilter):
+    """Drops added/modified events of files whose content did not actually change.
+
+    A file is only hashed when its (size, mtime_ns, inode) differ from the cached entry, and
+    hashing streams the file through crc32 and adler32 in chunks. Entries are kept in update
+    order, so expired ones are dropped from the front in O(1) and at most ``max_entries`` are
+    kept. The filter is thread-safe, ``filter_changes`` runs it on a worker thread.
+    """
+
     CACHE_MAX_ALIVE_TIME = 1
+    CACHE_MAX_ENTRIES = 100_000
+    HASH_CHUNK_SIZE = 1024 * 1024
 
-    def __init__(self):
+    def __init__(self, *, ttl: float = CACHE_MAX_ALIVE_TIME, max_entries: int = CACHE_MAX_ENTRIES):
         super().__init__()
-        self.cache: dict[str, tuple[float, str]] = {}
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache: OrderedDict[str, ContentCacheEntry] = OrderedDict()
+        self._lock = threading.Lock()
 
     def __call__(self, change: Change, path: str) -> bool:
         match change:
             case Change.added | Change.modified:
                 return not self.lookup_cache(path)
             case Change.deleted:
+                with self._lock:
+                    self.cache.pop(path, None)
                 return True
 
-    def clean_dead_cache(self) -> None:
-        to_delete: list[str] = []
-        for path, (timestamp, _) in self.cache.items():
-            if time.time() - timestamp > self.CACHE_MAX_ALIVE_TIME:
-                to_delete.append(path)
-        for path in to_delete:
-            del self.cache[path]
+    async def filter_changes(self, changes: set[tuple[Change, str]]) -> set[tuple[Change, str]]:
+        """Filter a batch of changes without blocking the event loop on hashing."""
+        return await asyncio.to_thread(lambda: {(change, path) for change, path in changes if self(change, path)})
+
+    def clean_dead_cache(self, now: float) -> None:
+        while self.cache and (len(self.cache) > self.max_entries or next(iter(self.cache.values())).expires_at <= now):
+            self.cache.popitem(last=False)
 
     def lookup_cache(self, path: str) -> bool:
-        self.clean_dead_cache()
-        if path not in self.cache:
-            self.cache[path] = (time.time(), self.calc_file_md5(path))
-            return False
-        _, md5 = self.cache[path]
-        if md5 != self.calc_file_md5(path):
-            self.cache[path] = (time.time(), self.calc_file_md5(path))
+        """Whether ``path`` still has the content cached for it, refreshing the entry either way."""
+        try:
+            stat = Path(path).stat()
+        except OSError:
             return False
-        return True
+        signature = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        now = time.monotonic()
+        with self._lock:
+            self.clean_dead_cache(now)
+            entry = self.cache.pop(path, None)
+        if entry is not None and entry.signature == signature:
+            digest = entry.digest
+        else:
+            try:
+                digest = self.calc_file_digest(path)
+            except OSError:
+                return False
+        with self._lock:
+            self.cache[path] = ContentCacheEntry(signature, digest, now + self.ttl)
+            self.clean_dead_cache(now)
+        return entry is not None and entry.digest == digest
 
-    def calc_file_md5(self, path: str) -> str:
+    def calc_file_digest(self, path: str) -> tuple[int, int, int]:
+        size = crc = 0
+        adler = 1
         with Path(path).open("rb") as f:
-            return hashlib.md5(f.read()).hexdigest()
+            while chunk := f.read(self.HASH_CHUNK_SIZE):
+                size += len(chunk)
+                crc = zlib.crc32(chunk, crc)
+                adler = zlib.adler32(chunk, adler)
+        return size, crc, adler
 
 
 class CombinedFilter(BaseFilter):
@@ -105,3 +419,20 @@ class CombinedFilter(BaseFilter):
 
 def combine_filters(filters: list[BaseFilter]) -> BaseFilter:
     return CombinedFilter(filters)
+
+
+class MeasuredFilter(BaseFilter):
+    """Counts the changes ``filter`` drops and the time spent in it, for the metrics."""
+
+    def __init__(self, filter: BaseFilter):
+        self.filter = filter
+        self.dropped = 0
+        self.seconds = 0.0
+
+    def __call__(self, change: Change, path: str) -> bool:
+        started = time.perf_counter()
+        allowed = self.filter(change, path)
+        self.seconds += time.perf_counter() - started
+        if not allowed:
+            self.dropped += 1
+        return allowed
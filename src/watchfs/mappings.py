@@ -20,6 +20,10 @@ class LocalTargetSpec:
     def display(self) -> str:
         return str(self.path)
 
+    def names(self) -> set[str]:
+        """What options like ``--bwlimit TARGET=RATE`` may call this destination."""
+        return {self.display()}
+
 
 @dataclass(frozen=True, slots=True)
 class SshTargetSpec:
@@ -42,6 +46,9 @@ class SshTargetSpec:
     def credential_key(self) -> str:
         return f"{self.authority()}:{self.port}"
 
+    def names(self) -> set[str]:
+        return {self.display(), self.host, self.authority()}
+
 
 type TargetSpec = LocalTargetSpec | SshTargetSpec
 
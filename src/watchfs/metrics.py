@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import contextlib
+import os
+import tempfile
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Literal
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+type Labels = tuple[tuple[str, str], ...]
+type MetricType = Literal["counter", "gauge", "histogram"]
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+STATS_INTERVAL = 10.0
+HTTP_READ_TIMEOUT = 5.0
+
+DESCRIPTIONS: dict[str, tuple[MetricType, str]] = {
+    "watchfs_events_received_total": ("counter", "File system changes reported by the watcher."),
+    "watchfs_events_filtered_total": ("counter", "Changes dropped by a filter."),
+    "watchfs_filter_seconds_total": ("counter", "Time spent in filters."),
+    "watchfs_events_coalesced_total": ("counter", "Queued changes merged into a pending change of the same path."),
+    "watchfs_events_applied_total": ("counter", "Changes applied to a target."),
+    "watchfs_events_failed_total": ("counter", "Changes whose application failed, including ones retried later."),
+    "watchfs_queue_depth": ("gauge", "Changes waiting in a target queue."),
+    "watchfs_payload_bytes_total": ("counter", "Size of the changed data a target was asked to sync."),
+    "watchfs_sent_bytes_total": ("counter", "Bytes actually sent or written to a target."),
+    "watchfs_operation_seconds": ("histogram", "Duration of a batch of writes, removals, moves or rescans."),
+    "watchfs_sync_lag_seconds": ("histogram", "Time from the first unsynced change of a path until it was applied."),
+}
+
+
+@dataclass(slots=True)
+class Histogram:
+    buckets: tuple[float, ...]
+    counts: list[int] = field(init=False)
+    total: float = 0.0
+    count: int = 0
+
+    def __post_init__(self) -> None:
+        self.counts = [0] * len(self.buckets)
+
+    def observe(self, value: float) -> None:
+        # Cumulated when rendered, so an observation only touches its own bucket.
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    """Counters, gauges and histograms of the sync pipeline, rendered in the Prometheus text format.
+
+    Every metric is declared in ``DESCRIPTIONS`` and keyed by its labels. Gauges are callbacks
+    read when rendering, e.g. the length of a queue, so nothing has to keep them up to date.
+    """
+
+    def __init__(self) -> None:
+        self._counters: dict[tuple[str, Labels], float] = {}
+        self._histograms: dict[tuple[str, Labels], Histogram] = {}
+        self._gauges: dict[tuple[str, Labels], Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            if (histogram := self._histograms.get(key)) is None:
+                histogram = self._histograms[key] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(value)
+
+    def gauge(self, name: str, callback: Callable[[], float], **labels: str) -> None:
+        """Report ``callback()`` as the value of ``name``, for counters kept elsewhere too."""
+        with self._lock:
+            self._gauges[name, tuple(labels.items())] = callback
+
+    def value(self, name: str, **labels: str) -> float:
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            if (callback := self._gauges.get(key)) is not None:
+                return callback()
+            if (histogram := self._histograms.get(key)) is not None:
+                return histogram.count
+            return self._counters.get(key, 0.0)
+
+    def render(self) -> str:
+        samples: dict[str, list[str]] = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append(_sample(name, labels, value))
+            for (name, labels), callback in self._gauges.items():
+                samples.setdefault(name, []).append(_sample(name, labels, callback()))
+            for (name, labels), histogram in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts, strict=True):
+                    cumulative += count
+                    lines.append(_sample(f"{name}_bucket", (*labels, ("le", _format(bound))), cumulative))
+                lines.append(_sample(f"{name}_bucket", (*labels, ("le", "+Inf")), histogram.count))
+                lines.append(_sample(f"{name}_sum", labels, histogram.total))
+                lines.append(_sample(f"{name}_count", labels, histogram.count))
+        output: list[str] = []
+        for name, lines in samples.items():
+            kind, description = DESCRIPTIONS[name]
+            output.extend((f"# HELP {name} {description}", f"# TYPE {name} {kind}", *lines))
+        return "\n".join(output) + "\n"
+
+
+REGISTRY = Metrics()
+
+
+async def serve_metrics(metrics: Metrics, host: str, port: int) -> asyncio.Server:
+    """Serve ``GET /metrics`` over plain HTTP, for Prometheus to scrape."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HTTP_READ_TIMEOUT)
+            method, path, *_ = request.split(b"\r\n", 1)[0].decode("latin-1").split(" ")
+            if method == "GET" and path.split("?", 1)[0] in ("/", "/metrics"):
+                status, body = "200 OK", metrics.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (TimeoutError, ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+async def write_stats_periodically(metrics: Metrics, path: Path, interval: float = STATS_INTERVAL) -> None:
+    """Rewrite ``path`` with the rendered metrics every ``interval`` seconds, e.g. for node_exporter's textfile collector."""
+    while True:
+        await asyncio.to_thread(write_stats_file, metrics, path)
+        await asyncio.sleep(interval)
+
+
+def write_stats_file(metrics: Metrics, path: Path) -> None:
+    # Replaced atomically so a reader never sees a partial file.
+    fd, temp_name = tempfile.mkstemp(prefix=f".{path.name}.", dir=path.parent)
+    try:
+        with os.fdopen(fd, "w") as stream:
+            stream.write(metrics.render())
+        Path(temp_name).replace(path)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok=True)
+        raise
+
+
+def _sample(name: str, labels: Labels, value: float) -> str:
+    if not labels:
+        return f"{name} {_format(value)}"
+    rendered = ",".join(f'{key}="{_escape(label)}"' for key, label in labels)
+    return f"{name}{{{rendered}}} {_format(value)}"
+
+
+def _format(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import os
+import stat
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from watchfiles import Change
+
+if TYPE_CHECKING:
+    from watchfiles.filters import BaseFilter
+
+MAX_INDEXED_PATHS = 100_000
+
+
+@dataclass(frozen=True, slots=True)
+class PathIdentity:
+    device: int
+    inode: int
+    size: int
+    mtime_ns: int
+    is_dir: bool
+
+    @classmethod
+    def of(cls, path: Path) -> PathIdentity | None:
+        try:
+            result = path.lstat()
+        except OSError:
+            return None
+        return cls(result.st_dev, result.st_ino, result.st_size, result.st_mtime_ns, stat.S_ISDIR(result.st_mode))
+
+    def same_content(self, other: PathIdentity) -> bool:
+        """Whether ``other`` is this path after a rename, a directory's mtime changes with its entries."""
+        if (self.device, self.inode, self.is_dir) != (other.device, other.inode, other.is_dir):
+            return False
+        return self.is_dir or (self.size, self.mtime_ns) == (other.size, other.mtime_ns)
+
+
+class MoveDetector:
+    """Pairs the deletion and the addition that watchfiles reports for a rename.
+
+    The identity (inode, size, mtime) of every path found by ``index`` or that was added or
+    modified is kept, so when a batch deletes a known path and adds one with the same identity,
+    that is a move.
+    A move is not reported when the batch also changes the old path or anything below it,
+    in that case the destination may not hold what was moved.
+    """
+
+    def __init__(self, *, max_entries: int = MAX_INDEXED_PATHS) -> None:
+        self.max_entries = max_entries
+        self._identities: OrderedDict[Path, PathIdentity] = OrderedDict()
+        self._paths: dict[tuple[int, int], Path] = {}
+        self._lock = threading.Lock()
+
+    def index(self, root: Path, path_filter: BaseFilter | None = None) -> None:
+        """Record the identities of the paths already below ``root``, shallowest first. Blocking.
+
+        Stops once ``max_entries`` paths are known, and never replaces an identity recorded
+        from a change meanwhile, which is at least as recent.
+        """
+        directories = [root]
+        while directories:
+            next_level: list[Path] = []
+            for directory in directories:
+                try:
+                    with os.scandir(directory) as entries:
+                        found = [Path(entry.path) for entry in entries]
+                except OSError:
+                    continue
+                for path in found:
+                    if path_filter is not None and not path_filter(Change.added, str(path)):
+                        continue
+                    identity = PathIdentity.of(path)
+                    if identity is None:
+                        continue
+                    with self._lock:
+                        if len(self._identities) >= self.max_entries:
+                            return
+                        if path not in self._identities:
+                            self._remember(path, identity)
+                    if identity.is_dir:
+                        next_level.append(path)
+            directories = next_level
+
+    def update(self, changes: set[tuple[Change, str]]) -> list[tuple[Path, Path]]:
+        """Record the identities in a batch of changes and return its ``(old, new)`` moves. Blocking."""
+        deleted = {Path(path) for change, path in changes if change == Change.deleted}
+        added = {Path(path) for change, path in changes if change == Change.added}
+        changed = [Path(path) for change, path in changes if change != Change.deleted]
+        identities = {path: PathIdentity.of(path) for path in changed}
+        moves: list[tuple[Path, Path]] = []
+        with self._lock:
+            for path, identity in identities.items():
+                if identity is None or path not in added:
+                    continue
+                old_path = self._paths.get((identity.device, identity.inode))
+                if old_path is None or old_path not in deleted:
+                    continue
+                previous = self._identities.get(old_path)
+                if previous is None or not previous.same_content(identity):
+                    continue
+                if any(other == old_path or old_path in other.parents for other in changed):
+                    continue
+                moves.append((old_path, path))
+            for path in deleted:
+                self._forget(path)
+            for path, identity in identities.items():
+                if identity is not None:
+                    self._remember(path, identity)
+        return moves
+
+    def _remember(self, path: Path, identity: PathIdentity) -> None:
+        self._forget(path)
+        self._identities[path] = identity
+        self._paths[identity.device, identity.inode] = path
+        while len(self._identities) > self.max_entries:
+            old_path, old_identity = self._identities.popitem(last=False)
+            if self._paths.get((old_identity.device, old_identity.inode)) == old_path:
+                del self._paths[old_identity.device, old_identity.inode]
+
+    def _forget(self, path: Path) -> None:
+        identity = self._identities.pop(path, None)
+        if identity is not None and self._paths.get((identity.device, identity.inode)) == path:
+            del self._paths[identity.device, identity.inode]
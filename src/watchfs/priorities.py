@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import stat
+import threading
+import time
+from collections import OrderedDict
+from enum import IntEnum
+from typing import TYPE_CHECKING
+
+from watchfiles import Change
+
+from watchfs.filters import match_pattern
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Sequence
+    from pathlib import Path
+
+    from watchfs.mappings import TargetSpec
+
+SMALL_FILE_SIZE = 256 * 1024
+LARGE_FILE_SIZE = 64 * 1024 * 1024
+# A path changed again within this many seconds is being worked on.
+RECENT_EDIT_WINDOW = 60.0
+# A waiting change is handed out like one of the next more urgent class after this many seconds.
+PRIORITY_AGING = 10.0
+MAX_TRACKED_PATHS = 100_000
+
+
+class Priority(IntEnum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+class PriorityPolicy:
+    """Sorts changed paths into priority classes, see ``CoalescingQueue`` for how they are handed out.
+
+    The first of ``patterns`` that matches a path decides. Otherwise deletions are high, they
+    are cheap. So are files changed again within ``recent_edit_window`` of their last change,
+    unless they are large, someone is editing them. Other files go by size: small ones are
+    high, large ones low. Directories are normal, they may hold anything.
+    """
+
+    def __init__(
+        self,
+        patterns: Sequence[tuple[str, Priority]] = (),
+        *,
+        small_file_size: int = SMALL_FILE_SIZE,
+        large_file_size: int = LARGE_FILE_SIZE,
+        recent_edit_window: float = RECENT_EDIT_WINDOW,
+        max_entries: int = MAX_TRACKED_PATHS,
+    ) -> None:
+        self.patterns = patterns
+        self.small_file_size = small_file_size
+        self.large_file_size = large_file_size
+        self.recent_edit_window = recent_edit_window
+        self.max_entries = max_entries
+        self._changed_at: OrderedDict[Path, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def classify(self, changes: Iterable[tuple[Change, Path]]) -> dict[Path, Priority]:
+        """Return the class of every changed path. Blocking."""
+        now = time.monotonic()
+        priorities: dict[Path, Priority] = {}
+        for change, path in changes:
+            with self._lock:
+                previous = self._changed_at.pop(path, None)
+                self._changed_at[path] = now
+                if len(self._changed_at) > self.max_entries:
+                    self._changed_at.popitem(last=False)
+            recent = previous is not None and now - previous <= self.recent_edit_window
+            priorities[path] = self._classify(change, path, recent=recent)
+        return priorities
+
+    def _classify(self, change: Change, path: Path, *, recent: bool) -> Priority:
+        for pattern, priority in self.patterns:
+            if match_pattern(path, pattern):
+                return priority
+        if change == Change.deleted:
+            return Priority.HIGH
+        try:
+            result = path.stat()
+        except OSError:
+            # Gone again, syncing it is as cheap as a deletion.
+            return Priority.HIGH
+        if stat.S_ISDIR(result.st_mode):
+            return Priority.NORMAL
+        if result.st_size >= self.large_file_size:
+            return Priority.LOW
+        if recent or result.st_size <= self.small_file_size:
+            return Priority.HIGH
+        return Priority.NORMAL
+
+
+def parse_priority(text: str) -> Priority:
+    try:
+        return Priority[text.strip().upper()]
+    except KeyError:
+        raise ValueError(f"Invalid priority {text!r}, expected high, normal or low") from None
+
+
+def parse_priority_rule(text: str) -> tuple[str, Priority]:
+    """Parse ``PATTERN=CLASS`` or ``TARGET=CLASS`` as given to ``--priority`` and ``--target-priority``."""
+    name, separator, priority = text.rpartition("=")
+    if not separator or not name:
+        raise ValueError(f"Invalid priority rule {text!r}, expected e.g. '*.py=high'")
+    return name, parse_priority(priority)
+
+
+def priority_for(spec: TargetSpec, rules: Sequence[tuple[str, Priority]]) -> Priority | None:
+    """The class of the last of ``rules`` naming ``spec``, ``None`` to classify its changes one by one."""
+    names = spec.names()
+    matched = [priority for target, priority in rules if target in names]
+    return matched[-1] if matched else None
@@ -0,0 +1,382 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import time
+from collections import Counter, OrderedDict
+from typing import TYPE_CHECKING
+
+from watchfiles import Change
+
+from watchfs.events import coalesce_changes
+from watchfs.priorities import Priority
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from watchfs.events import SyncEvent
+    from watchfs.mappings import SyncMapping
+
+
+type PathKey = tuple[SyncMapping, Path]
+# Moves are keyed by both of their paths, so they never coalesce with plain events.
+type QueueKey = tuple[SyncMapping, Path, Path | None]
+
+
+class CoalescingQueue:
+    """A FIFO of sync events that keeps only the latest pending state per path.
+
+    A new event for a path that is still pending is merged with it (see ``coalesce_changes``)
+    and moved to the back, so it is ordered after anything queued in between. With a
+    ``debounce`` window an entry is only handed out once its path has been quiet that long.
+    A failed event is not handed out again before its ``retry_at``.
+
+    Several workers may consume the queue. An entry is held back while an event for the same
+    path, one of its ancestors or one of its descendants is being applied, and also while an
+    earlier such entry is held back, so overlapping paths are applied in queue order and
+    unrelated ones in parallel. Workers report completion with ``task_done(event)``.
+
+    Entries are handed out by the ``priority`` of their event, most urgent class first and in
+    queue order within a class. With ``aging``, every ``aging`` seconds an entry waits make
+    it as urgent as one of the next class, so low priority work keeps moving. An entry never
+    overtakes an earlier one of an overlapping path, whatever their classes.
+
+    With a ``limit``, a queue that grows past it collapses the pending events below a common
+    directory into a single ``rescan`` event for that directory, starting with the deepest
+    directory that frees enough entries, until it is back at ``LOW_WATER`` of the limit.
+    Later events below a pending rescan are absorbed by it, so memory stays flat however
+    long the destination is unavailable. Rescans are low priority.
+    """
+
+    # How far past held-back entries ``get`` looks for one that can be handed out.
+    SCAN_LIMIT = 1024
+    # Share of ``limit`` a collapse goes down to, so the next one is some way off.
+    LOW_WATER = 0.75
+
+    def __init__(self, *, debounce: float = 0.0, limit: int | None = None, aging: float | None = None) -> None:
+        self.debounce = debounce
+        self.limit = limit
+        self.aging = aging
+        self.coalesced = 0
+        self.collapsed = 0
+        self._pending: OrderedDict[QueueKey, tuple[SyncEvent, float]] = OrderedDict()
+        # The pending keys per class in queue order, with their position in the whole queue.
+        self._classes: dict[Priority, OrderedDict[QueueKey, int]] = {}
+        # The pending paths per class, only built once a class has to be checked for overlaps.
+        self._class_paths: dict[Priority, SubtreeSet] = {}
+        self._first_position = 0
+        self._last_position = 0
+        self._rescans: set[PathKey] = set()
+        self._roots: dict[SyncMapping, Path] = {}
+        self._in_flight = SubtreeSet()
+        self._unfinished = 0
+        self._changed = asyncio.Event()
+
+    def qsize(self) -> int:
+        return len(self._pending)
+
+    def empty(self) -> bool:
+        return not self._pending
+
+    def has_pending(self, mapping: SyncMapping, path: Path) -> bool:
+        """Whether an event for ``path``, one of its ancestors or descendants is waiting to be handed out."""
+        return any(self._paths_of(priority).overlaps((mapping, path)) for priority in self._classes)
+
+    def put_nowait(self, event: SyncEvent) -> None:
+        if self._rescans and all(self._is_rescanned(path_key) for path_key in _path_keys(event)):
+            self.coalesced += 1
+            return
+        key = (event.job.mapping, event.path, event.moved_from)
+        if (previous := self._remove(key)) is not None:
+            self.coalesced += 1
+            change = coalesce_changes(previous[0].change, event.change)
+            if change is None:
+                return
+            event = dataclasses.replace(event, change=change, observed_at=previous[0].observed_at)
+        self._insert(key, event, time.monotonic())
+        if self.limit is not None and len(self._pending) > self.limit:
+            self._collapse(event)
+        self._changed.set()
+
+    async def put(self, event: SyncEvent) -> None:
+        self.put_nowait(event)
+
+    def requeue(self, events: list[SyncEvent]) -> None:
+        """Put events that failed back in front, before ``task_done`` is called for them.
+
+        They keep their order ahead of anything queued since. A pending event for the same
+        path is merged as the later change, and an addition counts as a modification since
+        the failed attempt may have left part of it at the destination.
+        """
+        for event in reversed(events):
+            if self._rescans and all(self._is_rescanned(path_key) for path_key in _path_keys(event)):
+                continue
+            if event.change == Change.added:
+                event = dataclasses.replace(event, change=Change.modified)
+            key = (event.job.mapping, event.path, event.moved_from)
+            if (pending := self._remove(key)) is not None:
+                change = coalesce_changes(event.change, pending[0].change)
+                if change is None:
+                    continue
+                event = dataclasses.replace(
+                    pending[0],
+                    change=change,
+                    attempts=event.attempts,
+                    retry_at=event.retry_at,
+                    observed_at=event.observed_at,
+                )
+            self._insert(key, event, 0.0, front=True)
+            if event.rescan:
+                self._rescans.add(key[:2])
+        if self.limit is not None and len(self._pending) > self.limit and events:
+            self._collapse(events[-1])
+        self._changed.set()
+
+    def get_nowait(self) -> SyncEvent:
+        event, _ = self._take()
+        if event is None:
+            raise asyncio.QueueEmpty
+        return event
+
+    async def get(self) -> SyncEvent:
+        while True:
+            self._changed.clear()
+            event, wait = self._take()
+            if event is not None:
+                return event
+            try:
+                await asyncio.wait_for(self._changed.wait(), None if wait == float("inf") else wait)
+            except TimeoutError:
+                pass
+
+    def task_done(self, event: SyncEvent) -> None:
+        if self._unfinished <= 0:
+            raise ValueError("task_done() called too many times")
+        self._unfinished -= 1
+        for key in _path_keys(event):
+            self._in_flight.discard(key)
+        self._changed.set()
+
+    def _take(self) -> tuple[SyncEvent | None, float]:
+        """Pop the first entry of the most urgent class that may be handed out, else return how long until one is ready."""
+        now = time.monotonic()
+        wait = float("inf")
+        for priority in sorted(self._classes, key=lambda priority: self._urgency(priority, now)):
+            event, class_wait = self._take_from(priority, now)
+            if event is not None:
+                return event, 0.0
+            wait = min(wait, class_wait)
+        return None, wait
+
+    def _urgency(self, priority: Priority, now: float) -> float:
+        if self.aging is None:
+            return priority
+        _, updated_at = self._pending[next(iter(self._classes[priority]))]
+        return priority - (now - updated_at) / self.aging
+
+    def _take_from(self, priority: Priority, now: float) -> tuple[SyncEvent | None, float]:
+        held_back = SubtreeSet()
+        retry_wait = float("inf")
+        for scanned, (key, position) in enumerate(self._classes[priority].items()):
+            event, updated_at = self._pending[key]
+            # Entries are in update order, so once one is still debouncing all later ones are too.
+            if (wait := updated_at + self.debounce - now) > 0:
+                return None, min(wait, retry_wait)
+            if scanned >= self.SCAN_LIMIT:
+                break
+            path_keys = _path_keys(event)
+            if event.retry_at > now:
+                retry_wait = min(retry_wait, event.retry_at - now)
+                for path_key in path_keys:
+                    held_back.add(path_key)
+                continue
+            if any(
+                self._in_flight.overlaps(path_key) or held_back.overlaps(path_key) for path_key in path_keys
+            ) or self._behind_other_class(priority, position, path_keys):
+                for path_key in path_keys:
+                    held_back.add(path_key)
+                continue
+            self._remove(key)
+            if event.rescan:
+                self._rescans.discard(path_keys[0])
+            for path_key in path_keys:
+                self._in_flight.add(path_key)
+            self._unfinished += 1
+            return event, 0.0
+        return None, retry_wait
+
+    def _behind_other_class(self, priority: Priority, position: int, path_keys: list[PathKey]) -> bool:
+        """Whether an entry of another class that was queued before ``position`` overlaps ``path_keys``."""
+        for other, entries in self._classes.items():
+            # Cheap check first, most of the time all entries of a less urgent class came later.
+            if other == priority or next(iter(entries.values())) > position:
+                continue
+            paths = self._paths_of(other)
+            if not any(paths.overlaps(path_key) for path_key in path_keys):
+                continue
+            for scanned, (key, other_position) in enumerate(self._classes[other].items()):
+                if other_position > position:
+                    break
+                if scanned >= self.SCAN_LIMIT:
+                    return True
+                other_keys = _path_keys(self._pending[key][0])
+                if any(_overlap(a, b) for a in path_keys for b in other_keys):
+                    return True
+        return False
+
+    def _insert(self, key: QueueKey, event: SyncEvent, updated_at: float, *, front: bool = False) -> None:
+        self._pending[key] = (event, updated_at)
+        entries = self._classes.setdefault(event.priority, OrderedDict())
+        if front:
+            self._first_position -= 1
+            entries[key] = self._first_position
+            self._pending.move_to_end(key, last=False)
+            entries.move_to_end(key, last=False)
+        else:
+            self._last_position += 1
+            entries[key] = self._last_position
+        if (paths := self._class_paths.get(event.priority)) is not None:
+            for path_key in _path_keys(event):
+                paths.add(path_key)
+
+    def _remove(self, key: QueueKey) -> tuple[SyncEvent, float] | None:
+        entry = self._pending.pop(key, None)
+        if entry is None:
+            return None
+        event = entry[0]
+        entries = self._classes[event.priority]
+        del entries[key]
+        if not entries:
+            del self._classes[event.priority]
+            self._class_paths.pop(event.priority, None)
+        elif (paths := self._class_paths.get(event.priority)) is not None:
+            for path_key in _path_keys(event):
+                paths.discard(path_key)
+        return entry
+
+    def _paths_of(self, priority: Priority) -> SubtreeSet:
+        if (paths := self._class_paths.get(priority)) is None:
+            paths = self._class_paths[priority] = SubtreeSet()
+            for key in self._classes[priority]:
+                for path_key in _path_keys(self._pending[key][0]):
+                    paths.add(path_key)
+        return paths
+
+    def _collapse(self, event: SyncEvent) -> None:
+        assert self.limit is not None
+        low_water = int(self.limit * self.LOW_WATER)
+        mapping = event.job.mapping
+        root = self._root(mapping)
+        # Collapsing k entries into one rescan removes k - 1 of them.
+        needed = len(self._pending) - low_water + 1
+        candidates = [parent for parent in event.path.parents if parent == root or root in parent.parents]
+        counts: Counter[Path] = Counter()
+        for pending, _ in self._pending.values():
+            if pending.job.mapping == mapping:
+                counts.update(_covering_directories(pending).intersection(candidates))
+        directory = next((candidate for candidate in candidates if counts[candidate] >= needed), root)
+        self._replace_with_rescan(event, directory)
+        # Even the whole source was not enough, so the other mappings sharing this queue follow.
+        per_mapping = Counter(pending.job.mapping for pending, _ in self._pending.values() if not pending.rescan)
+        for other_mapping, _ in per_mapping.most_common():
+            if len(self._pending) <= low_water:
+                break
+            other = next(pending for pending, _ in self._pending.values() if pending.job.mapping == other_mapping)
+            self._replace_with_rescan(other, self._root(other_mapping))
+
+    def _replace_with_rescan(self, event: SyncEvent, directory: Path) -> None:
+        mapping = event.job.mapping
+        observed_at = event.observed_at
+        for key, (pending, _) in list(self._pending.items()):
+            if pending.job.mapping == mapping and directory in _covering_directories(pending):
+                self._remove(key)
+                self._rescans.discard((mapping, pending.path))
+                self.collapsed += 1
+                observed_at = min(observed_at, pending.observed_at)
+        rescan = dataclasses.replace(
+            event,
+            change=Change.modified,
+            path=directory,
+            moved_from=None,
+            rescan=True,
+            observed_at=observed_at,
+            priority=Priority.LOW,
+        )
+        self._insert((mapping, directory, None), rescan, time.monotonic())
+        self._rescans.add((mapping, directory))
+
+    def _is_rescanned(self, key: PathKey) -> bool:
+        mapping, path = key
+        return key in self._rescans or any((mapping, parent) in self._rescans for parent in path.parents)
+
+    def _root(self, mapping: SyncMapping) -> Path:
+        if (root := self._roots.get(mapping)) is None:
+            root = self._roots[mapping] = mapping.source.resolve()
+        return root
+
+
+class SubtreeSet:
+    """A multiset of paths that tells whether a path overlaps any of them.
+
+    Two paths overlap when they are equal or one is an ancestor of the other. Paths are
+    keyed per mapping, paths of different mappings never overlap.
+    """
+
+    def __init__(self) -> None:
+        self._paths: Counter[PathKey] = Counter()
+        self._ancestors: Counter[PathKey] = Counter()
+
+    def __bool__(self) -> bool:
+        return bool(self._paths)
+
+    def add(self, key: PathKey) -> None:
+        mapping, path = key
+        self._paths[key] += 1
+        for parent in path.parents:
+            self._ancestors[mapping, parent] += 1
+
+    def discard(self, key: PathKey) -> None:
+        if key not in self._paths:
+            return
+        mapping, path = key
+        _decrement(self._paths, key)
+        for parent in path.parents:
+            _decrement(self._ancestors, (mapping, parent))
+
+    def overlaps(self, key: PathKey) -> bool:
+        if not self._paths:
+            return False
+        mapping, path = key
+        return (
+            key in self._paths
+            or key in self._ancestors
+            or any((mapping, parent) in self._paths for parent in path.parents)
+        )
+
+
+def _path_keys(event: SyncEvent) -> list[PathKey]:
+    keys = [(event.job.mapping, event.path)]
+    if event.moved_from is not None:
+        keys.append((event.job.mapping, event.moved_from))
+    return keys
+
+
+def _overlap(first: PathKey, second: PathKey) -> bool:
+    (first_mapping, first_path), (second_mapping, second_path) = first, second
+    return first_mapping == second_mapping and (
+        first_path == second_path or first_path in second_path.parents or second_path in first_path.parents
+    )
+
+
+def _covering_directories(event: SyncEvent) -> set[Path]:
+    """The paths a rescan may be of to cover ``event``, i.e. its path and ancestors, for a move those of both paths."""
+    covering = {event.path, *event.path.parents}
+    if event.moved_from is not None:
+        covering.intersection_update({event.moved_from, *event.moved_from.parents})
+    return covering
+
+
+def _decrement(counter: Counter[PathKey], key: PathKey) -> None:
+    counter[key] -= 1
+    if counter[key] <= 0:
+        del counter[key]
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+from pathlib import PurePosixPath
+from typing import TYPE_CHECKING
+
+from watchfiles import Change
+
+from watchfs.events import SyncEvent
+from watchfs.priorities import Priority
+from watchfs.scan import iterate_in_thread, walk_files
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+    from pathlib import Path
+
+    from watchfiles.filters import BaseFilter
+
+    from watchfs.events import SyncJob
+    from watchfs.queues import CoalescingQueue
+    from watchfs.scan import FileState
+
+# Stop feeding the queue while it holds this many entries, so memory stays flat on huge trees.
+QUEUE_HIGH_WATER = 10000
+QUEUE_POLL_INTERVAL = 0.05
+
+
+@dataclass(slots=True)
+class ReconcileStats:
+    written: int = 0
+    deleted: int = 0
+    unchanged: int = 0
+
+
+def is_outdated(source: FileState, destination: FileState, *, newer_only: bool = False) -> bool:
+    if newer_only:
+        return int(source.mtime) > int(destination.mtime)
+    return source.size != destination.size or int(source.mtime) != int(destination.mtime)
+
+
+async def reconcile_job(
+    job: SyncJob,
+    queue: CoalescingQueue,
+    *,
+    path_filter: BaseFilter | None = None,
+    delete: bool = False,
+    newer_only: bool = False,
+) -> ReconcileStats:
+    """Queue every file that differs between the source of ``job`` and its destination.
+
+    Both sides are listed in sorted order and merge-joined, so neither listing is ever held
+    in memory. Files only present at the destination are queued for removal when ``delete``
+    is set. ``newer_only`` only overwrites destination files older than the source, which
+    keeps both directions of a bidirectional mapping from overwriting each other.
+
+    When the job has a complete state index, the source is compared to the index instead of
+    listing the destination, and files that were synced before but are gone from the source
+    are always removed. Otherwise the files found up to date are recorded in the index.
+    """
+    src_dir = job.mapping.source.resolve()
+    stats = ReconcileStats()
+    state = job.state
+    from_index = state is not None and state.complete
+    sources = aiter(iterate_in_thread(walk_files(src_dir, path_filter)))
+    if from_index:
+        assert state is not None
+        destinations = aiter(iterate_in_thread(state.iter_files()))
+    else:
+        destinations = aiter(job.target.list_files())
+    async for source, destination in merge_join(sources, destinations):
+        if destination is None:
+            assert source is not None
+            await _enqueue(queue, job, Change.modified, src_dir / source.path)
+            stats.written += 1
+        elif source is None:
+            path = src_dir / destination.path
+            if (delete or from_index) and (path_filter is None or path_filter(Change.deleted, str(path))):
+                await _enqueue(queue, job, Change.deleted, path)
+                stats.deleted += 1
+        # The index holds the exact source state that was synced, so any difference counts.
+        elif source != destination if from_index else is_outdated(source, destination, newer_only=newer_only):
+            await _enqueue(queue, job, Change.modified, src_dir / source.path)
+            stats.written += 1
+        else:
+            if state is not None and not from_index:
+                state.record([source])
+            stats.unchanged += 1
+    if state is not None and not from_index:
+        state.mark_complete()
+    return stats
+
+
+async def diff_subtree(job: SyncJob, path: Path) -> AsyncIterator[tuple[Change, Path]]:
+    """Yield what to write (``modified``) and remove (``deleted``) to bring the destination's copy of ``path`` up to date.
+
+    Like ``reconcile_job`` but limited to one directory of the source and always comparing
+    against the destination itself, for resyncing a subtree whose changes were not tracked.
+    For a bidirectional job nothing is removed and only files older than the source are
+    written, as in the initial sync, since the other side may have changed them meanwhile.
+    """
+    src_dir = job.mapping.source.resolve()
+    relative_path = path.relative_to(src_dir)
+    prefix = f"{PurePosixPath(*relative_path.parts)}/"
+    sources = aiter(iterate_in_thread(walk_files(path, job.path_filter, prefix)))
+    async for source, destination in merge_join(sources, aiter(job.target.list_files(relative_path))):
+        if source is None:
+            assert destination is not None
+            removed = src_dir / destination.path
+            if not job.bidirectional and (job.path_filter is None or job.path_filter(Change.deleted, str(removed))):
+                yield Change.deleted, removed
+        elif destination is None or is_outdated(source, destination, newer_only=job.bidirectional):
+            yield Change.modified, src_dir / source.path
+
+
+async def merge_join(
+    sources: AsyncIterator[FileState], destinations: AsyncIterator[FileState]
+) -> AsyncIterator[tuple[FileState | None, FileState | None]]:
+    """Pair up two listings sorted by path, ``None`` stands for a path missing on that side."""
+    source = await anext(sources, None)
+    destination = await anext(destinations, None)
+    while source is not None or destination is not None:
+        if destination is None or (source is not None and source.path < destination.path):
+            yield source, None
+            source = await anext(sources, None)
+        elif source is None or destination.path < source.path:
+            yield None, destination
+            destination = await anext(destinations, None)
+        else:
+            yield source, destination
+            source = await anext(sources, None)
+            destination = await anext(destinations, None)
+
+
+async def _enqueue(queue: CoalescingQueue, job: SyncJob, change: Change, path: Path) -> None:
+    # Leave headroom below a bounded queue's limit, so the initial sync never makes it overflow.
+    high_water = QUEUE_HIGH_WATER if queue.limit is None else min(QUEUE_HIGH_WATER, queue.limit // 2)
+    while queue.qsize() >= high_water:
+        await asyncio.sleep(QUEUE_POLL_INTERVAL)
+    # Catching up in bulk, so it gives way to what is being edited meanwhile.
+    priority = Priority.LOW if job.priority is None else job.priority
+    await queue.put(SyncEvent(job=job, change=change, path=path, priority=priority))
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import os
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from watchfiles import Change
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Iterator
+    from pathlib import Path
+
+    from watchfiles.filters import BaseFilter
+
+SCAN_CHUNK_SIZE = 1024
+
+
+@dataclass(frozen=True, slots=True)
+class FileState:
+    """A regular file below a sync root, ``path`` is relative and uses ``/`` separators."""
+
+    path: str
+    size: int
+    mtime: float
+
+
+def walk_files(root: Path, path_filter: BaseFilter | None = None, prefix: str = "") -> Iterator[FileState]:
+    """Yield every regular file below ``root`` in byte-wise sorted path order.
+
+    Only the entries of the directories on the current path are held in memory, so the walk
+    streams through arbitrarily large trees. Directories rejected by ``path_filter`` are pruned.
+    The order matches ``LC_ALL=C sort`` on the relative paths, which lets callers merge-join
+    two walks without materializing either of them. ``prefix`` is prepended to every path,
+    e.g. ``"sub/"`` to walk a subdirectory with paths relative to its parent.
+    """
+    stack = [iter(_sorted_entries(root))]
+    prefixes = [prefix]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            prefixes.pop()
+            continue
+        if path_filter is not None and not path_filter(Change.added, entry.path):
+            continue
+        relative_path = prefixes[-1] + entry.name
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(iter(_sorted_entries(entry.path)))
+                prefixes.append(f"{relative_path}/")
+            elif entry.is_file():
+                stat = entry.stat()
+                yield FileState(relative_path, stat.st_size, stat.st_mtime)
+        except FileNotFoundError:
+            continue
+
+
+def iter_file_paths(root: Path, path_filter: BaseFilter | None = None) -> Iterator[str]:
+    """Yield the relative paths of the regular files below ``root`` in no particular order.
+
+    Unlike ``walk_files`` this neither sorts nor stats the files, the type reported by
+    ``os.scandir`` is enough to tell files from directories.
+    """
+    stack: list[tuple[str, str | Path]] = [("", root)]
+    while stack:
+        prefix, directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if path_filter is not None and not path_filter(Change.added, entry.path):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((f"{prefix}{entry.name}/", entry.path))
+                        elif entry.is_file():
+                            yield prefix + entry.name
+                    except OSError:
+                        continue
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+
+
+def _sorted_entries(path: str | Path) -> list[os.DirEntry[str]]:
+    try:
+        with os.scandir(path) as entries:
+            return sorted(entries, key=_sort_key)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+
+
+def _sort_key(entry: os.DirEntry[str]) -> str:
+    # A directory sorts as if it were its contents, i.e. "name/..." ("-" < "/" < "0").
+    try:
+        return f"{entry.name}/" if entry.is_dir(follow_symlinks=False) else entry.name
+    except OSError:
+        return entry.name
+
+
+async def iterate_in_thread[T](iterator: Iterator[T], chunk_size: int = SCAN_CHUNK_SIZE) -> AsyncIterator[T]:
+    """Drive a blocking iterator from a worker thread, ``chunk_size`` items at a time."""
+
+    # A closure rather than a generic helper, type checkers do not carry ``T`` through ``to_thread``.
+    def take() -> list[T]:
+        return list(itertools.islice(iterator, chunk_size))
+
+    while True:
+        chunk = await asyncio.to_thread(take)
+        for item in chunk:
+            yield item
+        if len(chunk) < chunk_size:
+            return
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import re
+import threading
+import time
+from typing import IO, TYPE_CHECKING
+
+from watchfs.mappings import SshTargetSpec
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+    from watchfs.mappings import TargetSpec
+
+# Every write is paced in pieces of this size, so streams sharing a bucket take turns quickly.
+SHAPING_CHUNK_SIZE = 64 * 1024
+# How much may be sent at once after an idle period, in seconds at the full rate.
+BURST_SECONDS = 0.1
+
+_RATE_RE = re.compile(r"(?P<number>\d+(?:\.\d+)?)\s*(?P<unit>[kmgt]?)i?b?(?:/s)?", re.IGNORECASE)
+_UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+
+class TokenBucket:
+    """Paces writes to ``rate`` bytes per second, shared by any number of threads.
+
+    Each write reserves its slot in arrival order (GCRA, a token bucket that keeps time
+    instead of tokens), so the streams sharing a bucket are served in turn, one piece
+    each. A small file queued behind a bulk upload waits for one piece of it, not all.
+    """
+
+    def __init__(self, rate: float, burst: float | None = None) -> None:
+        if rate <= 0:
+            raise ValueError(f"Rate must be positive, got {rate}")
+        self.rate = rate
+        self.burst = burst if burst is not None else max(SHAPING_CHUNK_SIZE, rate * BURST_SECONDS)
+        # When everything reserved so far has been paid for at ``rate``.
+        self._paid_until = 0.0
+        self._lock = threading.Lock()
+
+    def consume(self, size: int) -> None:
+        """Wait until ``size`` bytes may be sent. Blocking."""
+        with self._lock:
+            now = time.monotonic()
+            self._paid_until = max(self._paid_until, now) + size / self.rate
+            delay = self._paid_until - self.burst / self.rate - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ShapedWriter:
+    """A write-only stream that passes everything to ``raw`` at the pace of all ``buckets``."""
+
+    def __init__(self, raw: IO[bytes], buckets: Sequence[TokenBucket]) -> None:
+        self.raw = raw
+        self.buckets = buckets
+
+    def write(self, data: bytes | bytearray | memoryview) -> int:
+        view = memoryview(data)
+        for offset in range(0, len(view), SHAPING_CHUNK_SIZE):
+            piece = view[offset : offset + SHAPING_CHUNK_SIZE]
+            for bucket in self.buckets:
+                bucket.consume(len(piece))
+            self.raw.write(piece)
+        return len(view)
+
+    def flush(self) -> None:
+        self.raw.flush()
+
+    def close(self) -> None:
+        self.raw.close()
+
+
+def shaped(raw: IO[bytes], buckets: Sequence[TokenBucket]) -> IO[bytes] | ShapedWriter:
+    return ShapedWriter(raw, buckets) if buckets else raw
+
+
+def parse_rate(text: str) -> float:
+    """Parse a byte rate like ``512K``, ``10M`` or ``1.5MiB/s``, units are powers of 1024."""
+    matched = _RATE_RE.fullmatch(text.strip())
+    if matched is None or float(matched.group("number")) <= 0:
+        raise ValueError(f"Invalid rate {text!r}, expected e.g. 512K or 10M")
+    return float(matched.group("number")) * _UNITS[matched.group("unit").lower()]
+
+
+def parse_bandwidth_limit(text: str) -> tuple[str | None, float]:
+    """Parse ``RATE`` or ``TARGET=RATE`` as given to ``--bwlimit``."""
+    target, separator, rate = text.rpartition("=")
+    return (target if separator else None), parse_rate(rate)
+
+
+def buckets_for(
+    spec: TargetSpec, limits: Sequence[tuple[str | None, float]], shared: TokenBucket | None = None
+) -> tuple[TokenBucket, ...]:
+    """The buckets uploads to ``spec`` are paced by, a new one for its limit and ``shared``.
+
+    The last of ``limits`` naming ``spec`` by host or as displayed applies, else the last one
+    without a target. Local destinations are never paced.
+    """
+    if not isinstance(spec, SshTargetSpec):
+        return ()
+    names = spec.names()
+    rates = [rate for target, rate in limits if target in names] or [rate for target, rate in limits if target is None]
+    buckets = [TokenBucket(rates[-1])] if rates else []
+    if shared is not None:
+        buckets.append(shared)
+    return tuple(buckets)
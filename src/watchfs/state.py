@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path, PurePosixPath
+from typing import TYPE_CHECKING
+
+from watchfs.scan import FileState
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+    from pathlib import PurePath
+
+    from watchfs.mappings import SyncMapping
+
+# Pending updates are written in one transaction at most this often, see ``flush``.
+FLUSH_INTERVAL = 1.0
+READ_CHUNK_SIZE = 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID;
+"""
+
+type _Update = tuple[str, tuple[object, ...]]
+
+
+class SyncStateIndex:
+    """The size and mtime of every source file as it was last synced to one destination.
+
+    Stored in SQLite in WAL mode, so the index survives a crash in the state of its last
+    committed transaction. Entries are only recorded after the destination confirmed the
+    write, and updates are buffered and committed in batches by ``flush``. Losing the last
+    batch only means those files are compared, and copied, again on the next start.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'complete'").fetchone()
+        # Whether the index covers the whole destination, i.e. a full reconcile finished once.
+        self.complete = row is not None
+        self._pending: list[_Update] = []
+        self._lock = threading.Lock()
+        # Held for a whole flush, so batches are committed in the order they were taken.
+        self._flush_lock = threading.Lock()
+
+    @classmethod
+    def for_mapping(cls, state_dir: Path, mapping: SyncMapping) -> SyncStateIndex:
+        key = f"{mapping.source.resolve()} -> {mapping.target.display()}"
+        index = cls(state_dir / f"{hashlib.sha256(key.encode()).hexdigest()[:16]}.sqlite3")
+        index._update("INSERT OR REPLACE INTO meta VALUES ('mapping', ?)", key)
+        return index
+
+    def record(self, states: Iterable[FileState]) -> None:
+        for state in states:
+            if _is_encodable(state.path):
+                self._update("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", state.path, state.size, state.mtime)
+
+    def remove(self, relative_path: PurePath) -> None:
+        """Forget ``relative_path`` and everything below it."""
+        path = _index_path(relative_path)
+        self._update("DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)", path, f"{path}/", f"{path}0")
+
+    def move(self, old_path: PurePath, new_path: PurePath) -> None:
+        old, new = _index_path(old_path), _index_path(new_path)
+        self.remove(new_path)
+        self._update(
+            "UPDATE files SET path = ? || substr(path, ?) WHERE path = ? OR (path >= ? AND path < ?)",
+            new,
+            len(old) + 1,
+            old,
+            f"{old}/",
+            f"{old}0",
+        )
+
+    def mark_complete(self) -> None:
+        self.complete = True
+        self._update("INSERT OR REPLACE INTO meta VALUES ('complete', '1')")
+
+    def flush(self) -> None:
+        """Commit the pending updates in one transaction. Blocking."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            connection = self._connection
+            connection.execute("BEGIN")
+            try:
+                for statement, parameters in pending:
+                    connection.execute(statement, parameters)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def iter_files(self) -> Iterator[FileState]:
+        """Yield the recorded files sorted like ``walk_files``, from a snapshot taken at the first item. Blocking."""
+        self.flush()
+        # A connection of its own, so the read transaction is isolated from concurrent flushes.
+        connection = sqlite3.connect(self.path)
+        try:
+            cursor = connection.execute("SELECT path, size, mtime FROM files ORDER BY path")
+            while rows := cursor.fetchmany(READ_CHUNK_SIZE):
+                for path, size, mtime in rows:
+                    yield FileState(path, size, mtime)
+        finally:
+            connection.close()
+
+    def close(self) -> None:
+        self.flush()
+        self._connection.close()
+
+    def _update(self, statement: str, *parameters: object) -> None:
+        with self._lock:
+            self._pending.append((statement, parameters))
+
+
+def collect_states(files: Iterable[tuple[PurePath, Path]], states: list[FileState]) -> Iterator[tuple[PurePath, Path]]:
+    """Pass ``files`` through, appending the state of each file to ``states`` before it is written."""
+    for relative_path, source in files:
+        try:
+            stat = source.stat()
+        except OSError:
+            pass
+        else:
+            states.append(FileState(_index_path(relative_path), stat.st_size, stat.st_mtime))
+        yield relative_path, source
+
+
+def _index_path(relative_path: PurePath) -> str:
+    return PurePosixPath(*relative_path.parts).as_posix()
+
+
+def _is_encodable(path: str) -> bool:
+    # Undecodable file names come back from the OS as lone surrogates, which SQLite cannot store.
+    try:
+        path.encode()
+    except UnicodeEncodeError:
+        return False
+    return True
@@ -1,36 +1,136 @@
 from __future__ import annotations
 
 import asyncio
+import contextlib
+import itertools
+import os
+import random
 import shlex
 import shutil
 import subprocess
+import sys
+import tarfile
+import tempfile
+import time
 from dataclasses import dataclass, field
 from pathlib import Path, PurePath, PurePosixPath
-from typing import IO, Protocol
+from typing import IO, TYPE_CHECKING, Protocol, cast
 
 from aiofiles.os import wrap
 
+from watchfs.agent import AgentClient, agent_command
+from watchfs.appends import Append, AppendTracker, append_local_file
+from watchfs.compression import MAGIC_SIZE, AdaptiveLevel, CompressingWriter, TransferStats, is_incompressible
+from watchfs.delta import (
+    DELTA_MIN_SIZE,
+    SSH_ERROR_EXIT_CODE,
+    choose_block_size,
+    delta_remote_command,
+    transfer_delta_sync,
+)
+from watchfs.exceptions import TargetUnavailableError
+from watchfs.fanout import open_changed_file
+from watchfs.fastcopy import copy_file, stream_file
 from watchfs.mappings import LocalTargetSpec, SshTargetSpec, TargetSpec
-
-copyfile = wrap(shutil.copyfile)
+from watchfs.scan import FileState, iterate_in_thread, walk_files
+from watchfs.shaping import SHAPING_CHUNK_SIZE, shaped
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Callable, Iterable, Iterator, Sequence
+
+    from watchfs.echoes import EchoSuppressor
+    from watchfs.fanout import SharedReader
+    from watchfs.shaping import TokenBucket
+
+    # Opens a source file for reading, e.g. ``SharedReads.open`` to share one read between targets.
+    type SourceOpener = Callable[[Path], IO[bytes] | SharedReader]
+
+
+def _write_local_file(
+    appends: AppendTracker,
+    relative_path: PurePath,
+    source: Path,
+    destination: Path,
+    opener: SourceOpener | None,
+    echoes: EchoSuppressor | None = None,
+) -> tuple[int, int]:
+    """Bring ``destination`` up to date, return the size of the file and how many bytes were written."""
+    if echoes is not None:
+        echoes.expect_write(relative_path, source.stat())
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    append = appends.find_append(relative_path, source)
+    if append is not None and append_local_file(append, destination):
+        appends.record_append(append)
+        return append.size, append.size - append.offset
+    if opener is None:
+        copied = copy_file(source, destination)
+    else:
+        with opener(source) as reader:
+            copied = stream_file(source, destination, reader)
+    size = destination.stat().st_size
+    written = size if copied else 0
+    # Whatever the destination now holds is a prefix of the source, even if the source grew meanwhile.
+    appends.record(relative_path, source, size)
+    return size, written
+
+
+def _open_source(path: Path) -> IO[bytes]:
+    return path.open("rb")
+
+
+write_local_file = wrap(_write_local_file)
+
+COPY_BUFFER_SIZE = 1024 * 1024
+LOCAL_WRITE_CONCURRENCY = 8
+# Exit status of the remote append command when the remote file is not the size it was synced with.
+APPEND_MISMATCH_EXIT_CODE = 98
+# Exit status of the remote move command when the path to move does not exist.
+MOVE_SOURCE_MISSING_EXIT_CODE = 96
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
 
 
 class SyncTarget(Protocol):
     description: str
+    stats: TransferStats
 
     async def start(self) -> None: ...
 
     async def close(self) -> None: ...
 
-    async def write_file(self, relative_path: PurePath, source: Path) -> None: ...
+    async def reconnect(self) -> None:
+        """Set up the target again after it was unavailable, raises ``TargetUnavailableError`` if it still is."""
+        ...
+
+    async def write_file(self, relative_path: PurePath, source: Path, opener: SourceOpener | None = None) -> None: ...
 
     async def remove_path(self, relative_path: PurePath) -> None: ...
 
+    async def write_files(self, files: Iterable[tuple[PurePath, Path]], opener: SourceOpener | None = None) -> None:
+        """Write all files, ``files`` may be a lazy blocking iterator and is only consumed off the loop."""
+        ...
+
+    async def remove_paths(self, relative_paths: Sequence[PurePath]) -> None: ...
+
+    async def move_path(self, old_path: PurePath, new_path: PurePath) -> bool:
+        """Rename ``old_path`` to ``new_path``, replacing it, ``False`` if ``old_path`` does not exist."""
+        ...
+
+    def list_files(self, relative_path: PurePath | None = None) -> AsyncIterator[FileState]:
+        """Stream the regular files below the target root, or below ``relative_path``, sorted like ``walk_files``."""
+        ...
+
 
 @dataclass(slots=True)
 class LocalTarget:
     spec: LocalTargetSpec
     description: str = field(init=False)
+    # Number of copies kept in flight by ``write_files``, so several disk queues stay busy.
+    concurrency: int = LOCAL_WRITE_CONCURRENCY
+    # Told about every change before it is made when the target is also watched, see ``EchoSuppressor``.
+    echoes: EchoSuppressor | None = None
+    appends: AppendTracker = field(init=False, default_factory=AppendTracker)
+    stats: TransferStats = field(init=False, default_factory=TransferStats)
 
     def __post_init__(self) -> None:
         self.description = self.spec.display()
@@ -41,43 +141,289 @@ class LocalTarget:
     async def close(self) -> None:
         return None
 
-    async def write_file(self, relative_path: PurePath, source: Path) -> None:
+    async def reconnect(self) -> None:
+        return None
+
+    async def write_file(self, relative_path: PurePath, source: Path, opener: SourceOpener | None = None) -> None:
         dst = self.spec.path / Path(*relative_path.parts)
-        dst.parent.mkdir(parents=True, exist_ok=True)
-        await copyfile(source, dst)
+        self.stats.add(*await write_local_file(self.appends, relative_path, source, dst, opener, self.echoes))
 
     async def remove_path(self, relative_path: PurePath) -> None:
+        self.appends.forget(relative_path)
+        if self.echoes is not None:
+            self.echoes.expect_removal(relative_path)
         dst = self.spec.path / Path(*relative_path.parts)
         if dst.is_dir():
             await _remove_directory(dst)
         elif dst.exists():
             await asyncio.to_thread(dst.unlink)
 
+    async def write_files(self, files: Iterable[tuple[PurePath, Path]], opener: SourceOpener | None = None) -> None:
+        pending = aiter(iterate_in_thread(iter(files)))
+        lock = asyncio.Lock()
+
+        async def copy_pending() -> None:
+            while True:
+                async with lock:
+                    item = await anext(pending, None)
+                if item is None:
+                    return
+                await self.write_file(*item, opener)
+
+        workers = [asyncio.create_task(copy_pending()) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def remove_paths(self, relative_paths: Sequence[PurePath]) -> None:
+        for relative_path in relative_paths:
+            await self.remove_path(relative_path)
+
+    async def move_path(self, old_path: PurePath, new_path: PurePath) -> bool:
+        self.appends.forget(old_path)
+        self.appends.forget(new_path)
+        if self.echoes is not None:
+            await asyncio.to_thread(self.echoes.expect_move, old_path, new_path)
+        return await asyncio.to_thread(
+            _move_local_path, self.spec.path / Path(*old_path.parts), self.spec.path / Path(*new_path.parts)
+        )
+
+    async def list_files(self, relative_path: PurePath | None = None) -> AsyncIterator[FileState]:
+        if relative_path is None:
+            root, prefix = self.spec.path, ""
+        else:
+            root, prefix = self.spec.path / Path(*relative_path.parts), f"{PurePosixPath(*relative_path.parts)}/"
+        async for state in iterate_in_thread(walk_files(root, prefix=prefix)):
+            yield state
+
+
+class TargetHealth:
+    """Whether the targets fed by one queue are reachable, and when to try them next.
+
+    Every failure to reach a target pushes the next attempt back with exponential backoff,
+    jittered so targets that failed together do not retry in lockstep. Targets that could not be reached at all
+    are kept in ``unavailable`` until ``reconnect`` brings them back, the queue of a target
+    is paused in the meantime and keeps coalescing its changes.
+    """
+
+    def __init__(self, *, base_delay: float = RETRY_BASE_DELAY, max_delay: float = RETRY_MAX_DELAY) -> None:
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self.unavailable: dict[int, SyncTarget] = {}
+        self.lock = asyncio.Lock()
+        self._resume_at = 0.0
+
+    def succeeded(self) -> None:
+        self.failures = 0
+        self._resume_at = 0.0
+
+    def failed(self, unreachable: Iterable[SyncTarget] = ()) -> float:
+        """Back off after a failure, noting the targets that could not be reached. Returns the delay."""
+        for target in unreachable:
+            self.unavailable[id(target)] = target
+        self.failures += 1
+        delay = self.retry_delay(self.failures)
+        self._resume_at = max(self._resume_at, time.monotonic() + delay)
+        return delay
+
+    def retry_delay(self, failures: int) -> float:
+        """The backoff after ``failures`` failures in a row, also used for single events."""
+        return min(self.base_delay * 2 ** (failures - 1), self.max_delay) * random.uniform(0.5, 1.0)
+
+    async def wait(self) -> None:
+        while (remaining := self._resume_at - time.monotonic()) > 0:
+            await asyncio.sleep(remaining)
+
+    async def reconnect(self) -> list[SyncTarget]:
+        """Try every unavailable target once and return those that are back."""
+        recovered: list[SyncTarget] = []
+        for key, target in list(self.unavailable.items()):
+            try:
+                await target.reconnect()
+            except Exception:
+                continue
+            del self.unavailable[key]
+            recovered.append(target)
+        if self.unavailable:
+            self.failed()
+        else:
+            self.succeeded()
+        return recovered
+
+
+class SshSession:
+    """A multiplexed OpenSSH master connection shared by all targets on the same machine.
+
+    The master is started once per ``credential_key()`` and every later ``ssh`` invocation
+    reuses it through ``ControlPath``, so a command only pays for a local process spawn
+    instead of a full handshake.
+    """
+
+    CONNECT_TIMEOUT = 30
+    POLL_INTERVAL = 0.02
+
+    def __init__(self, spec: SshTargetSpec) -> None:
+        self.spec = spec
+        self.refs = 0
+        self.control_path: Path | None = None
+        self._control_dir: Path | None = None
+        self._master: asyncio.subprocess.Process | None = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def key(self) -> str:
+        return self.spec.credential_key()
+
+    def options(self) -> list[str]:
+        if self.control_path is None:
+            return []
+        return ["-o", f"ControlPath={self.control_path}", "-o", "ControlMaster=no"]
+
+    async def open(self) -> None:
+        async with self._lock:
+            self.refs += 1
+            if self._master is not None and self._master.returncode is not None:
+                # The connection dropped, e.g. the network went away, so a new master is started.
+                await self._shutdown()
+            if self._master is not None or not _supports_control_master():
+                return
+            self._control_dir = Path(tempfile.mkdtemp(prefix="watchfs-ssh-"))
+            control_path = self._control_dir / "control"
+            command = _ssh_command_prefix(self.spec)
+            command.extend(["-M", "-N", "-o", f"ControlPath={control_path}", "-o", "ControlPersist=no"])
+            command.extend(["-o", f"ConnectTimeout={self.CONNECT_TIMEOUT}", self.spec.authority()])
+            self._master = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            try:
+                await asyncio.wait_for(self._wait_ready(control_path), self.CONNECT_TIMEOUT)
+            except TimeoutError as err:
+                # A host that drops the packets, ssh itself may not give up before the timeout.
+                await self._shutdown()
+                message = f"SSH connection to {self.spec.display()} timed out after {self.CONNECT_TIMEOUT}s"
+                raise TargetUnavailableError(message) from err
+            except BaseException:
+                await self._shutdown()
+                raise
+            self.control_path = control_path
+
+    async def release(self) -> bool:
+        async with self._lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return False
+            await self._shutdown()
+            return True
+
+    async def _wait_ready(self, control_path: Path) -> None:
+        assert self._master is not None
+        while not control_path.exists():
+            if self._master.returncode is not None:
+                stderr = await self._master.stderr.read() if self._master.stderr else b""
+                stderr_text = stderr.decode().strip() or "unknown ssh error"
+                raise TargetUnavailableError(f"SSH connection failed for {self.spec.display()}: {stderr_text}")
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    async def _shutdown(self) -> None:
+        master, self._master = self._master, None
+        control_path, self.control_path = self.control_path, None
+        if master is not None:
+            if control_path is not None and master.returncode is None:
+                command = _ssh_command_prefix(self.spec)
+                command.extend(["-o", f"ControlPath={control_path}", "-O", "exit", self.spec.authority()])
+                await _run_command(command)
+            if master.returncode is None:
+                master.terminate()
+            with contextlib.suppress(ProcessLookupError):
+                await master.wait()
+        if self._control_dir is not None:
+            shutil.rmtree(self._control_dir, ignore_errors=True)
+            self._control_dir = None
+
+
+_SSH_SESSIONS: dict[str, SshSession] = {}
+
+
+async def acquire_ssh_session(spec: SshTargetSpec) -> SshSession:
+    session = _SSH_SESSIONS.setdefault(spec.credential_key(), SshSession(spec))
+    try:
+        await session.open()
+    except BaseException:
+        await release_ssh_session(session)
+        raise
+    return session
+
+
+async def release_ssh_session(session: SshSession) -> None:
+    if await session.release() and _SSH_SESSIONS.get(session.key) is session:
+        del _SSH_SESSIONS[session.key]
+
 
 @dataclass(slots=True)
 class SshTarget:
     spec: SshTargetSpec
     description: str = field(init=False)
+    session: SshSession | None = field(init=False, default=None)
+    # Files at least this large are updated with a delta transfer, ``None`` disables it.
+    delta_min_size: int | None = DELTA_MIN_SIZE
+    # Level of the gzip compression of tar uploads, adapted as the target is used. ``None`` disables it.
+    compression: AdaptiveLevel | None = None
+    # Pace every uploaded byte, e.g. a bucket of this target and one shared by all targets.
+    buckets: tuple[TokenBucket, ...] = ()
+    # Apply changes through a python3 agent on the destination instead of shell commands, see ``AgentClient``.
+    use_agent: bool = False
+    agent: AgentClient | None = field(init=False, default=None)
+    appends: AppendTracker = field(init=False, default_factory=AppendTracker)
+    stats: TransferStats = field(init=False, default_factory=TransferStats)
+    _delta_supported: bool = field(init=False, default=True)
 
     def __post_init__(self) -> None:
         self.description = self.spec.display()
 
     async def start(self) -> None:
+        self.session = await acquire_ssh_session(self.spec)
         await self._run_ssh_command("true")
+        if self.use_agent:
+            await self._start_agent()
+
+    async def _start_agent(self) -> None:
+        command = self._ssh_base_command()
+        command.append(agent_command(_quote_remote_path(self.spec.path.as_posix())))
+        agent = AgentClient(command, self.description, self.buckets)
+        if not await asyncio.to_thread(agent.start):
+            # No python3 on the remote side, keep using shell commands for this target.
+            self.use_agent = False
+            return
+        self.agent = agent
+        await asyncio.to_thread(agent.mkdir)
 
     async def close(self) -> None:
-        return None
+        agent, self.agent = self.agent, None
+        if agent is not None:
+            await asyncio.to_thread(agent.close)
+        session, self.session = self.session, None
+        if session is not None:
+            await release_ssh_session(session)
 
-    async def write_file(self, relative_path: PurePath, source: Path) -> None:
-        remote_path = self._remote_path(relative_path)
-        remote_dir = _quote_remote_path(remote_path.parent.as_posix())
-        remote_file = _quote_remote_path(remote_path.as_posix())
-        command = f"mkdir -p -- {remote_dir} && cat > {remote_file}"
+    async def reconnect(self) -> None:
+        await self.close()
+        await self.start()
 
-        with source.open("rb") as stdin:
-            await self._run_ssh_command(command, stdin=stdin)
+    async def write_file(self, relative_path: PurePath, source: Path, opener: SourceOpener | None = None) -> None:
+        await self.write_files([(relative_path, source)], opener)
 
     async def remove_path(self, relative_path: PurePath) -> None:
+        self.appends.forget(relative_path)
+        if self.agent is not None:
+            await asyncio.to_thread(self.agent.remove, [relative_path])
+            return
         remote_path = _quote_remote_path(self._remote_path(relative_path).as_posix())
         command = (
             f"if [ -d {remote_path} ]; then "
@@ -88,23 +434,196 @@ class SshTarget:
         )
         await self._run_ssh_command(command)
 
+    async def write_files(self, files: Iterable[tuple[PurePath, Path]], opener: SourceOpener | None = None) -> None:
+        """Upload all files as one tar stream that is unpacked under the target root.
+
+        ``files`` is consumed by the upload thread, so expanding a directory overlaps the transfer.
+        Files that were only appended to, and files of at least ``delta_min_size`` bytes, are set
+        aside and sent as appends and deltas afterwards. With the agent running the files are
+        sent to it as pipelined requests instead of a tar stream.
+        """
+        batch = _UploadBatch(self.appends, self.delta_min_size if self._delta_supported else None)
+        pending = batch.plan(iter(files))
+        try:
+            first = await asyncio.to_thread(_next_file, pending)
+            if first is not None:
+                await self._upload(itertools.chain([first], pending), opener or _open_source)
+            # Large files the destination has no copy of yet, a delta would send all of them as is.
+            new_files = []
+            for relative_path, source, size in batch.large_files:
+                if not await self._write_delta(relative_path, source, size, opener or _open_source):
+                    new_files.append((relative_path, source))
+            if new_files:
+                await self._upload(iter(new_files), opener or _open_source)
+        except BaseException:
+            batch.forget_recorded()
+            raise
+        for append in batch.appended_files:
+            if not await self._write_append(append):
+                self.appends.forget(append.relative_path)
+                await self.write_files([(append.relative_path, append.source)], opener)
+
+    async def _upload(self, files: Iterator[tuple[PurePath, Path]], opener: SourceOpener) -> None:
+        """Send ``files`` to the agent, or as one tar stream that is unpacked under the target root."""
+        if self.agent is not None:
+            total, sent = await asyncio.to_thread(self.agent.write_files, files, opener, self.compression)
+            self.stats.add(total, sent)
+            return
+        remote_root = _quote_remote_path(self.spec.path.as_posix())
+        command = self._ssh_base_command()
+        tar_flags = "-xzf" if self.compression is not None else "-xf"
+        command.append(f"mkdir -p -- {remote_root} && tar --no-same-owner {tar_flags} - -C {remote_root}")
+        result = await asyncio.to_thread(
+            _upload_tar_sync,
+            command,
+            files,
+            opener,
+            compression=self.compression,
+            stats=self.stats,
+            buckets=self.buckets,
+        )
+        self._check_result(result)
+
+    async def _write_append(self, append: Append) -> bool:
+        """Append the new bytes remotely, ``False`` if the remote file does not have the old size anymore."""
+        if self.agent is not None:
+            try:
+                appended = await asyncio.to_thread(self.agent.append, append)
+            except FileNotFoundError:
+                return True
+            if appended:
+                self.appends.record_append(append)
+                self.stats.add(append.size, append.size - append.offset)
+            return appended
+        remote_path = _quote_remote_path(self._remote_path(append.relative_path).as_posix())
+        mtime = f"@{append.mtime_ns // 1_000_000_000}.{append.mtime_ns % 1_000_000_000:09d}"
+        command = self._ssh_base_command()
+        command.append(
+            f'[ "$(wc -c < {remote_path})" -eq {append.offset} ] 2>/dev/null || exit {APPEND_MISMATCH_EXIT_CODE}; '
+            f"head -c {append.size - append.offset} >> {remote_path} && touch -m -d {mtime} -- {remote_path}"
+        )
+        try:
+            with append.source.open("rb") as stream:
+                stream.seek(append.offset)
+                result = await _run_command(command, stdin=stream, buckets=self.buckets)
+        except FileNotFoundError:
+            return True
+        if result.returncode == APPEND_MISMATCH_EXIT_CODE:
+            return False
+        self._check_result(result)
+        self.appends.record_append(append)
+        self.stats.add(append.size, append.size - append.offset)
+        return True
+
+    async def _write_delta(self, relative_path: PurePath, source: Path, size: int, opener: SourceOpener) -> bool:
+        """Send the changed blocks of ``source``, ``False`` if it has to be uploaded whole instead."""
+        block_size = choose_block_size(size)
+        remote_root = _quote_remote_path(self.spec.path.as_posix())
+        command = self._ssh_base_command()
+        command.append(delta_remote_command(remote_root, PurePosixPath(*relative_path.parts).as_posix(), block_size))
+        stats = await asyncio.to_thread(
+            transfer_delta_sync, command, source, opener, block_size, self.buckets, require_remote_copy=True
+        )
+        if stats is None:
+            # No python3 on the remote side, keep using plain uploads for this target.
+            self._delta_supported = False
+            return False
+        if stats.remote_missing:
+            return False
+        self.stats.add(stats.literal_bytes + stats.matched_bytes, stats.literal_bytes)
+        return True
+
+    async def remove_paths(self, relative_paths: Sequence[PurePath]) -> None:
+        """Remove all paths with a single ``rm`` fed NUL-separated paths over stdin."""
+        if not relative_paths:
+            return
+        for relative_path in relative_paths:
+            self.appends.forget(relative_path)
+        if self.agent is not None:
+            await asyncio.to_thread(self.agent.remove, relative_paths)
+            return
+        remote_root = _quote_remote_path(self.spec.path.as_posix())
+        command = self._ssh_base_command()
+        command.append(f"if cd -- {remote_root} 2>/dev/null; then xargs -0 rm -rf --; fi")
+        paths = b"".join(os.fsencode(PurePosixPath(*path.parts).as_posix()) + b"\0" for path in relative_paths)
+        result = await _run_command(command, input=paths)
+        self._check_result(result)
+
+    async def move_path(self, old_path: PurePath, new_path: PurePath) -> bool:
+        self.appends.forget(old_path)
+        self.appends.forget(new_path)
+        if self.agent is not None:
+            return await asyncio.to_thread(self.agent.move, old_path, new_path)
+        remote_root = _quote_remote_path(self.spec.path.as_posix())
+        old_remote = shlex.quote(PurePosixPath(*old_path.parts).as_posix())
+        new_remote = shlex.quote(PurePosixPath(*new_path.parts).as_posix())
+        command = self._ssh_base_command()
+        command.append(
+            f"cd -- {remote_root} 2>/dev/null && [ -e {old_remote} ] || exit {MOVE_SOURCE_MISSING_EXIT_CODE}; "
+            f'rm -rf -- {new_remote} && mkdir -p -- "$(dirname -- {new_remote})" && mv -- {old_remote} {new_remote}'
+        )
+        result = await _run_command(command)
+        if result.returncode == MOVE_SOURCE_MISSING_EXIT_CODE:
+            return False
+        self._check_result(result)
+        return True
+
+    async def list_files(self, relative_path: PurePath | None = None) -> AsyncIterator[FileState]:
+        """List the remote tree with one ``find`` whose output is sorted on the remote side.
+
+        Needs GNU find for ``-printf``, unless the agent runs, which walks the tree itself.
+        """
+        if self.agent is not None:
+            async for state in iterate_in_thread(self.agent.iter_files(relative_path)):
+                yield state
+            return
+        remote_root = _quote_remote_path(self.spec.path.as_posix())
+        change_directory = f"cd -- {remote_root} 2>/dev/null"
+        prefix = ""
+        if relative_path is not None:
+            prefix = f"{PurePosixPath(*relative_path.parts)}/"
+            change_directory += f" && cd -- {shlex.quote(prefix)} 2>/dev/null"
+        command = self._ssh_base_command()
+        command.append(f"{change_directory} || exit 0; find . -type f -printf '%P\\t%s\\t%T@\\0' | LC_ALL=C sort -z")
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        assert process.stdout is not None
+        try:
+            buffer = b""
+            while chunk := await process.stdout.read(COPY_BUFFER_SIZE):
+                *records, buffer = (buffer + chunk).split(b"\0")
+                for record in records:
+                    path, size, mtime = record.decode("utf-8", "surrogateescape").rsplit("\t", 2)
+                    yield FileState(prefix + path, int(size), float(mtime))
+            stderr = await process.stderr.read() if process.stderr else b""
+            self._check_result(subprocess.CompletedProcess(command, await process.wait(), b"", stderr))
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
     async def _run_ssh_command(self, remote_command: str, *, stdin: IO[bytes] | int | None = None) -> None:
         command = self._ssh_base_command()
         command.append(remote_command)
         result = await _run_command(command, stdin=stdin)
+        self._check_result(result)
+
+    def _check_result(self, result: subprocess.CompletedProcess[bytes]) -> None:
         if result.returncode != 0:
             stderr_text = result.stderr.decode().strip() if result.stderr else "unknown ssh error"
+            if result.returncode == SSH_ERROR_EXIT_CODE:
+                raise TargetUnavailableError(f"SSH connection failed for {self.description}: {stderr_text}")
             raise RuntimeError(f"SSH command failed for {self.description}: {stderr_text}")
 
     def _ssh_base_command(self) -> list[str]:
-        command = ["ssh"]
-        if self.spec.port != 22:
-            command.extend(["-p", str(self.spec.port)])
-        command.extend(["-o", "BatchMode=yes"])
+        command = _ssh_command_prefix(self.spec)
+        if self.session is not None:
+            command.extend(self.session.options())
         command.append(self.spec.authority())
-        if self.spec.jump_host is not None:
-            # TODO: add jump host / ProxyJump support.
-            pass
         return command
 
     def _remote_path(self, relative_path: PurePath) -> PurePosixPath:
@@ -112,29 +631,112 @@ class SshTarget:
         return self.spec.path / relative_posix
 
 
-def create_target(spec: TargetSpec) -> SyncTarget:
+def create_target(
+    spec: TargetSpec,
+    *,
+    delta_min_size: int | None = DELTA_MIN_SIZE,
+    compress: bool = False,
+    buckets: tuple[TokenBucket, ...] = (),
+    agent: bool = False,
+) -> SyncTarget:
     if isinstance(spec, LocalTargetSpec):
         return LocalTarget(spec)
-    return SshTarget(spec)
+    compression = AdaptiveLevel() if compress else None
+    return SshTarget(spec, delta_min_size=delta_min_size, compression=compression, buckets=buckets, use_agent=agent)
+
+
+class _UploadBatch:
+    """Sorts the files of one ``SshTarget.write_files`` call into tar members, deltas and appends."""
+
+    def __init__(self, appends: AppendTracker, delta_min_size: int | None) -> None:
+        self.appends = appends
+        self.delta_min_size = delta_min_size
+        self.large_files: list[tuple[PurePath, Path, int]] = []
+        self.appended_files: list[Append] = []
+        self.recorded: list[PurePath] = []
+
+    def plan(self, files: Iterator[tuple[PurePath, Path]]) -> Iterator[tuple[PurePath, Path]]:
+        """Yield the files for the tar stream, setting the others aside. Blocking, run it in a thread."""
+        for relative_path, source in files:
+            if (append := self.appends.find_append(relative_path, source)) is not None:
+                self.appended_files.append(append)
+                continue
+            try:
+                size = source.stat().st_size
+            except OSError:
+                size = 0
+            # Recorded before the upload, if the file still grows meanwhile the remote size check
+            # of the next append fails and the file is uploaded in full again.
+            self.appends.record(relative_path, source, size)
+            self.recorded.append(relative_path)
+            if self.delta_min_size is not None and size >= self.delta_min_size:
+                self.large_files.append((relative_path, source, size))
+            else:
+                yield relative_path, source
+
+    def forget_recorded(self) -> None:
+        for relative_path in self.recorded:
+            self.appends.forget(relative_path)
+
+
+def _next_file(files: Iterator[tuple[PurePath, Path]]) -> tuple[PurePath, Path] | None:
+    # ``to_thread(next, files, None)`` loses the item type to type checkers.
+    return next(files, None)
+
+
+def _ssh_command_prefix(spec: SshTargetSpec) -> list[str]:
+    command = ["ssh"]
+    if spec.port != 22:
+        command.extend(["-p", str(spec.port)])
+    command.extend(["-o", "BatchMode=yes"])
+    if spec.jump_host is not None:
+        # TODO: add jump host / ProxyJump support.
+        pass
+    return command
+
+
+def _supports_control_master() -> bool:
+    # The Windows port of OpenSSH has no unix domain socket multiplexing.
+    return sys.platform != "win32"
 
 
 async def _remove_directory(path: Path) -> None:
     await asyncio.to_thread(shutil.rmtree, path)
 
 
+def _move_local_path(source: Path, destination: Path) -> bool:
+    if not os.path.lexists(source):
+        return False
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    if destination.is_dir() and not destination.is_symlink():
+        shutil.rmtree(destination)
+    elif os.path.lexists(destination):
+        destination.unlink()
+    source.replace(destination)
+    return True
+
+
 async def _run_command(
     command: list[str],
     *,
     stdin: IO[bytes] | int | None = None,
+    input: bytes | None = None,
+    buckets: Sequence[TokenBucket] = (),
 ) -> subprocess.CompletedProcess[bytes]:
-    return await asyncio.to_thread(_run_command_sync, command, stdin=stdin)
+    return await asyncio.to_thread(_run_command_sync, command, stdin=stdin, input=input, buckets=buckets)
 
 
 def _run_command_sync(
     command: list[str],
     *,
     stdin: IO[bytes] | int | None = None,
+    input: bytes | None = None,
+    buckets: Sequence[TokenBucket] = (),
 ) -> subprocess.CompletedProcess[bytes]:
+    if input is not None:
+        return subprocess.run(command, input=input, capture_output=True, text=False)
+    if buckets and stdin is not None and not isinstance(stdin, int):
+        return _pump_command_sync(command, stdin, buckets)
     return subprocess.run(
         command,
         stdin=stdin if stdin is not None else subprocess.DEVNULL,
@@ -143,6 +745,112 @@ def _run_command_sync(
     )
 
 
+def _pump_command_sync(
+    command: list[str], stream: IO[bytes], buckets: Sequence[TokenBucket]
+) -> subprocess.CompletedProcess[bytes]:
+    """Run ``command`` with ``stream`` fed to its stdin at the pace of ``buckets``, instead of handing it over."""
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr)
+        assert process.stdin is not None
+        try:
+            shutil.copyfileobj(stream, shaped(process.stdin, buckets), SHAPING_CHUNK_SIZE)
+        except BrokenPipeError:
+            # The command read all it needed, e.g. ``head -c``.
+            pass
+        finally:
+            with contextlib.suppress(BrokenPipeError):
+                process.stdin.close()
+        returncode = process.wait()
+        stderr.seek(0)
+        return subprocess.CompletedProcess(command, returncode, b"", stderr.read())
+
+
+def _upload_tar_sync(
+    command: list[str],
+    files: Iterable[tuple[PurePath, Path]],
+    opener: SourceOpener = _open_source,
+    *,
+    compression: AdaptiveLevel | None = None,
+    stats: TransferStats | None = None,
+    buckets: Sequence[TokenBucket] = (),
+) -> subprocess.CompletedProcess[bytes]:
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr)
+        assert process.stdin is not None
+        writer = CompressingWriter(shaped(process.stdin, buckets), compression)
+        try:
+            # A stream mode archive only writes to and closes its file object.
+            with tarfile.open(fileobj=cast("IO[bytes]", writer), mode="w|") as archive:
+                for relative_path, source in files:
+                    _add_file_to_tar(archive, PurePosixPath(*relative_path.parts).as_posix(), source, opener, writer)
+                # The end-of-archive padding is all zeros.
+                writer.set_compressible(True)
+            writer.close()
+        except BrokenPipeError:
+            # The remote side exited early, its exit status and stderr tell why.
+            pass
+        finally:
+            with contextlib.suppress(BrokenPipeError):
+                process.stdin.close()
+        returncode = process.wait()
+        if stats is not None:
+            stats.add(writer.raw_bytes, writer.wire_bytes)
+        stderr.seek(0)
+        return subprocess.CompletedProcess(command, returncode, b"", stderr.read())
+
+
+def _add_file_to_tar(
+    archive: tarfile.TarFile,
+    arcname: str,
+    source: Path,
+    opener: SourceOpener,
+    writer: CompressingWriter | None = None,
+) -> None:
+    if (opened := open_changed_file(source, opener)) is None:
+        return
+    stream, stat = opened
+    with stream:
+        info = tarfile.TarInfo(arcname)
+        info.size = stat.st_size
+        info.mtime = stat.st_mtime
+        info.mode = stat.st_mode & 0o7777
+        head = b""
+        if writer is not None and writer.level is not None:
+            head = bytes(stream.read(MAGIC_SIZE))
+            writer.set_compressible(not is_incompressible(PurePosixPath(arcname), head))
+        archive.addfile(info, _SizedReader(stream, stat.st_size, head))
+
+
+class _SizedReader:
+    """Yields exactly ``size`` bytes, zero-padding a file that shrank while it was being archived.
+
+    The tar header is already written at that point, so the stream has to stay well-formed.
+    The writer that truncated the file triggers another event which uploads the final content.
+    Short reads are retried, e.g. a ``SharedReader`` stops at the end of each shared chunk,
+    only the end of the file pads.
+    """
+
+    def __init__(self, stream: IO[bytes] | SharedReader, size: int, head: bytes = b"") -> None:
+        self.stream = stream
+        self.remaining = size
+        # Bytes already read from ``stream``, e.g. to sniff the file type, that come first.
+        self.head = head
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        buffer = bytearray(self.head[:size])
+        self.head = self.head[size:]
+        while len(buffer) < size:
+            piece = self.stream.read(size - len(buffer))
+            if not piece:
+                buffer += bytes(size - len(buffer))
+                break
+            buffer += piece
+        self.remaining -= size
+        return bytes(buffer)
+
+
 def _quote_remote_path(path: str) -> str:
     if path == "~":
         return "~"
@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import shlex
+import threading
+from pathlib import Path, PurePath, PurePosixPath
+from typing import IO
+
+import pytest
+
+from tests.helpers import LoopbackSshTarget
+from watchfs.agent import AGENT_CHUNK_SIZE, AgentClient, Op, Status, agent_command
+from watchfs.appends import APPEND_MIN_SIZE, AppendTracker
+from watchfs.compression import AdaptiveLevel
+from watchfs.mappings import SshTargetSpec
+from watchfs.scan import walk_files
+
+
+def start_agent(root: Path) -> AgentClient:
+    client = AgentClient(["sh", "-c", agent_command(shlex.quote(root.as_posix()))], "loopback")
+    assert client.start()
+    return client
+
+
+def open_source(path: Path) -> IO[bytes]:
+    return path.open("rb")
+
+
+def test_agent_writes_and_inspects_files(tmp_path: Path):
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "big.bin").write_bytes(os.urandom(2 * AGENT_CHUNK_SIZE + 5))
+    (source / "empty").write_bytes(b"")
+    (source / "text.txt").write_text("hello " * 1000)
+    os.utime(source / "text.txt", ns=(1_000_000_000, 1_500_000_000))
+    remote = tmp_path / "remote"
+    client = start_agent(remote)
+    try:
+        files = [(PurePath("sub", path.name), path) for path in sorted(source.iterdir())]
+        total, sent = client.write_files(files, open_source, AdaptiveLevel())
+        assert total == 2 * AGENT_CHUNK_SIZE + 5 + 6000
+        # The text is compressed, the random data is not.
+        assert sent < total - 5000
+        for _, path in files:
+            assert (remote / "sub" / path.name).read_bytes() == path.read_bytes()
+        assert (remote / "sub" / "text.txt").stat().st_mtime_ns == 1_500_000_000
+        assert not [path for path in (remote / "sub").iterdir() if path.name.endswith(".watchfs")]
+
+        info = client.stat(PurePath("sub", "text.txt"))
+        assert info is not None and (info.size, info.mtime_ns, info.is_dir) == (6000, 1_500_000_000, False)
+        assert client.stat(PurePath("missing")) is None
+        assert client.hash(PurePath("missing")) is None
+        assert len(client.hash(PurePath("sub", "big.bin")) or b"") == 32
+    finally:
+        client.close()
+
+
+def test_agent_skips_unchanged_large_files(tmp_path: Path):
+    source = tmp_path / "large.bin"
+    source.write_bytes(os.urandom(AGENT_CHUNK_SIZE * 2))
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    (remote / "large.bin").write_bytes(source.read_bytes())
+    client = start_agent(remote)
+    try:
+        # Same content, only the modification time differs, so the hashes decide.
+        assert client.write_files([(PurePath("large.bin"), source)], open_source) == (AGENT_CHUNK_SIZE * 2, 0)
+        assert (remote / "large.bin").stat().st_mtime_ns == source.stat().st_mtime_ns
+    finally:
+        client.close()
+
+
+def test_agent_lists_like_walk_files(tmp_path: Path):
+    remote = tmp_path / "remote"
+    for name in ["a-b", "a/b", "a/c/d", "b", "c.txt"]:
+        (remote / name).parent.mkdir(parents=True, exist_ok=True)
+        (remote / name).write_text(name)
+    client = start_agent(remote)
+    try:
+        assert list(client.iter_files()) == list(walk_files(remote))
+        assert list(client.iter_files(PurePath("a"))) == list(walk_files(remote / "a", prefix="a/"))
+        assert list(client.iter_files(PurePath("missing"))) == []
+    finally:
+        client.close()
+
+
+def test_agent_lists_while_writing(tmp_path: Path):
+    remote = tmp_path / "remote"
+    for directory in range(20):
+        (remote / f"d{directory:02}").mkdir(parents=True)
+        for index in range(1000):
+            (remote / f"d{directory:02}" / f"f{index:04}").touch()
+    source = tmp_path / "big.bin"
+    # Below the size that is first compared with the remote copy, which would wait for the listing.
+    source.write_bytes(os.urandom(AGENT_CHUNK_SIZE // 2))
+    client = start_agent(remote)
+    listed: list[str] = []
+
+    def write_files() -> None:
+        client.write_files([(PurePath(f"copy{index}.bin"), source) for index in range(16)], open_source)
+
+    try:
+        files = client.iter_files()
+        listed.append(next(files).path)
+        # The replies to the listing fill the pipe while the writes fill the other direction.
+        threads = [
+            threading.Thread(target=listed.extend, args=((state.path for state in files),), daemon=True),
+            threading.Thread(target=write_files, daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=30)
+        deadlocked = any(thread.is_alive() for thread in threads)
+        if deadlocked:
+            assert client._process is not None
+            client._process.kill()
+        assert not deadlocked
+        assert len(listed) == 20 * 1000
+        assert (remote / "copy15.bin").read_bytes() == source.read_bytes()
+    finally:
+        client.close()
+
+
+def test_agent_pipelines_requests(tmp_path: Path):
+    client = start_agent(tmp_path)
+    try:
+        futures = [client.submit(Op.MKDIR, len(name).to_bytes(2) + name) for name in (b"a", b"b", b"a/c")]
+        futures.append(client.submit(Op.STAT, (1).to_bytes(2) + b"b"))
+        client.flush()
+        assert [future.result()[0] for future in futures] == [Status.OK] * 4
+        assert (tmp_path / "a" / "c").is_dir()
+        with pytest.raises(RuntimeError, match="Agent failed"):
+            client.call(Op.STAT, b"")
+    finally:
+        client.close()
+
+
+def test_agent_appends_moves_and_removes(tmp_path: Path):
+    source = tmp_path / "log.txt"
+    lines = "one\n" * (APPEND_MIN_SIZE // 4)
+    source.write_text(lines)
+    tracker = AppendTracker()
+    tracker.record(PurePath("log.txt"), source)
+    with source.open("a") as stream:
+        stream.write("two\n")
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    (remote / "log.txt").write_text(lines)
+    client = start_agent(remote)
+    try:
+        append = tracker.find_append(PurePath("log.txt"), source)
+        assert append is not None and client.append(append)
+        assert (remote / "log.txt").read_text() == lines + "two\n"
+        # The remote file has grown meanwhile, the append does not apply anymore.
+        assert not client.append(append)
+
+        assert client.move(PurePath("log.txt"), PurePath("old", "log.txt"))
+        assert not client.move(PurePath("log.txt"), PurePath("other.txt"))
+        assert (remote / "old" / "log.txt").exists()
+        client.remove([PurePath("old"), PurePath("missing")])
+        assert list(remote.iterdir()) == []
+    finally:
+        client.close()
+
+
+def test_ssh_target_uses_the_agent(tmp_path: Path):
+    source = tmp_path / "source"
+    (source / "sub").mkdir(parents=True)
+    (source / "sub" / "file.txt").write_text("content")
+    remote = tmp_path / "remote"
+    target = LoopbackSshTarget(SshTargetSpec(host="loopback", path=PurePosixPath(remote.as_posix())), use_agent=True)
+
+    async def sync() -> list[str]:
+        await target.start()
+        try:
+            assert target.agent is not None
+            await target.write_files([(PurePath("sub", "file.txt"), source / "sub" / "file.txt")])
+            assert await target.move_path(PurePath("sub", "file.txt"), PurePath("moved.txt"))
+            listed = [state.path async for state in target.list_files()]
+            await target.remove_paths([PurePath("sub")])
+            return listed
+        finally:
+            await target.close()
+
+    assert asyncio.run(sync()) == ["moved.txt"]
+    assert [path.name for path in remote.iterdir()] == ["moved.txt"]
+    assert (remote / "moved.txt").read_text() == "content"
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import zlib
+from pathlib import Path, PurePath, PurePosixPath
+from typing import TYPE_CHECKING
+
+from tests.helpers import LoopbackSshTarget
+from watchfs.appends import APPEND_MIN_SIZE, AppendTracker
+from watchfs.mappings import LocalTargetSpec, SshTargetSpec
+from watchfs.targets import LocalTarget
+
+if TYPE_CHECKING:
+    import pytest
+
+LOG = PurePath("logs/app.log")
+# Long enough for its appends to be tracked.
+LINE = "x" * 99 + "\n"
+LINES = LINE * (APPEND_MIN_SIZE // len(LINE) + 1)
+
+
+def test_tracker_only_reports_pure_appends(tmp_path: Path):
+    size = 10 * APPEND_MIN_SIZE
+    source = tmp_path / "app.log"
+    source.write_bytes(b"x" * size)
+    tracker = AppendTracker()
+    assert tracker.find_append(LOG, source) is None
+    tracker.record(LOG, source)
+
+    with source.open("ab") as stream:
+        stream.write(b"more")
+    append = tracker.find_append(LOG, source)
+    assert append is not None
+    assert (append.offset, append.size) == (size, size + 4)
+
+    # Rewritten right before the end, like a file that is written in place.
+    with source.open("r+b") as stream:
+        stream.seek(size - 1)
+        stream.write(b"y")
+    assert tracker.find_append(LOG, source) is None
+
+    # Edited and grown, like a database file.
+    tracker.record(LOG, source)
+    with source.open("r+b") as stream:
+        stream.write(b"z")
+        stream.seek(0, os.SEEK_END)
+        stream.write(b"more")
+    assert tracker.find_append(LOG, source) is None
+
+    tracker.record(LOG, source)
+    replacement = tmp_path / "new.log"
+    replacement.write_bytes(source.read_bytes() + b"more")
+    replacement.replace(source)
+    assert tracker.find_append(LOG, source) is None
+
+    tracker.record(LOG, source)
+    source.write_bytes(b"x")
+    assert tracker.find_append(LOG, source) is None
+
+    # Small files are copied whole.
+    tracker.record(LOG, source)
+    with source.open("ab") as stream:
+        stream.write(b"more")
+    assert tracker.find_append(LOG, source) is None
+
+
+def test_tracker_reads_a_bounded_sample(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    source = tmp_path / "app.log"
+    source.write_bytes(os.urandom(100 * APPEND_MIN_SIZE))
+    tracker = AppendTracker()
+    tracker.record(LOG, source)
+    with source.open("ab") as stream:
+        stream.write(b"more")
+    checked = 0
+    crc32 = zlib.crc32
+
+    def counting_crc32(data: bytes, value: int = 0) -> int:
+        nonlocal checked
+        checked += len(data)
+        return crc32(data, value)
+
+    monkeypatch.setattr(zlib, "crc32", counting_crc32)
+    assert tracker.find_append(LOG, source) is not None
+    # The old and the new size are each checked by their samples only.
+    assert checked == 2 * APPEND_MIN_SIZE
+
+
+def test_local_target_appends_in_place(tmp_path: Path):
+    source = tmp_path / "src" / "app.log"
+    source.parent.mkdir()
+    source.write_text(LINES)
+    target = LocalTarget(LocalTargetSpec(tmp_path / "dst"))
+    destination = tmp_path / "dst" / "app.log"
+
+    asyncio.run(target.write_file(PurePath("app.log"), source))
+    inode = destination.stat().st_ino
+    with source.open("a") as stream:
+        stream.write("second\n")
+    asyncio.run(target.write_file(PurePath("app.log"), source))
+    assert destination.read_text() == LINES + "second\n"
+    assert destination.stat().st_ino == inode
+    assert destination.stat().st_mtime_ns == source.stat().st_mtime_ns
+
+    # The destination was changed behind our back, so it is copied in full.
+    destination.write_text("other\n")
+    with source.open("a") as stream:
+        stream.write("third\n")
+    asyncio.run(target.write_file(PurePath("app.log"), source))
+    assert destination.read_text() == LINES + "second\nthird\n"
+
+
+def test_ssh_target_sends_only_appended_bytes(tmp_path: Path):
+    source = tmp_path / "src" / "data.jsonl"
+    source.parent.mkdir()
+    source.write_text(LINES)
+    remote = tmp_path / "remote"
+    target = LoopbackSshTarget(SshTargetSpec(host="host1", path=PurePosixPath(remote.as_posix())), delta_min_size=None)
+    destination = remote / "data.jsonl"
+
+    asyncio.run(target.write_files([(PurePath("data.jsonl"), source)]))
+    assert destination.read_text() == LINES
+    with source.open("a") as stream:
+        stream.write('{"b": 2}\n')
+    inode = destination.stat().st_ino
+    asyncio.run(target.write_files([(PurePath("data.jsonl"), source)]))
+    assert destination.read_text() == LINES + '{"b": 2}\n'
+    assert destination.stat().st_ino == inode
+    assert int(destination.stat().st_mtime) == int(source.stat().st_mtime)
+
+    destination.write_text("truncated\n")
+    with source.open("a") as stream:
+        stream.write('{"c": 3}\n')
+    asyncio.run(target.write_files([(PurePath("data.jsonl"), source)]))
+    assert destination.read_text() == source.read_text()
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import gzip
+import io
+import os
+import random
+from pathlib import Path, PurePath
+
+import pytest
+
+from watchfs import compression
+from watchfs.compression import AdaptiveLevel, CompressingWriter, TransferStats, format_size, is_incompressible
+from watchfs.targets import _upload_tar_sync
+
+
+@pytest.mark.parametrize(
+    ("name", "head", "expected"),
+    [
+        ("archive.tar.gz", b"", True),
+        ("photo.JPG", b"", True),
+        ("data.bin", b"\x1f\x8b\x08\x00", True),
+        ("data.bin", b"\x28\xb5\x2f\xfd\x00", True),
+        ("clip", b"\x00\x00\x00\x18ftypmp42", True),
+        ("image", b"RIFF\x00\x00\x00\x00WEBP", True),
+        ("main.py", b"import os\n", False),
+        ("notes", b"", False),
+    ],
+)
+def test_is_incompressible(name: str, head: bytes, expected: bool):
+    assert is_incompressible(PurePath(name), head) is expected
+
+
+def test_compressing_writer_stores_incompressible_data_in_separate_members():
+    raw = io.BytesIO()
+    writer = CompressingWriter(raw, AdaptiveLevel())
+    text = b"the same line over and over\n" * 10000
+    noise = random.Random(0).randbytes(100_000)
+    writer.write(text)
+    writer.set_compressible(False)
+    writer.write(noise)
+    writer.set_compressible(True)
+    writer.write(text)
+    writer.close()
+    assert gzip.decompress(raw.getvalue()) == text + noise + text
+    assert raw.getvalue().count(b"\x1f\x8b\x08") >= 3
+    assert writer.raw_bytes == 2 * len(text) + len(noise)
+    assert writer.wire_bytes == len(raw.getvalue()) < len(noise) + 5000
+
+
+def test_compressing_writer_without_level_passes_data_through():
+    raw = io.BytesIO()
+    writer = CompressingWriter(raw, None)
+    writer.write(b"plain")
+    writer.close()
+    assert raw.getvalue() == b"plain"
+    assert writer.raw_bytes == writer.wire_bytes == 5
+
+
+def test_adaptive_level_follows_the_bottleneck():
+    level = AdaptiveLevel(6)
+    level.update(compress_time=0.9, write_time=0.1)
+    assert level.level == 5
+    level.update(compress_time=0.1, write_time=0.9)
+    level.update(compress_time=0.1, write_time=0.9)
+    assert level.level == 7
+    level.update(compress_time=0.4, write_time=0.6)
+    assert level.level == 7
+    for _ in range(10):
+        level.update(compress_time=0.1, write_time=0.9)
+    assert level.level == compression.MAX_LEVEL
+
+
+def test_compressed_tar_upload_unpacks_and_reports_savings(tmp_path: Path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "source.py").write_text("print('hello')\n" * 5000)
+    (src / "blob.gz").write_bytes(gzip.compress(os.urandom(50_000)))
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    stats = TransferStats()
+
+    result = _upload_tar_sync(
+        ["tar", "-xzf", "-", "-C", str(dst)],
+        [(PurePath("source.py"), src / "source.py"), (PurePath("blob.gz"), src / "blob.gz")],
+        compression=AdaptiveLevel(),
+        stats=stats,
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert (dst / "source.py").read_bytes() == (src / "source.py").read_bytes()
+    assert (dst / "blob.gz").read_bytes() == (src / "blob.gz").read_bytes()
+    assert stats.payload_bytes > 75_000 + 50_000
+    assert stats.sent_bytes < 60_000
+    assert "saved" in stats.describe()
+
+
+def test_format_size():
+    assert format_size(512) == "512 B"
+    assert format_size(1536) == "1.5 KiB"
+    assert format_size(3 * 1024**3) == "3.0 GiB"
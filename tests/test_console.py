@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import io
+import json
+from collections import Counter
+from pathlib import Path
+
+from watchfs.__main__ import BADGE_MOD, BADGE_MOVE
+from watchfs.console import Console, format_counts
+
+
+def test_rate_limits_change_lines():
+    stream = io.StringIO()
+    console = Console(stream, lines_per_second=3)
+    for index in range(10):
+        console.change(BADGE_MOD, Path(f"/src/file{index}"))
+    console.close()
+
+    lines = stream.getvalue().splitlines()
+    assert lines[0].endswith(" /src/file0")
+    # Three lines per second, the rest of the burst is counted instead.
+    rendered = [line for line in lines if not line.startswith("...")]
+    skipped = [int(line.split()[2]) for line in lines if line.startswith("...")]
+    assert len(rendered) <= 6
+    assert len(rendered) + sum(skipped) == 10
+
+
+def test_quiet_mode_prints_summaries():
+    stream = io.StringIO()
+    console = Console(stream, quiet=True)
+    console.change(BADGE_MOD, Path("/src/file"))
+    changes = [("modified", Path(f"/src/file{index}"), 0.1) for index in range(1204)]
+    console.synced("host-a", [*changes, ("deleted", Path("/src/old"), 0.1)], 0.5)
+    console.synced("host-a", [("deleted", Path(f"/src/gone{index}"), 0.1) for index in range(2)], 0.3)
+    console.close()
+
+    assert stream.getvalue() == "1,204 modified, 3 deleted → host-a in 0.8s\n"
+
+
+def test_logs_json_lines(tmp_path: Path):
+    log = tmp_path / "watchfs.jsonl"
+    console = Console(io.StringIO(), quiet=True)
+    console.open_log(log)
+    console.change(BADGE_MOVE, Path("/src/new"), moved_from=Path("/src/old"))
+    console.synced("host-a", [("moved", Path("/src/new"), 0.25)], 0.1)
+    console.failed("host-a", [Path("/src/new")], OSError("disk full"), retry=True)
+    console.close()
+
+    records = [json.loads(line) for line in log.read_text().splitlines()]
+    assert [record["event"] for record in records] == ["change", "synced", "failed"]
+    assert records[0]["change"] == "moved"
+    assert records[0]["from"] == "/src/old"
+    assert records[1]["lag"] == 0.25
+    assert records[2]["error"] == "disk full"
+
+
+def test_format_counts_orders_changes():
+    assert format_counts(Counter(deleted=3, added=1, rescanned=2)) == "1 added, 3 deleted, 2 rescanned"
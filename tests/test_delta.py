@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import os
+import random
+import shlex
+import struct
+from pathlib import PurePath, PurePosixPath
+from typing import TYPE_CHECKING
+
+import pytest
+
+from tests.helpers import LoopbackSshTarget
+from watchfs.compression import AdaptiveLevel
+from watchfs.delta import (
+    NO_PYTHON_EXIT_CODE,
+    delta_remote_command,
+    iter_delta,
+    signatures_of,
+    transfer_delta_sync,
+)
+from watchfs.mappings import SshTargetSpec
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+BLOCK_SIZE = 4096
+
+
+def apply_delta(old: bytes, ops: list[tuple[bytes, bytes]]) -> bytes:
+    new = bytearray()
+    for op, data in ops:
+        if op == b"L":
+            new += data
+        else:
+            (index,) = struct.unpack(">I", data)
+            new += old[index * BLOCK_SIZE : (index + 1) * BLOCK_SIZE]
+    return bytes(new)
+
+
+def literal_size(ops: list[tuple[bytes, bytes]]) -> int:
+    return sum(len(data) for op, data in ops if op == b"L")
+
+
+OLD = random.Random(0).randbytes(64 * BLOCK_SIZE + 123)
+
+
+@pytest.mark.parametrize(
+    ("new", "max_literal"),
+    [
+        (OLD, 0),
+        (OLD + b"appended" * 100, 800 + 123),
+        (OLD[: 10 * BLOCK_SIZE] + b"X" * 10 + OLD[10 * BLOCK_SIZE + 10 :], BLOCK_SIZE + 123),
+        (OLD[:5000] + b"inserted" + OLD[5000:], 2 * BLOCK_SIZE + 123),
+        (OLD[: 3 * BLOCK_SIZE] + OLD[4 * BLOCK_SIZE :], BLOCK_SIZE + 123),
+        (b"", 0),
+    ],
+)
+def test_delta_rebuilds_file_from_few_literals(new: bytes, max_literal: int):
+    ops = list(iter_delta(io.BytesIO(new), signatures_of(OLD, BLOCK_SIZE), BLOCK_SIZE))
+    assert apply_delta(OLD, ops) == new
+    assert literal_size(ops) <= max_literal
+
+
+def test_delta_without_roll_budget_only_matches_aligned_blocks():
+    new = b"shifted" + OLD
+    ops = list(iter_delta(io.BytesIO(new), signatures_of(OLD, BLOCK_SIZE), BLOCK_SIZE, roll_budget=0))
+    assert apply_delta(OLD, ops) == new
+    assert literal_size(ops) == len(new)
+
+
+def loopback_command(root: Path, name: str) -> list[str]:
+    # Runs the remote side of a delta transfer as a local process instead of over ssh.
+    return ["sh", "-c", delta_remote_command(shlex.quote(str(root)), name, BLOCK_SIZE)]
+
+
+def test_transfer_delta_updates_destination_through_loopback_helper(tmp_path: Path):
+    source = tmp_path / "source.db"
+    source.write_bytes(OLD[:20000] + b"changed" + OLD[20007:] + b"tail")
+    source.chmod(0o640)
+    os.utime(source, ns=(1_600_000_000_000_000_000, 1_600_000_000_123_456_789))
+    root = tmp_path / "remote"
+    (root / "data").mkdir(parents=True)
+    (root / "data" / "source.db").write_bytes(OLD)
+
+    stats = transfer_delta_sync(
+        loopback_command(root, "data/source.db"), source, lambda path: path.open("rb"), BLOCK_SIZE
+    )
+
+    destination = root / "data" / "source.db"
+    assert destination.read_bytes() == source.read_bytes()
+    assert destination.stat().st_mtime_ns == source.stat().st_mtime_ns
+    assert destination.stat().st_mode & 0o777 == 0o640
+    assert stats is not None
+    assert stats.literal_bytes < 2 * BLOCK_SIZE + 123
+    assert sorted(path.name for path in (root / "data").iterdir()) == ["source.db"]
+
+
+def test_transfer_delta_creates_missing_destination(tmp_path: Path):
+    source = tmp_path / "source"
+    source.write_bytes(OLD)
+    root = tmp_path / "remote"
+    root.mkdir()
+    stats = transfer_delta_sync(
+        loopback_command(root, "new/dir/file"), source, lambda path: path.open("rb"), BLOCK_SIZE
+    )
+    assert (root / "new" / "dir" / "file").read_bytes() == OLD
+    assert stats is not None
+    assert stats.literal_bytes == len(OLD)
+
+
+def test_transfer_delta_can_leave_missing_destination_alone(tmp_path: Path):
+    source = tmp_path / "source"
+    source.write_bytes(OLD)
+    root = tmp_path / "remote"
+    root.mkdir()
+    stats = transfer_delta_sync(
+        loopback_command(root, "file"), source, lambda path: path.open("rb"), BLOCK_SIZE, require_remote_copy=True
+    )
+    assert stats is not None and stats.remote_missing
+    assert list(root.iterdir()) == []
+
+
+def test_ssh_target_uploads_new_large_files_in_the_tar_stream(tmp_path: Path):
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "new.log").write_bytes(b"line\n" * 100_000)
+    (source / "old.db").write_bytes(OLD[:20000] + b"changed" + OLD[20007:])
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    (remote / "old.db").write_bytes(OLD)
+    target = LoopbackSshTarget(
+        SshTargetSpec(host="loopback", path=PurePosixPath(remote.as_posix())),
+        delta_min_size=len(OLD),
+        compression=AdaptiveLevel(),
+    )
+
+    asyncio.run(target.write_files([(PurePath(name), source / name) for name in ("new.log", "old.db")]))
+
+    for name in ("new.log", "old.db"):
+        assert (remote / name).read_bytes() == (source / name).read_bytes()
+    # Sent as a delta the new file would have gone out uncompressed, all 500 kB of it.
+    assert target.stats.sent_bytes < 100_000
+
+
+def test_transfer_delta_reports_missing_python(tmp_path: Path):
+    source = tmp_path / "source"
+    source.write_bytes(b"data")
+    command = ["sh", "-c", f"exit {NO_PYTHON_EXIT_CODE}"]
+    assert transfer_delta_sync(command, source, lambda path: path.open("rb"), BLOCK_SIZE) is None
+
+
+def test_transfer_delta_raises_on_remote_failure(tmp_path: Path):
+    source = tmp_path / "source"
+    source.write_bytes(b"data")
+    with pytest.raises(RuntimeError, match="boom"):
+        transfer_delta_sync(["sh", "-c", "echo boom >&2; exit 1"], source, lambda path: path.open("rb"), BLOCK_SIZE)
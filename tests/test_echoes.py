@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from pathlib import Path, PurePath
+
+from watchfiles import Change
+
+from watchfs.echoes import EchoSuppressor
+from watchfs.mappings import LocalTargetSpec
+from watchfs.targets import LocalTarget
+
+
+def test_drops_the_echoes_of_writes(tmp_path: Path):
+    source, root = tmp_path / "src" / "file.txt", tmp_path / "dst"
+    source.parent.mkdir()
+    source.write_text("content")
+    echoes = EchoSuppressor(root)
+    target = LocalTarget(LocalTargetSpec(root), echoes=echoes)
+    asyncio.run(target.write_file(PurePath("dir/file.txt"), source))
+
+    written = root / "dir" / "file.txt"
+    changes = {(Change.added, str(root / "dir")), (Change.added, str(written)), (Change.modified, str(written))}
+    assert echoes.filter_changes(changes) == set()
+    assert echoes.suppressed == 3
+
+    # A later change by someone else gives the file a new mtime.
+    written.write_text("edited")
+    os.utime(written, ns=(0, 10**9))
+    assert echoes.filter_changes({(Change.modified, str(written))}) == {(Change.modified, str(written))}
+
+
+def test_drops_the_echoes_of_removals_and_moves(tmp_path: Path):
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "file").write_text("x")
+    (tmp_path / "old").write_text("y")
+    echoes = EchoSuppressor(tmp_path)
+    target = LocalTarget(LocalTargetSpec(tmp_path), echoes=echoes)
+    asyncio.run(target.remove_path(PurePath("dir")))
+    asyncio.run(target.move_path(PurePath("old"), PurePath("new")))
+
+    changes = {
+        (Change.deleted, str(tmp_path / "dir")),
+        (Change.deleted, str(tmp_path / "dir" / "file")),
+        (Change.deleted, str(tmp_path / "old")),
+        (Change.added, str(tmp_path / "new")),
+    }
+    assert echoes.filter_changes(changes) == set()
+
+
+def test_keeps_changes_after_the_ttl(tmp_path: Path):
+    path = tmp_path / "file"
+    path.write_text("x")
+    echoes = EchoSuppressor(tmp_path, ttl=0)
+    echoes.expect_write(PurePath("file"), path.stat())
+    assert echoes.filter_changes({(Change.modified, str(path))}) == {(Change.modified, str(path))}
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import io
+import threading
+from typing import TYPE_CHECKING
+
+from watchfs.fanout import SharedRead, SharedReader, SharedReads, open_changed_file
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+CONTENT = bytes(range(256)) * 40
+
+
+class CountingStream(io.BytesIO):
+    def __init__(self, data: bytes) -> None:
+        super().__init__(data)
+        self.reads = 0
+
+    def read(self, size: int | None = -1) -> bytes:
+        self.reads += 1
+        return super().read(size)
+
+
+def read_all(reader: SharedReader, results: list[bytes]) -> None:
+    with reader:
+        results.append(bytes(reader.read()))
+
+
+def make_shared(path: Path, stream: io.BytesIO, *, readers: int, stall_timeout: float = 10.0) -> SharedRead:
+    return SharedRead(
+        path, stream, (0, len(CONTENT), 0), readers=readers, chunk_size=1000, window=2, stall_timeout=stall_timeout
+    )
+
+
+def test_shared_read_reads_the_source_once(tmp_path: Path):
+    stream = CountingStream(CONTENT)
+    shared = make_shared(tmp_path / "file", stream, readers=3)
+    readers = [shared.join() for _ in range(3)]
+    results: list[bytes] = []
+    threads = [threading.Thread(target=read_all, args=(reader, results)) for reader in readers if reader is not None]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == [CONTENT] * 3
+    assert stream.reads == len(CONTENT) // 1000 + 1
+    assert stream.closed
+
+
+def test_shared_read_turns_away_late_readers(tmp_path: Path):
+    shared = make_shared(tmp_path / "file", io.BytesIO(CONTENT), readers=2)
+    first = shared.join()
+    assert first is not None
+    assert first.read() == CONTENT
+    assert shared.join() is None
+
+
+def test_stalled_reader_falls_back_to_its_own_handle(tmp_path: Path):
+    path = tmp_path / "file"
+    path.write_bytes(CONTENT)
+    shared = make_shared(path, io.BytesIO(CONTENT), readers=2, stall_timeout=0.05)
+    slow = shared.join()
+    fast = shared.join()
+    assert slow is not None and fast is not None
+    head = bytes(slow.read(10))
+    assert fast.read() == CONTENT
+    assert head + slow.read() == CONTENT
+    slow.close()
+    fast.close()
+
+
+def test_shared_reads_share_unchanged_files_only(tmp_path: Path):
+    path = tmp_path / "file"
+    path.write_bytes(CONTENT)
+    reads = SharedReads(2)
+    first = reads.open(path)
+    second = reads.open(path)
+    assert isinstance(first, SharedReader) and isinstance(second, SharedReader)
+    assert first.shared is second.shared
+    third = reads.open(path)
+    assert isinstance(third, SharedReader) and third.shared is not first.shared
+    for reader in (first, second, third):
+        reader.close()
+
+
+def test_shared_reads_bound_buffered_chunks(tmp_path: Path):
+    first_path, second_path = tmp_path / "first", tmp_path / "second"
+    first_path.write_bytes(CONTENT)
+    second_path.write_bytes(CONTENT)
+    reads = SharedReads(2, max_buffered=len(CONTENT) // 2)
+    # Only one of the two expected readers ever shows up, its chunks stay for the other one.
+    with reads.open(first_path) as first:
+        assert first.read() == CONTENT
+    assert isinstance(first, SharedReader) and first.shared.buffered_bytes() == len(CONTENT)
+
+    # Opening another file releases them.
+    with reads.open(second_path) as second:
+        assert second.read() == CONTENT
+    assert first.shared.buffered_bytes() == 0
+    assert first.shared.join() is None
+
+
+def test_open_changed_file_skips_vanished_files(tmp_path: Path):
+    source = tmp_path / "source"
+    source.write_bytes(CONTENT)
+    opened = open_changed_file(source, SharedReads(2).open)
+    assert opened is not None
+    with opened[0] as reader:
+        assert opened[1].st_size == len(CONTENT)
+        assert bytes(reader.read(len(CONTENT))) == CONTENT
+    assert open_changed_file(tmp_path / "missing", SharedReads(2).open) is None
+    assert open_changed_file(tmp_path, lambda path: path.open("rb")) is None
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import errno
+import io
+import os
+from typing import TYPE_CHECKING
+
+import pytest
+
+from watchfs import fastcopy
+from watchfs.fastcopy import copy_file, stream_file
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def make_source(tmp_path: Path, content: bytes = b"content" * 1000) -> Path:
+    source = tmp_path / "source"
+    source.write_bytes(content)
+    source.chmod(0o750)
+    os.utime(source, ns=(1_600_000_000_000_000_000, 1_600_000_000_123_456_789))
+    return source
+
+
+def test_copy_file_keeps_content_mode_and_mtime(tmp_path: Path):
+    source = make_source(tmp_path)
+    destination = tmp_path / "destination"
+    destination.write_bytes(b"old")
+    assert copy_file(source, destination) is True
+    assert destination.read_bytes() == source.read_bytes()
+    assert destination.stat().st_mode & 0o777 == 0o750
+    assert destination.stat().st_mtime_ns == source.stat().st_mtime_ns
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["destination", "source"]
+
+
+def test_copy_file_skips_up_to_date_destination(tmp_path: Path):
+    source = make_source(tmp_path)
+    destination = tmp_path / "destination"
+    copy_file(source, destination)
+    inode = destination.stat().st_ino
+    assert copy_file(source, destination) is False
+    assert stream_file(source, destination, io.BytesIO(b"unused")) is False
+    assert destination.stat().st_ino == inode
+
+
+def test_failed_copy_leaves_destination_untouched(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    source = make_source(tmp_path)
+    destination = tmp_path / "destination"
+    destination.write_bytes(b"old")
+
+    def fail(reader, writer):
+        writer.write(b"partial")
+        raise OSError(errno.EIO, "I/O error")
+
+    monkeypatch.setattr(fastcopy, "_copy_data", fail)
+    with pytest.raises(OSError, match="I/O error"):
+        copy_file(source, destination)
+    assert destination.read_bytes() == b"old"
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["destination", "source"]
+
+
+@pytest.mark.parametrize("unsupported", ["reflink", "copy_file_range", "all"])
+def test_copy_file_falls_back_when_methods_are_unsupported(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, unsupported: str
+):
+    def unsupported_copy(*args):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(fastcopy, "_reflink", lambda source_fd, destination_fd: False)
+    if unsupported in ("copy_file_range", "all"):
+        monkeypatch.setattr(os, "copy_file_range", unsupported_copy, raising=False)
+    if unsupported == "all":
+        monkeypatch.setattr(os, "sendfile", unsupported_copy, raising=False)
+    source = make_source(tmp_path, os.urandom(3 * fastcopy.COPY_CHUNK_SIZE + 5))
+    destination = tmp_path / "destination"
+    assert copy_file(source, destination) is True
+    assert destination.read_bytes() == source.read_bytes()
+
+
+def test_stream_file_writes_reader_content(tmp_path: Path):
+    source = make_source(tmp_path)
+    destination = tmp_path / "nested-destination"
+    with source.open("rb") as reader:
+        assert stream_file(source, destination, reader) is True
+    assert destination.read_bytes() == source.read_bytes()
+    assert destination.stat().st_mtime_ns == source.stat().st_mtime_ns
@@ -1,10 +1,21 @@
 from __future__ import annotations
 
+import asyncio
+import os
+import random
 from pathlib import Path
 
 from watchfiles import Change
 
-from watchfs.filters import ExcludeFilter, iter_path_suffixes, match_pattern
+from watchfs.filters import (
+    ChangeCacheFilter,
+    ExcludeFilter,
+    ExcludeMatcher,
+    IgnoreFileFilter,
+    iter_path_suffixes,
+    match_pattern,
+    parse_ignore_rules,
+)
 
 
 def test_iter_path_suffixes_for_absolute_path():
@@ -48,3 +59,142 @@ def test_exclude_filter_blocks_git_events():
     assert filter_(Change.added, "/Users/meow/Projects/watchfs/.git/objects/8f/tmp_obj_oigEsw") is False
     assert filter_(Change.modified, "/Users/meow/Projects/watchfs/.git/config") is False
     assert filter_(Change.modified, "/Users/meow/Projects/watchfs/src/watchfs/__main__.py") is True
+
+
+PATTERNS = [
+    ".git/**",
+    "node_modules",
+    "build/",
+    "*.pyc",
+    "docs/_build",
+    "*/cache/**",
+    "tmp*",
+    "/Users/meow/Projects/watchfs/dist/**",
+    "/Users/meow/Projects/*/secret.txt",
+]
+NAMES = ["Users", "meow", "Projects", "watchfs", ".git", "node_modules", "build", "docs", "_build", "cache", "dist"]
+NAMES += ["a.pyc", "tmpfile", "src", "secret.txt", "x"]
+
+
+def test_exclude_matcher_agrees_with_match_pattern():
+    rng = random.Random(0)
+    paths = [
+        "/Users/meow/Projects/watchfs/.git",
+        "/Users/meow/Projects/watchfs/src/watchfs/__main__.py",
+        "/Users/meow/Projects/watchfs/dist",
+        "/Users/meow/Projects/watchfs/secret.txt",
+        "/Users/meow/Projects/watchfs/docs/_build/index.html",
+    ]
+    paths += ["/" + "/".join(rng.choice(NAMES) for _ in range(rng.randint(1, 8))) for _ in range(2000)]
+    for count in range(1, len(PATTERNS) + 1):
+        patterns = rng.sample(PATTERNS, count)
+        matcher = ExcludeMatcher(patterns)
+        for path in paths:
+            expected = any(match_pattern(Path(path), pattern) for pattern in patterns)
+            assert matcher.matches(path) == expected, (path, patterns)
+
+
+def test_exclude_matcher_excludes_descendants_of_literal_directories():
+    matcher = ExcludeMatcher(["node_modules", "docs/_build"])
+    assert matcher.matches("/repo/node_modules")
+    assert matcher.matches("/repo/web/node_modules/react/index.js")
+    assert matcher.matches("/repo/docs/_build/html/index.html")
+    assert not matcher.matches("/repo/_build/index.html")
+    assert not matcher.matches("/repo/node_modules_backup/file")
+
+
+def test_parse_ignore_rules_follows_gitignore_semantics():
+    def ignored(rules_text: str, path: str, *, is_dir: bool = False) -> bool:
+        result = False
+        for rule in parse_ignore_rules(rules_text):
+            if rule.regex.fullmatch(path) and (not rule.directory_only or is_dir):
+                result = not rule.negated
+        return result
+
+    assert ignored("*.log", "a/b/debug.log")
+    assert ignored("/build", "build")
+    assert not ignored("/build", "sub/build")
+    assert ignored("build/", "sub/build", is_dir=True)
+    assert not ignored("build/", "sub/build")
+    assert ignored("doc/*.txt", "doc/notes.txt")
+    assert not ignored("doc/*.txt", "doc/server/arch.txt")
+    assert ignored("**/foo/bar", "x/y/foo/bar")
+    assert ignored("a/**/b", "a/b")
+    assert ignored("a/**/b", "a/x/y/b")
+    assert ignored("abc/**", "abc/x/y")
+    assert not ignored("abc/**", "abc")
+    assert not ignored("*.log\n!keep.log", "keep.log")
+    assert ignored("\\#hash", "#hash")
+    assert ignored("file[0-9].txt", "file3.txt")
+    assert not ignored("file[!0-9].txt", "file3.txt")
+
+
+def test_ignore_file_filter_is_hierarchical_and_reloads(tmp_path: Path):
+    (tmp_path / "node_modules" / "pkg").mkdir(parents=True)
+    (tmp_path / "app" / "logs").mkdir(parents=True)
+    (tmp_path / ".gitignore").write_text("node_modules/\n*.log\n")
+    (tmp_path / "app" / ".watchfsignore").write_text("!important.log\n")
+    filter_ = IgnoreFileFilter([tmp_path])
+
+    def allowed(relative_path: str) -> bool:
+        return filter_(Change.modified, str(tmp_path / relative_path))
+
+    assert not allowed("node_modules")
+    assert not allowed("node_modules/pkg/index.js")
+    assert not allowed("debug.log")
+    assert allowed("app/important.log")
+    assert not allowed("app/logs/important2.log")
+    assert allowed("app/main.py")
+
+    (tmp_path / ".gitignore").write_text("*.py\n")
+    assert filter_(Change.modified, str(tmp_path / ".gitignore"))
+    assert not allowed("app/main.py")
+    assert allowed("debug.log")
+
+
+def test_change_cache_filter_drops_events_without_content_change(tmp_path: Path):
+    path = tmp_path / "file"
+    path.write_bytes(b"hello")
+    filter_ = ChangeCacheFilter()
+    assert filter_(Change.added, str(path)) is True
+    assert filter_(Change.modified, str(path)) is False
+    os.utime(path, ns=(0, 10**9))
+    assert filter_(Change.modified, str(path)) is False
+    path.write_bytes(b"world")
+    assert filter_(Change.modified, str(path)) is True
+    assert filter_(Change.deleted, str(path)) is True
+    assert filter_(Change.added, str(path)) is True
+
+
+def test_change_cache_filter_skips_hashing_unchanged_files(tmp_path: Path, monkeypatch):
+    path = tmp_path / "file"
+    path.write_bytes(b"hello")
+    filter_ = ChangeCacheFilter()
+    hashed: list[str] = []
+    calc_file_digest = filter_.calc_file_digest
+    monkeypatch.setattr(filter_, "calc_file_digest", lambda p: hashed.append(p) or calc_file_digest(p))
+    for _ in range(3):
+        filter_(Change.modified, str(path))
+    assert hashed == [str(path)]
+
+
+def test_change_cache_filter_bounds_and_expires_entries(tmp_path: Path):
+    filter_ = ChangeCacheFilter(max_entries=2)
+    paths = [tmp_path / f"file{i}" for i in range(3)]
+    for path in paths:
+        path.write_bytes(b"x")
+        filter_(Change.added, str(path))
+    assert list(filter_.cache) == [str(paths[1]), str(paths[2])]
+
+    filter_ = ChangeCacheFilter(ttl=0)
+    filter_(Change.added, str(paths[0]))
+    assert filter_(Change.modified, str(paths[0])) is True
+
+
+def test_change_cache_filter_filters_batches_off_loop(tmp_path: Path):
+    path = tmp_path / "file"
+    path.write_bytes(b"x")
+    filter_ = ChangeCacheFilter()
+    changes = asyncio.run(filter_.filter_changes({(Change.added, str(path))}))
+    assert changes == {(Change.added, str(path))}
+    assert asyncio.run(filter_.filter_changes({(Change.modified, str(path))})) == set()
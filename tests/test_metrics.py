@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING
+
+from watchfs.metrics import Metrics, serve_metrics, write_stats_file
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def test_render_prometheus_text():
+    metrics = Metrics()
+    metrics.inc("watchfs_events_applied_total", 3, target="host:/a")
+    metrics.inc("watchfs_events_applied_total", target="host:/a")
+    metrics.gauge("watchfs_queue_depth", lambda: 7, queue='local:"x"')
+    for value in (0.002, 0.2, 1000.0):
+        metrics.observe("watchfs_sync_lag_seconds", value, target="t")
+
+    lines = metrics.render().splitlines()
+    assert "# TYPE watchfs_events_applied_total counter" in lines
+    assert 'watchfs_events_applied_total{target="host:/a"} 4' in lines
+    assert 'watchfs_queue_depth{queue="local:\\"x\\""} 7' in lines
+    assert "# TYPE watchfs_sync_lag_seconds histogram" in lines
+    assert 'watchfs_sync_lag_seconds_bucket{target="t",le="0.001"} 0' in lines
+    assert 'watchfs_sync_lag_seconds_bucket{target="t",le="0.005"} 1' in lines
+    assert 'watchfs_sync_lag_seconds_bucket{target="t",le="300"} 2' in lines
+    assert 'watchfs_sync_lag_seconds_bucket{target="t",le="+Inf"} 3' in lines
+    assert 'watchfs_sync_lag_seconds_count{target="t"} 3' in lines
+    assert metrics.value("watchfs_events_applied_total", target="host:/a") == 4
+
+
+def test_metrics_endpoint_and_stats_file(tmp_path: Path):
+    metrics = Metrics()
+    metrics.inc("watchfs_events_received_total", 2, source="/src")
+
+    async def scrape(path: str) -> bytes:
+        server = await serve_metrics(metrics, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            response = await reader.read()
+            writer.close()
+            return response
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    response = asyncio.run(scrape("/metrics"))
+    assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert response.endswith(b'watchfs_events_received_total{source="/src"} 2\n')
+    assert asyncio.run(scrape("/other")).startswith(b"HTTP/1.1 404")
+
+    write_stats_file(metrics, tmp_path / "watchfs.prom")
+    assert (tmp_path / "watchfs.prom").read_text() == metrics.render()
+    assert [path.name for path in tmp_path.iterdir()] == ["watchfs.prom"]
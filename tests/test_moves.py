@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path, PurePath, PurePosixPath
+
+from watchfiles import Change
+
+from tests.helpers import LoopbackSshTarget
+from watchfs.mappings import LocalTargetSpec, SshTargetSpec
+from watchfs.moves import MoveDetector
+from watchfs.targets import LocalTarget
+
+
+def test_detector_pairs_renames(tmp_path: Path):
+    old, new = tmp_path / "old.txt", tmp_path / "new.txt"
+    old.write_text("content")
+    detector = MoveDetector()
+    assert detector.update({(Change.added, str(old))}) == []
+
+    old.rename(new)
+    assert detector.update({(Change.deleted, str(old)), (Change.added, str(new))}) == [(old, new)]
+
+    # A deletion and an unrelated addition are not a move.
+    other = tmp_path / "other.txt"
+    other.write_text("content")
+    new.unlink()
+    assert detector.update({(Change.deleted, str(new)), (Change.added, str(other))}) == []
+
+
+def test_detector_pairs_renames_of_existing_paths(tmp_path: Path):
+    (tmp_path / "dir" / "sub").mkdir(parents=True)
+    (tmp_path / "dir" / "sub" / "file.txt").write_text("content")
+    (tmp_path / "other.txt").write_text("other")
+    detector = MoveDetector()
+    detector.index(tmp_path)
+
+    (tmp_path / "dir").rename(tmp_path / "renamed")
+    changes = {(Change.deleted, str(tmp_path / "dir")), (Change.added, str(tmp_path / "renamed"))}
+    assert detector.update(changes) == [(tmp_path / "dir", tmp_path / "renamed")]
+    (tmp_path / "other.txt").rename(tmp_path / "moved.txt")
+    changes = {(Change.deleted, str(tmp_path / "other.txt")), (Change.added, str(tmp_path / "moved.txt"))}
+    assert detector.update(changes) == [(tmp_path / "other.txt", tmp_path / "moved.txt")]
+
+    # Indexing stops at the limit.
+    limited = MoveDetector(max_entries=2)
+    limited.index(tmp_path)
+    (tmp_path / "moved.txt").rename(tmp_path / "again.txt")
+    changes = {(Change.deleted, str(tmp_path / "moved.txt")), (Change.added, str(tmp_path / "again.txt"))}
+    assert limited.update(changes) == [(tmp_path / "moved.txt", tmp_path / "again.txt")]
+    (tmp_path / "renamed" / "sub").rename(tmp_path / "renamed" / "sub2")
+    changes = {(Change.deleted, str(tmp_path / "renamed" / "sub")), (Change.added, str(tmp_path / "renamed" / "sub2"))}
+    assert limited.update(changes) == []
+
+
+def test_detector_skips_moves_of_changed_directories(tmp_path: Path):
+    old, new = tmp_path / "old", tmp_path / "new"
+    old.mkdir()
+    detector = MoveDetector()
+    detector.update({(Change.added, str(old))})
+
+    old.rename(new)
+    (new / "file").write_text("x")
+    changes = {(Change.deleted, str(old)), (Change.added, str(new)), (Change.added, str(old / "file"))}
+    assert detector.update(changes) == []
+
+
+def test_local_target_moves_paths(tmp_path: Path):
+    target = LocalTarget(LocalTargetSpec(tmp_path))
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "file").write_text("x")
+    (tmp_path / "nested").mkdir()
+    (tmp_path / "nested" / "stale").write_text("y")
+
+    assert asyncio.run(target.move_path(PurePath("dir"), PurePath("nested")))
+    assert sorted(path.name for path in (tmp_path / "nested").iterdir()) == ["file"]
+    assert asyncio.run(target.move_path(PurePath("nested/file"), PurePath("a/b/file")))
+    assert (tmp_path / "a" / "b" / "file").read_text() == "x"
+    assert not asyncio.run(target.move_path(PurePath("missing"), PurePath("other")))
+
+
+def test_ssh_target_moves_paths(tmp_path: Path):
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "file name").write_text("x")
+    target = LoopbackSshTarget(SshTargetSpec(host="host1", path=PurePosixPath(tmp_path.as_posix())))
+
+    assert asyncio.run(target.move_path(PurePath("dir"), PurePath("a/b")))
+    assert (tmp_path / "a" / "b" / "file name").read_text() == "x"
+    assert not asyncio.run(target.move_path(PurePath("dir"), PurePath("c")))
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from pathlib import Path, PurePosixPath
+
+import pytest
+from watchfiles import Change
+
+from watchfs.mappings import LocalTargetSpec, SshTargetSpec
+from watchfs.priorities import Priority, PriorityPolicy, parse_priority_rule, priority_for
+
+
+def test_policy_classifies_by_pattern_size_and_recency(tmp_path: Path):
+    small, medium, large = tmp_path / "small.txt", tmp_path / "medium.dat", tmp_path / "large.dat"
+    small.write_bytes(bytes(10))
+    medium.write_bytes(bytes(1000))
+    large.write_bytes(bytes(5000))
+    (tmp_path / "model.bin").write_bytes(bytes(10))
+    policy = PriorityPolicy([("*.bin", Priority.LOW)], small_file_size=100, large_file_size=4000)
+
+    changes = [
+        (Change.modified, small),
+        (Change.modified, medium),
+        (Change.added, large),
+        (Change.added, tmp_path / "model.bin"),
+        (Change.deleted, tmp_path / "gone"),
+        (Change.added, tmp_path),
+    ]
+    assert policy.classify(changes) == {
+        small: Priority.HIGH,
+        medium: Priority.NORMAL,
+        large: Priority.LOW,
+        tmp_path / "model.bin": Priority.LOW,
+        tmp_path / "gone": Priority.HIGH,
+        tmp_path: Priority.NORMAL,
+    }
+    # Saved again, so someone is working on it, unless it is large.
+    assert policy.classify([(Change.modified, medium), (Change.modified, large)]) == {
+        medium: Priority.HIGH,
+        large: Priority.LOW,
+    }
+
+
+def test_parses_priority_rules():
+    assert parse_priority_rule("*.py=high") == ("*.py", Priority.HIGH)
+    assert parse_priority_rule("host-a=Low") == ("host-a", Priority.LOW)
+    with pytest.raises(ValueError, match="Invalid priority"):
+        parse_priority_rule("*.py=urgent")
+    with pytest.raises(ValueError, match="Invalid priority rule"):
+        parse_priority_rule("high")
+
+
+def test_priority_for_targets():
+    rules = [("host-a", Priority.LOW), ("/backup", Priority.HIGH)]
+    assert priority_for(SshTargetSpec(host="host-a", path=PurePosixPath("/data")), rules) == Priority.LOW
+    assert priority_for(SshTargetSpec(host="host-b", path=PurePosixPath("/data")), rules) is None
+    assert priority_for(LocalTargetSpec(Path("/backup")), rules) == Priority.HIGH
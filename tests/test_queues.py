@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import time
+from pathlib import Path
+
+import pytest
+from watchfiles import Change
+
+from watchfs.events import SyncEvent, SyncJob, coalesce_changes
+from watchfs.mappings import LocalTargetSpec, SyncMapping
+from watchfs.priorities import Priority
+from watchfs.queues import CoalescingQueue
+
+JOB = SyncJob(mapping=SyncMapping(Path("src"), LocalTargetSpec(Path("dst"))), target=None, queue_key="q")  # type: ignore
+
+
+def event(change: Change, path: str) -> SyncEvent:
+    return SyncEvent(job=JOB, change=change, path=Path(path))
+
+
+def drain(queue: CoalescingQueue) -> list[tuple[Change, Path]]:
+    events: list[tuple[Change, Path]] = []
+    while not queue.empty():
+        item = queue.get_nowait()
+        events.append((item.change, item.path))
+        queue.task_done(item)
+    return events
+
+
+@pytest.mark.parametrize(
+    ("previous", "current", "expected"),
+    [
+        (Change.added, Change.modified, Change.added),
+        (Change.added, Change.deleted, None),
+        (Change.modified, Change.modified, Change.modified),
+        (Change.modified, Change.deleted, Change.deleted),
+        (Change.deleted, Change.added, Change.modified),
+        (Change.deleted, Change.deleted, Change.deleted),
+    ],
+)
+def test_coalesce_changes(previous: Change, current: Change, expected: Change | None):
+    assert coalesce_changes(previous, current) == expected
+
+
+def test_queue_keeps_latest_state_per_path():
+    queue = CoalescingQueue()
+    for _ in range(5):
+        queue.put_nowait(event(Change.modified, "src/a"))
+    queue.put_nowait(event(Change.added, "src/tmp"))
+    queue.put_nowait(event(Change.deleted, "src/tmp"))
+    assert drain(queue) == [(Change.modified, Path("src/a"))]
+    assert queue.coalesced == 5
+
+
+def test_queue_moves_merged_path_behind_newer_events():
+    queue = CoalescingQueue()
+    queue.put_nowait(event(Change.added, "src/d/f"))
+    queue.put_nowait(event(Change.deleted, "src/d"))
+    queue.put_nowait(event(Change.modified, "src/d/f"))
+    assert drain(queue) == [(Change.deleted, Path("src/d")), (Change.added, Path("src/d/f"))]
+
+
+def test_queue_debounce_waits_for_quiet_path():
+    async def run() -> None:
+        queue = CoalescingQueue(debounce=0.05)
+        queue.put_nowait(event(Change.modified, "src/a"))
+        with pytest.raises(asyncio.QueueEmpty):
+            queue.get_nowait()
+        item = await asyncio.wait_for(queue.get(), 1)
+        assert item.path == Path("src/a")
+
+    asyncio.run(run())
+
+
+def test_overlapping_paths_wait_for_in_flight_events():
+    queue = CoalescingQueue()
+    for change, path in [
+        (Change.added, "/src/a"),
+        (Change.deleted, "/src/a/b"),
+        (Change.modified, "/src/c"),
+        (Change.modified, "/src/a/b/c"),
+        (Change.modified, "/src/d"),
+    ]:
+        queue.put_nowait(event(change, path))
+    first = queue.get_nowait()
+    assert first.path == Path("/src/a")
+    # The descendants of /src/a are held back, the later one also behind the earlier one.
+    assert [queue.get_nowait().path for _ in range(2)] == [Path("/src/c"), Path("/src/d")]
+    with pytest.raises(asyncio.QueueEmpty):
+        queue.get_nowait()
+    queue.task_done(first)
+    second = queue.get_nowait()
+    assert second.path == Path("/src/a/b")
+    with pytest.raises(asyncio.QueueEmpty):
+        queue.get_nowait()
+    queue.task_done(second)
+    assert queue.get_nowait().path == Path("/src/a/b/c")
+
+
+def test_new_event_for_in_flight_path_waits():
+    async def run() -> list[str]:
+        queue = CoalescingQueue()
+        queue.put_nowait(event(Change.modified, "/src/a"))
+        order: list[str] = []
+
+        async def worker(name: str) -> None:
+            item = await queue.get()
+            order.append(f"{name} start {item.change.name}")
+            await asyncio.sleep(0.01)
+            order.append(f"{name} done")
+            queue.task_done(item)
+
+        first = asyncio.create_task(worker("first"))
+        await asyncio.sleep(0)
+        queue.put_nowait(event(Change.deleted, "/src/a"))
+        await asyncio.gather(first, worker("second"))
+        return order
+
+    assert asyncio.run(run()) == ["first start modified", "first done", "second start deleted", "second done"]
+
+
+def test_move_waits_for_events_on_either_path():
+    queue = CoalescingQueue()
+    queue.put_nowait(event(Change.modified, "/src/old/a"))
+    queue.put_nowait(SyncEvent(job=JOB, change=Change.added, path=Path("/src/new"), moved_from=Path("/src/old")))
+    queue.put_nowait(event(Change.modified, "/src/new/b"))
+    assert queue.has_pending(JOB.mapping, Path("/src/old"))
+    assert not queue.has_pending(JOB.mapping, Path("/src/other"))
+    first = queue.get_nowait()
+    assert first.path == Path("/src/old/a")
+    with pytest.raises(asyncio.QueueEmpty):
+        queue.get_nowait()
+    queue.task_done(first)
+    move = queue.get_nowait()
+    assert move.moved_from == Path("/src/old")
+    with pytest.raises(asyncio.QueueEmpty):
+        queue.get_nowait()
+    queue.task_done(move)
+    assert queue.get_nowait().path == Path("/src/new/b")
+
+
+def test_overflow_collapses_into_subtree_rescan():
+    mapping = SyncMapping(Path("/src"), LocalTargetSpec(Path("dst")))
+    job = SyncJob(mapping=mapping, target=None, queue_key="q")  # type: ignore
+    queue = CoalescingQueue(limit=8)
+    for name in ["/src/other", "/src/a/b/1", "/src/a/b/2", "/src/a/c", "/src/a/b/3", "/src/a/b/4", "/src/a/b/5"]:
+        queue.put_nowait(SyncEvent(job=job, change=Change.modified, path=Path(name)))
+    assert queue.qsize() == 7
+    queue.put_nowait(SyncEvent(job=job, change=Change.modified, path=Path("/src/a/b/6")))
+    queue.put_nowait(SyncEvent(job=job, change=Change.deleted, path=Path("/src/a/b/7")))
+    # /src/a/b alone frees enough entries to get back to 6 of 8.
+    assert [(item.path, item.rescan) for item, _ in queue._pending.values()] == [
+        (Path("/src/other"), False),
+        (Path("/src/a/c"), False),
+        (Path("/src/a/b"), True),
+    ]
+    # Changes below a pending rescan are covered by it.
+    queue.put_nowait(SyncEvent(job=job, change=Change.added, path=Path("/src/a/b/8/9")))
+    assert queue.qsize() == 3
+    assert queue.collapsed == 7
+    assert drain(queue)[-1] == (Change.modified, Path("/src/a/b"))
+    # Once the rescan was handed out, new changes are queued again.
+    queue.put_nowait(SyncEvent(job=job, change=Change.added, path=Path("/src/a/b/8/9")))
+    assert queue.qsize() == 1
+
+
+def test_requeue_puts_failed_events_back_in_front():
+    queue = CoalescingQueue()
+    for change, path in [(Change.added, "/src/a"), (Change.deleted, "/src/b"), (Change.modified, "/src/c")]:
+        queue.put_nowait(event(change, path))
+    failed = [queue.get_nowait(), queue.get_nowait()]
+    queue.put_nowait(event(Change.deleted, "/src/a"))
+    queue.requeue(failed)
+    for item in failed:
+        queue.task_done(item)
+    # The addition may have been partly written, so the later deletion still has to happen.
+    assert drain(queue) == [
+        (Change.deleted, Path("/src/a")),
+        (Change.deleted, Path("/src/b")),
+        (Change.modified, Path("/src/c")),
+    ]
+
+
+def test_requeued_event_waits_for_its_retry_time():
+    queue = CoalescingQueue()
+    queue.put_nowait(event(Change.modified, "/src/a"))
+    failed = queue.get_nowait()
+    queue.requeue([dataclasses.replace(failed, retry_at=time.monotonic() + 0.05)])
+    queue.task_done(failed)
+    queue.put_nowait(event(Change.modified, "/src/a/b"))
+    queue.put_nowait(event(Change.modified, "/src/c"))
+    # Unrelated paths go ahead, overlapping ones stay behind the failed event.
+    assert queue.get_nowait().path == Path("/src/c")
+    with pytest.raises(asyncio.QueueEmpty):
+        queue.get_nowait()
+
+    async def take() -> Path:
+        return (await asyncio.wait_for(queue.get(), 1)).path
+
+    assert asyncio.run(take()) == Path("/src/a")
+
+
+def test_queue_hands_out_urgent_classes_first():
+    queue = CoalescingQueue()
+    queue.put_nowait(dataclasses.replace(event(Change.modified, "src/big.bin"), priority=Priority.LOW))
+    queue.put_nowait(event(Change.modified, "src/notes.txt"))
+    queue.put_nowait(dataclasses.replace(event(Change.modified, "src/main.py"), priority=Priority.HIGH))
+    assert drain(queue) == [
+        (Change.modified, Path("src/main.py")),
+        (Change.modified, Path("src/notes.txt")),
+        (Change.modified, Path("src/big.bin")),
+    ]
+
+
+def test_queue_never_overtakes_overlapping_paths():
+    queue = CoalescingQueue()
+    queue.put_nowait(dataclasses.replace(event(Change.deleted, "src/d"), priority=Priority.LOW))
+    queue.put_nowait(dataclasses.replace(event(Change.added, "src/d/f"), priority=Priority.HIGH))
+    queue.put_nowait(dataclasses.replace(event(Change.added, "src/other"), priority=Priority.HIGH))
+    assert drain(queue) == [
+        (Change.added, Path("src/other")),
+        (Change.deleted, Path("src/d")),
+        (Change.added, Path("src/d/f")),
+    ]
+
+
+def test_queue_ages_waiting_entries():
+    queue = CoalescingQueue(aging=0.01)
+    queue.put_nowait(dataclasses.replace(event(Change.modified, "src/big.bin"), priority=Priority.LOW))
+    time.sleep(0.05)
+    queue.put_nowait(dataclasses.replace(event(Change.modified, "src/main.py"), priority=Priority.HIGH))
+    assert drain(queue)[0] == (Change.modified, Path("src/big.bin"))
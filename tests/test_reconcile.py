@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+from pathlib import Path
+
+from watchfiles import Change
+
+from tests.helpers import write
+from watchfs.events import SyncJob
+from watchfs.filters import ExcludeFilter
+from watchfs.mappings import LocalTargetSpec, SyncMapping
+from watchfs.queues import CoalescingQueue
+from watchfs.reconcile import diff_subtree, reconcile_job
+from watchfs.scan import iter_file_paths, walk_files
+from watchfs.targets import LocalTarget
+
+
+def test_walk_files_is_sorted_bytewise_and_prunes(tmp_path: Path):
+    for name in ["a/b", "a-c", "a0", "b", "node_modules/x", "z/y/x"]:
+        write(tmp_path / name, name)
+    paths = [state.path for state in walk_files(tmp_path, ExcludeFilter("node_modules"))]
+    assert paths == sorted(paths)
+    assert paths == ["a-c", "a/b", "a0", "b", "z/y/x"]
+
+
+def test_iter_file_paths_finds_the_same_files_unsorted(tmp_path: Path):
+    for name in ["a/b", "a-c", "a0", "b", "node_modules/x", "z/y/x"]:
+        write(tmp_path / name, name)
+    (tmp_path / "empty").mkdir()
+    assert sorted(iter_file_paths(tmp_path, ExcludeFilter("node_modules"))) == ["a-c", "a/b", "a0", "b", "z/y/x"]
+
+
+def test_reconcile_queues_only_outdated_files(tmp_path: Path):
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    write(src / "same.txt", "same")
+    write(dst / "same.txt", "same")
+    write(src / "resized.txt", "longer")
+    write(dst / "resized.txt", "short")
+    write(src / "touched.txt", "same", mtime=1_700_000_000)
+    write(dst / "touched.txt", "same")
+    write(src / "nested" / "new.txt", "new")
+    write(dst / "stale.txt", "stale")
+
+    mapping = SyncMapping(src, LocalTargetSpec(dst))
+    job = SyncJob(mapping=mapping, target=LocalTarget(mapping.target), queue_key="q")  # type: ignore
+    queue = CoalescingQueue()
+    stats = asyncio.run(reconcile_job(job, queue, delete=True))
+
+    queued: list[tuple[Change, Path]] = []
+    while not queue.empty():
+        event = queue.get_nowait()
+        queued.append((event.change, event.path.relative_to(src.resolve())))
+    assert queued == [
+        (Change.modified, Path("nested/new.txt")),
+        (Change.modified, Path("resized.txt")),
+        (Change.deleted, Path("stale.txt")),
+        (Change.modified, Path("touched.txt")),
+    ]
+    assert (stats.written, stats.deleted, stats.unchanged) == (3, 1, 1)
+
+
+def test_diff_subtree_compares_one_directory(tmp_path: Path):
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    write(src / "sub" / "same.txt", "same")
+    write(dst / "sub" / "same.txt", "same")
+    write(src / "sub" / "deep" / "new.txt", "new")
+    write(dst / "sub" / "stale.txt", "stale")
+    write(src / "outside.txt", "outside")
+
+    mapping = SyncMapping(src, LocalTargetSpec(dst))
+    job = SyncJob(mapping=mapping, target=LocalTarget(mapping.target), queue_key="q")  # type: ignore
+
+    async def collect() -> list[tuple[Change, Path]]:
+        return [(change, path) async for change, path in diff_subtree(job, src.resolve() / "sub")]
+
+    assert asyncio.run(collect()) == [
+        (Change.modified, src.resolve() / "sub/deep/new.txt"),
+        (Change.deleted, src.resolve() / "sub/stale.txt"),
+    ]
+
+    # A bidirectional job keeps the other side's files and its newer copies.
+    write(dst / "sub" / "deep" / "new.txt", "newer", mtime=1_700_000_000)
+    write(src / "sub" / "older.txt", "older")
+    write(dst / "sub" / "older.txt", "old", mtime=1_500_000_000)
+    job = dataclasses.replace(job, bidirectional=True)
+    assert asyncio.run(collect()) == [(Change.modified, src.resolve() / "sub/older.txt")]
@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import threading
+import time
+from pathlib import Path, PurePath, PurePosixPath
+
+import pytest
+
+from tests.helpers import LoopbackSshTarget
+from watchfs.mappings import LocalTargetSpec, SshTargetSpec
+from watchfs.shaping import ShapedWriter, TokenBucket, buckets_for, parse_bandwidth_limit, parse_rate
+
+MiB = 1024 * 1024
+
+
+def test_bucket_paces_writes():
+    bucket = TokenBucket(4 * MiB, burst=64 * 1024)
+    stream = io.BytesIO()
+    started = time.monotonic()
+    ShapedWriter(stream, [bucket]).write(bytes(MiB))
+    assert time.monotonic() - started >= 0.2
+    assert stream.getvalue() == bytes(MiB)
+
+
+def test_small_writes_overtake_bulk_writes():
+    bucket = TokenBucket(2 * MiB, burst=64 * 1024)
+    bulk = threading.Thread(target=ShapedWriter(io.BytesIO(), [bucket]).write, args=(bytes(2 * MiB),))
+    bulk.start()
+    time.sleep(0.1)
+    started = time.monotonic()
+    ShapedWriter(io.BytesIO(), [bucket]).write(bytes(64 * 1024))
+    small = time.monotonic() - started
+    bulk.join()
+    # Behind the whole bulk write it would wait most of a second, it only waits for its next piece.
+    assert small < 0.25
+
+
+def test_parses_limits():
+    assert parse_rate("512K") == 512 * 1024
+    assert parse_rate("1.5MiB/s") == 1.5 * MiB
+    assert parse_rate("100") == 100
+    with pytest.raises(ValueError, match="Invalid rate"):
+        parse_rate("fast")
+    assert parse_bandwidth_limit("10M") == (None, 10 * MiB)
+    assert parse_bandwidth_limit("host-a=1M") == ("host-a", MiB)
+
+
+def test_buckets_for_picks_the_named_limit():
+    limits = [(None, 10 * MiB), ("host-a", MiB)]
+    shared = TokenBucket(20 * MiB)
+    host_a = SshTargetSpec(host="host-a", path=PurePosixPath("/data"), username="me")
+    host_b = SshTargetSpec(host="host-b", path=PurePosixPath("/data"))
+
+    assert [bucket.rate for bucket in buckets_for(host_a, limits, shared)] == [MiB, 20 * MiB]
+    assert [bucket.rate for bucket in buckets_for(host_b, limits)] == [10 * MiB]
+    assert buckets_for(host_b, []) == ()
+    assert buckets_for(LocalTargetSpec(Path("/dst")), limits, shared) == ()
+
+
+def test_ssh_uploads_are_paced(tmp_path: Path):
+    source = tmp_path / "file.bin"
+    source.write_bytes(bytes(MiB))
+    remote = tmp_path / "remote"
+    bucket = TokenBucket(4 * MiB, burst=64 * 1024)
+    target = LoopbackSshTarget(
+        SshTargetSpec(host="loopback", path=PurePosixPath(remote.as_posix())), delta_min_size=None, buckets=(bucket,)
+    )
+
+    started = time.monotonic()
+    asyncio.run(target.write_files([(PurePath("file.bin"), source)]))
+    assert time.monotonic() - started >= 0.2
+    assert (remote / "file.bin").read_bytes() == bytes(MiB)
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path, PurePath
+
+from watchfiles import Change
+
+from tests.helpers import write
+from watchfs.events import SyncJob
+from watchfs.mappings import LocalTargetSpec, SyncMapping
+from watchfs.queues import CoalescingQueue
+from watchfs.reconcile import reconcile_job
+from watchfs.scan import FileState
+from watchfs.state import SyncStateIndex
+from watchfs.targets import LocalTarget
+
+
+def test_index_updates_survive_reopening(tmp_path: Path):
+    index = SyncStateIndex(tmp_path / "state.sqlite3")
+    index.record([FileState("a/1", 1, 1.5), FileState("a/2", 2, 2.0), FileState("a-b", 3, 3.0), FileState("c", 4, 4.0)])
+    index.move(PurePath("a"), PurePath("d"))
+    index.remove(PurePath("c"))
+    index.mark_complete()
+    # Not flushed yet, so a crash now would leave the index as it was.
+    assert list(SyncStateIndex(tmp_path / "state.sqlite3").iter_files()) == []
+    index.close()
+
+    reopened = SyncStateIndex(tmp_path / "state.sqlite3")
+    assert reopened.complete
+    assert list(reopened.iter_files()) == [FileState("a-b", 3, 3.0), FileState("d/1", 1, 1.5), FileState("d/2", 2, 2.0)]
+
+
+def test_reconcile_compares_to_a_complete_index(tmp_path: Path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    write(src / "same.txt", "same")
+    write(dst / "same.txt", "same")
+    write(src / "gone.txt", "gone")
+    write(dst / "gone.txt", "gone")
+    mapping = SyncMapping(src, LocalTargetSpec(dst))
+    state = SyncStateIndex.for_mapping(tmp_path / "state", mapping)
+    job = SyncJob(mapping=mapping, target=LocalTarget(mapping.target), queue_key="q", state=state)  # type: ignore
+
+    stats = asyncio.run(reconcile_job(job, CoalescingQueue()))
+    assert (stats.written, stats.unchanged) == (0, 2)
+    assert state.complete
+
+    # Changes made while not running, the destination is no longer listed.
+    write(src / "same.txt", "same", mtime=1_700_000_000)
+    (src / "gone.txt").unlink()
+    write(src / "new.txt", "new")
+    (dst / "same.txt").unlink()
+    queue = CoalescingQueue()
+    stats = asyncio.run(reconcile_job(job, queue))
+    queued = []
+    while not queue.empty():
+        event = queue.get_nowait()
+        queued.append((event.change, event.path.relative_to(src.resolve())))
+    assert queued == [
+        (Change.deleted, Path("gone.txt")),
+        (Change.modified, Path("new.txt")),
+        (Change.modified, Path("same.txt")),
+    ]
+    state.close()
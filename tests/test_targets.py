@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import os
+from pathlib import Path, PurePath, PurePosixPath
+
+import pytest
+
+from watchfs.exceptions import TargetUnavailableError
+from watchfs.mappings import LocalTargetSpec, SshTargetSpec
+from watchfs.targets import LocalTarget, SshSession, SshTarget, TargetHealth, _upload_tar_sync
+
+SPEC = SshTargetSpec(host="192.168.66.1", path=PurePosixPath("/tmp/watchfs"), username="meow", port=2222)
+
+
+def test_ssh_command_without_session_connects_directly():
+    target = SshTarget(SPEC)
+    assert target._ssh_base_command() == ["ssh", "-p", "2222", "-o", "BatchMode=yes", "meow@192.168.66.1"]
+
+
+def test_ssh_command_reuses_session_control_path():
+    target = SshTarget(SPEC)
+    session = SshSession(SPEC)
+    session.control_path = Path("/tmp/watchfs-ssh-test/control")
+    target.session = session
+    command = target._ssh_base_command()
+    assert command[-1] == "meow@192.168.66.1"
+    assert "ControlPath=/tmp/watchfs-ssh-test/control" in command
+    assert "ControlMaster=no" in command
+
+
+def test_ssh_session_that_never_connects_is_unavailable(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    # Like ssh to a host that drops the packets.
+    stub = tmp_path / "ssh"
+    stub.write_text("#!/bin/sh\nexec sleep 60\n")
+    stub.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(SshSession, "CONNECT_TIMEOUT", 1)
+    target = SshTarget(SPEC)
+    with pytest.raises(TargetUnavailableError, match="timed out"):
+        asyncio.run(target.start())
+    assert target.session is None
+
+
+def test_upload_tar_unpacks_files_with_mtime(tmp_path: Path):
+    src = tmp_path / "src"
+    (src / "nested").mkdir(parents=True)
+    (src / "a.txt").write_text("a")
+    (src / "nested" / "b.txt").write_text("b")
+    os.utime(src / "a.txt", (1_600_000_000, 1_600_000_000))
+    dst = tmp_path / "dst"
+    dst.mkdir()
+
+    result = _upload_tar_sync(
+        ["tar", "-xf", "-", "-C", str(dst)],
+        [
+            (PurePath("a.txt"), src / "a.txt"),
+            (PurePath("nested/b.txt"), src / "nested" / "b.txt"),
+            (PurePath("gone.txt"), src / "gone.txt"),
+        ],
+    )
+
+    assert result.returncode == 0
+    assert (dst / "a.txt").read_text() == "a"
+    assert (dst / "nested" / "b.txt").read_text() == "b"
+    assert not (dst / "gone.txt").exists()
+    assert (dst / "a.txt").stat().st_mtime == 1_600_000_000
+
+
+class ShortReads(io.BytesIO):
+    # Returns less than asked for, like a ``SharedReader`` at the end of a chunk.
+    def read(self, size: int | None = -1) -> bytes:
+        return super().read(min(size, 1000) if size is not None and size >= 0 else size)
+
+
+def test_upload_tar_retries_short_reads(tmp_path: Path):
+    source = tmp_path / "file.bin"
+    source.write_bytes(bytes(range(256)) * 200)
+    dst = tmp_path / "dst"
+    dst.mkdir()
+
+    result = _upload_tar_sync(
+        ["tar", "-xf", "-", "-C", str(dst)],
+        [(PurePath("file.bin"), source)],
+        lambda path: ShortReads(path.read_bytes()),
+    )
+
+    assert result.returncode == 0
+    assert (dst / "file.bin").read_bytes() == source.read_bytes()
+
+
+def test_local_target_writes_files_with_bounded_concurrency(tmp_path: Path, monkeypatch):
+    sources = []
+    for index in range(20):
+        source = tmp_path / "src" / f"dir{index % 3}" / f"file{index}"
+        source.parent.mkdir(parents=True, exist_ok=True)
+        source.write_text(str(index))
+        sources.append((PurePath(source.relative_to(tmp_path / "src")), source))
+    target = LocalTarget(LocalTargetSpec(tmp_path / "dst"), concurrency=4)
+    in_flight = peak = 0
+    write_file = LocalTarget.write_file
+
+    async def tracked_write_file(self, relative_path, source, opener=None):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        await write_file(self, relative_path, source, opener)
+        in_flight -= 1
+
+    monkeypatch.setattr(LocalTarget, "write_file", tracked_write_file)
+    asyncio.run(target.write_files(iter(sources)))
+    assert peak == 4
+    for relative_path, source in sources:
+        assert (tmp_path / "dst" / relative_path).read_text() == source.read_text()
+
+
+class FlakyTarget(LocalTarget):
+    # Unreachable until ``reconnect`` was tried ``outage`` times.
+    outage = 2
+
+    async def reconnect(self) -> None:
+        self.outage -= 1
+        if self.outage > 0:
+            raise TargetUnavailableError("still down")
+
+
+def test_health_backs_off_until_targets_reconnect(tmp_path: Path):
+    health = TargetHealth(base_delay=0.01, max_delay=0.02)
+    target = FlakyTarget(LocalTargetSpec(tmp_path))
+    delays = [health.failed([target]) for _ in range(3)]
+    assert all(0.005 <= delay <= 0.02 for delay in delays)
+    assert delays[2] >= 0.01
+
+    assert asyncio.run(health.reconnect()) == []
+    assert health.unavailable
+    assert asyncio.run(health.reconnect()) == [target]
+    assert not health.unavailable
+    assert health.failures == 0
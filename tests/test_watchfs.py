@@ -1,12 +1,19 @@
 from __future__ import annotations
 
+import asyncio
 import tomllib
 from pathlib import Path, PurePosixPath
 
+from watchfiles import Change
+
 from watchfs import __version__
-from watchfs.__main__ import build_queue_key
-from watchfs.mappings import LocalTargetSpec, SshTargetSpec, parse_sync_mapping, parse_target_spec
+from watchfs.__main__ import MAX_ATTEMPTS, build_queue_key, consume_target_queue, split_event_runs
+from watchfs.delta import MIN_BLOCK_SIZE, transfer_delta_sync
+from watchfs.events import SyncEvent, SyncJob
+from watchfs.mappings import LocalTargetSpec, SshTargetSpec, SyncMapping, parse_sync_mapping, parse_target_spec
+from watchfs.queues import CoalescingQueue
 from watchfs.rusty import Err, Ok
+from watchfs.targets import TargetHealth
 
 with Path("pyproject.toml").open("rb") as f:
     project_info = tomllib.load(f)
@@ -168,3 +175,97 @@ def test_different_ssh_machine_uses_different_queue_key():
             raise AssertionError("expected second ssh mapping to parse")
 
     assert build_queue_key(first_mapping) != build_queue_key(second_mapping)
+
+
+def test_split_event_runs_keeps_order_per_job():
+    first = SyncJob(mapping=SyncMapping(Path("a"), LocalTargetSpec(Path("x"))), target=None, queue_key="q")  # type: ignore
+    second = SyncJob(mapping=SyncMapping(Path("b"), LocalTargetSpec(Path("y"))), target=None, queue_key="q")  # type: ignore
+    events = [
+        SyncEvent(first, Change.added, Path("a/1")),
+        SyncEvent(second, Change.deleted, Path("b/1")),
+        SyncEvent(first, Change.modified, Path("a/2")),
+        SyncEvent(first, Change.deleted, Path("a/1")),
+        SyncEvent(first, Change.added, Path("a/3")),
+        SyncEvent(first, Change.added, Path("a/4"), moved_from=Path("a/3")),
+    ]
+    runs = [(job, kind, [event.path for event in run]) for job, kind, run in split_event_runs(events)]
+    assert runs == [
+        (first, "write", [Path("a/1"), Path("a/2")]),
+        (first, "remove", [Path("a/1")]),
+        (first, "write", [Path("a/3")]),
+        (first, "move", [Path("a/4")]),
+        (second, "remove", [Path("b/1")]),
+    ]
+
+
+class OutageTarget:
+    # Unreachable for the first ``outages`` writes, every write after that fails ``broken`` paths.
+    description = "outage"
+
+    def __init__(self, broken: set[str], outages: int) -> None:
+        self.broken = broken
+        self.outages = outages
+        self.written: list[str] = []
+
+    async def reconnect(self) -> None:
+        pass
+
+    async def write_files(self, files, opener=None) -> None:
+        if self.outages:
+            self.outages -= 1
+            # A delta transfer whose ssh connection fails.
+            command = ["sh", "-c", "echo 'Connection refused' >&2; exit 255"]
+            path = next(iter(files))[1]
+            transfer_delta_sync(command, path, lambda source: source.open("rb"), MIN_BLOCK_SIZE)
+        names = [relative_path.as_posix() for relative_path, _ in files]
+        if self.broken.intersection(names):
+            raise RuntimeError("broken")
+        self.written.extend(names)
+
+
+def test_consumer_buffers_while_offline_and_isolates_failing_paths(tmp_path: Path):
+    for name in ["a", "b", "bad"]:
+        (tmp_path / name).write_text(name)
+    # More outages than attempts, none of them count as one.
+    target = OutageTarget({"bad"}, MAX_ATTEMPTS + 1)
+    job = SyncJob(mapping=SyncMapping(tmp_path, LocalTargetSpec(Path("dst"))), target=target, queue_key="q")  # type: ignore
+
+    async def run() -> None:
+        queue = CoalescingQueue()
+        health = TargetHealth(base_delay=0.001, max_delay=0.001)
+        for name in ["a", "bad", "b"]:
+            queue.put_nowait(SyncEvent(job, Change.modified, tmp_path.resolve() / name))
+        worker = asyncio.create_task(consume_target_queue(queue, health))
+        async with asyncio.timeout(10):
+            while len(target.written) < 2:
+                await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        worker.cancel()
+        assert queue.empty()
+
+    asyncio.run(run())
+    assert sorted(target.written) == ["a", "b"]
+
+
+def test_consumer_backs_off_failing_paths_alone(tmp_path: Path):
+    for name in ["a", "bad"]:
+        (tmp_path / name).write_text(name)
+    target = OutageTarget({"bad"}, 0)
+    job = SyncJob(mapping=SyncMapping(tmp_path, LocalTargetSpec(Path("dst"))), target=target, queue_key="q")  # type: ignore
+
+    async def run() -> None:
+        queue = CoalescingQueue()
+        health = TargetHealth(base_delay=60, max_delay=60)
+        queue.put_nowait(SyncEvent(job, Change.modified, tmp_path.resolve() / "bad"))
+        worker = asyncio.create_task(consume_target_queue(queue, health))
+        await asyncio.sleep(0.05)
+        queue.put_nowait(SyncEvent(job, Change.modified, tmp_path.resolve() / "a"))
+        async with asyncio.timeout(5):
+            while not target.written:
+                await asyncio.sleep(0.01)
+        worker.cancel()
+        assert health.failures == 0
+        assert queue.qsize() == 1
+
+    asyncio.run(run())
+    assert target.written == ["a"]